@@ -0,0 +1,7 @@
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# All benchmarks in the suite.
+__all__ = ( "dispatch", "suite" )
@@ -0,0 +1,63 @@
+#
+# Benchmark of the raw instruction throughput of the ZCpu execution
+# loop, using a synthetic story which spins in a tight loop of cheap
+# arithmetic, branch and call instructions.
+#
+# Run it from the root directory of the distribution:
+#
+#     python -m benchmarks.dispatch [instructions]
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import sys
+import time
+
+from zvm import zmachine, trivialzui
+from tests.storybuild import Assembler, Label, SP, glob, local, build_story
+
+DEFAULT_INSTRUCTIONS = 200000
+
+def make_loop_story():
+  """Return a story image which loops forever over a mix of common
+  instructions."""
+  asm = Assembler(0x1100)
+  asm.routine('main', 2)
+  asm.label('loop')
+  asm.op('add', glob(0), 1, store=glob(0))
+  asm.op('and', glob(0), 0xff, store=glob(1))
+  asm.op('jz', glob(1), branch=('skip', True))
+  asm.op('call_2s', Label('double'), glob(1), store=SP)
+  asm.op('store', 2, SP)
+  asm.label('skip')
+  asm.op('inc', 1)
+  asm.op('jl', local(1), 100, branch=('loop', True))
+  asm.op('store', 1, 0)
+  asm.op('jump', 'loop')
+  asm.routine('double', 1)
+  asm.op('add', local(1), local(1), store=glob(2))
+  asm.op('rtrue')
+  return build_story(asm)
+
+def run(instructions=DEFAULT_INSTRUCTIONS, translate=False):
+  """Run the loop story for INSTRUCTIONS instructions, and return the
+  number of instructions executed per second. If TRANSLATE is true,
+  run the story in the translating mode of the CPU."""
+  machine = zmachine.ZMachine(make_loop_story(),
+                              ui=trivialzui.create_zui(),
+                              translate=translate)
+  start = time.perf_counter()
+  machine.run(max_instructions=instructions)
+  elapsed = time.perf_counter() - start
+  return machine._cpu.instruction_count / elapsed
+
+def main():
+  instructions = DEFAULT_INSTRUCTIONS
+  if len(sys.argv) > 1:
+    instructions = int(sys.argv[1])
+  print("interpreted: %.0f instructions/sec" % run(instructions))
+  print(" translated: %.0f instructions/sec" % run(instructions, True))
+
+if __name__ == '__main__':
+  main()
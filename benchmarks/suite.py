@@ -0,0 +1,303 @@
+#
+# Benchmark suite for the interpreter. It runs a set of workloads (the
+# bundled curses.z5, and synthetic stories exercising one subsystem
+# each) through a scripted, non-interactive user interface, and
+# reports the results as JSON, so that runs can be compared across
+# commits.
+#
+# Run it from the root directory of the distribution:
+#
+#     python -m benchmarks.suite [--translate] [--output FILE]
+#                                [--turns N] [workload ...]
+#
+# For each workload, the suite reports:
+#
+#   - the number of instructions executed, the wall time and the
+#     instructions per second;
+#   - the wall time of each turn, a turn being the execution between
+#     two requests for input;
+#   - the peak memory allocated by the interpreter, measured with
+#     tracemalloc in a second run;
+#   - the split of the execution time between instruction decoding,
+#     opcode dispatch and execution, string decoding and object
+#     access, measured with cProfile in a third run.
+#
+# The memory and profiling runs are much slower than the timed run, so
+# they are kept apart from it.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import argparse
+import cProfile
+import json
+import os.path
+import platform
+import pstats
+import subprocess
+import time
+import tracemalloc
+
+from zvm import zmachine, scriptedzui, zstoryimage
+from zvm.zcpu import ZCpuError, STOPPED_INPUT
+from zvm.zmemory import ZMemoryError
+from tests.storybuild import Assembler, Label, SP, glob, local, build_story
+
+DEFAULT_TURNS = 20
+
+STORIES_DIR = os.path.join(os.path.dirname(os.path.dirname(
+  os.path.abspath(__file__))), 'stories')
+
+# Commands typed into curses.z5, after the key press its title screen
+# waits for.
+CURSES_SCRIPT = ["", "look", "inventory", "examine map", "north",
+                 "south", "up", "look", "take all", "inventory"]
+
+# Profiler categories, by source file of the profiled function.
+# Compiled blocks of the translator count as dispatch.
+PROFILE_CATEGORIES = {
+  'zopdecoder.py': 'decode',
+  'decodetables.py': 'decode',
+  'ztranslator.py': 'decode',
+  'zcpu.py': 'dispatch',
+  'zstring.py': 'strings',
+  'zobjectparser.py': 'objects',
+  }
+
+
+class Workload(object):
+  """A story image, along with the script of input lines to feed it.
+  The story runs until the end of its script, or until the
+  interpreter stops on an unimplemented or illegal instruction, or on
+  an illegal memory access."""
+
+  def __init__(self, name, story, script):
+    self.name = name
+    self.story = story
+    self.script = script
+
+
+def _turn_loop(asm, iterations, emit_body):
+  """Assemble into ASM a main routine which runs the code emitted by
+  EMIT_BODY(asm) ITERATIONS times, then waits for a key press, and
+  starts over."""
+  asm.routine('main', 1)
+  asm.label('turn')
+  asm.op('store', 1, 0)
+  asm.label('loop')
+  emit_body(asm)
+  asm.op('inc_chk', 1, iterations, branch=('loop', False))
+  asm.op('read_char', 1, 0, 0, store=glob(10))
+  asm.op('jump', 'turn')
+
+def make_arithmetic_story():
+  """Return a story looping over arithmetic, branches and calls."""
+  def body(asm):
+    asm.op('add', glob(0), 1, store=glob(0))
+    asm.op('and', glob(0), 0xff, store=glob(1))
+    asm.op('jz', glob(1), branch=('skip', True))
+    asm.op('call_2s', Label('double'), glob(1), store=SP)
+    asm.op('div', SP, 3, store=glob(2))
+    asm.label('skip')
+    asm.op('mul', glob(1), 3, store=glob(3))
+    # A table of 256 words, ending where static memory starts.
+    asm.op('storew', 0x600, glob(1), glob(3))
+    asm.op('loadw', 0x600, 0, store=glob(4))
+  asm = Assembler(0x1100)
+  _turn_loop(asm, 500, body)
+  asm.routine('double', 1)
+  asm.op('add', local(1), local(1), store=glob(5))
+  asm.op('rtrue')
+  return build_story(asm)
+
+def make_strings_story():
+  """Return a story printing inline and packed strings."""
+  def body(asm):
+    asm.op('print', text="You are standing in an open field west of "
+                         "a white house. ")
+    asm.op('print_paddr', Label('description'))
+    asm.op('print_char', 62)
+  asm = Assembler(0x1100)
+  _turn_loop(asm, 50, body)
+  asm.string('description', "The house is a beautiful colonial house "
+             "which is painted white. It is clear that the owners must "
+             "have been extremely wealthy.\n")
+  return build_story(asm)
+
+def make_objects_story():
+  """Return a story moving objects around and reading and writing
+  their properties."""
+  objects = [
+    ("room", 0, 0, 3, [1], {5: b'\x00\x10', 10: b'\x01'}),
+    ("other room", 0, 0, 0, [], {5: b'\x00\x20'}),
+    ("lamp", 1, 4, 0, [2, 3], {5: b'\x00\x01', 7: b'\x00\x02'}),
+    ("box", 1, 0, 0, [], {5: b'\x00\x03', 7: b'\x00\x04'}),
+    ]
+  def body(asm):
+    asm.op('insert_obj', 3, 2)
+    asm.op('get_parent', 3, store=glob(0))
+    asm.op('get_prop', glob(0), 5, store=glob(1))
+    asm.op('insert_obj', 3, 1)
+    asm.op('get_child', 1, store=glob(2), branch=('has_child', True))
+    asm.label('has_child')
+    asm.op('get_prop', glob(2), 7, store=glob(3))
+    asm.op('put_prop', 4, 7, glob(1))
+  asm = Assembler(0x1100)
+  _turn_loop(asm, 200, body)
+  return build_story(asm, objects=objects)
+
+def make_workloads(turns=DEFAULT_TURNS):
+  """Return the list of all workloads. Synthetic stories run for
+  TURNS turns."""
+  script = [""] * turns
+  workloads = [
+    Workload('arithmetic', make_arithmetic_story(), script),
+    Workload('strings', make_strings_story(), script),
+    Workload('objects', make_objects_story(), script),
+    ]
+  curses_path = os.path.join(STORIES_DIR, 'curses.z5')
+  if os.path.isfile(curses_path):
+    workloads.insert(0, Workload('curses',
+                                 zstoryimage.load_story(curses_path),
+                                 CURSES_SCRIPT))
+  return workloads
+
+
+def _run(workload, translate, on_input=None):
+  """Run WORKLOAD to its end, and return the machine, along with a
+  description of what stopped it."""
+  ui = scriptedzui.create_zui(workload.script, keep_output=False,
+                              on_input=on_input)
+  machine = zmachine.ZMachine(workload.story, ui, translate=translate)
+  try:
+    if machine.run() == STOPPED_INPUT:
+      stopped_by = "end of script"
+    else:
+      stopped_by = "halt"
+  except (ZCpuError, ZMemoryError) as e:
+    # Report the failure with the workload's results, rather than
+    # stopping the whole suite.
+    instruction = machine._opdecoder.get_current_instruction()
+    opcode_class, opcode_number = instruction[:2]
+    handler = machine._cpu._dispatch[(opcode_class << 8) | opcode_number]
+    stopped_by = "%s in %s" % (e.__class__.__name__, handler.__name__)
+  return machine, stopped_by
+
+def time_workload(workload, translate=False):
+  """Run WORKLOAD, and return its timings as a dictionary."""
+  turn_marks = []
+  def on_input():
+    turn_marks.append(time.perf_counter())
+  start = time.perf_counter()
+  machine, stopped_by = _run(workload, translate, on_input)
+  end = time.perf_counter()
+
+  turn_times = []
+  previous = start
+  for mark in turn_marks:
+    turn_times.append(mark - previous)
+    previous = mark
+  instructions = machine._cpu.instruction_count
+  wall_time = end - start
+  return {
+    'stopped_by': stopped_by,
+    'instructions': instructions,
+    'wall_time': wall_time,
+    'instructions_per_sec': instructions / wall_time,
+    'turns': len(turn_times),
+    'turn_times': turn_times,
+    'mean_turn_time': sum(turn_times) / len(turn_times) if turn_times
+                      else None,
+    'max_turn_time': max(turn_times) if turn_times else None,
+    }
+
+def measure_peak_memory(workload, translate=False):
+  """Run WORKLOAD, and return the peak memory in bytes allocated by
+  Python while loading and running it."""
+  tracemalloc.start()
+  try:
+    _run(workload, translate)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def profile_workload(workload, translate=False):
+  """Run WORKLOAD under cProfile, and return the split of its
+  execution time between the PROFILE_CATEGORIES, as a dictionary
+  mapping categories to fractions of the total time."""
+  profiler = cProfile.Profile()
+  profiler.enable()
+  try:
+    _run(workload, translate)
+  finally:
+    profiler.disable()
+
+  totals = {'other': 0.0}
+  for category in PROFILE_CATEGORIES.values():
+    totals[category] = 0.0
+  stats = pstats.Stats(profiler).stats
+  for (filename, line, name), (cc, nc, tottime, cumtime,
+                               callers) in stats.items():
+    if filename.startswith('<ztranslator'):
+      category = 'dispatch'
+    else:
+      category = PROFILE_CATEGORIES.get(os.path.basename(filename),
+                                        'other')
+    totals[category] += tottime
+  total = sum(totals.values()) or 1.0
+  return dict((category, value / total)
+              for category, value in totals.items())
+
+def _git_revision():
+  """Return the current git revision of the tree, or None."""
+  try:
+    output = subprocess.check_output(
+      ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+      cwd=os.path.dirname(os.path.abspath(__file__)))
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return output.decode('ascii').strip()
+
+def run_suite(names=None, translate=False, turns=DEFAULT_TURNS):
+  """Run the workloads named in NAMES (all of them if None), and
+  return the results as a dictionary ready to be dumped as JSON."""
+  results = {}
+  for workload in make_workloads(turns):
+    if names and workload.name not in names:
+      continue
+    result = time_workload(workload, translate)
+    result['peak_memory'] = measure_peak_memory(workload, translate)
+    result['profile'] = profile_workload(workload, translate)
+    results[workload.name] = result
+  return {
+    'revision': _git_revision(),
+    'python': platform.python_version(),
+    'translate': translate,
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'workloads': results,
+    }
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Run the interpreter benchmarks, and print the "
+    "results as JSON.")
+  parser.add_argument('workloads', nargs='*',
+                      help="workloads to run (default: all)")
+  parser.add_argument('--translate', action='store_true',
+                      help="run the stories in translating mode")
+  parser.add_argument('--turns', type=int, default=DEFAULT_TURNS,
+                      help="number of turns of the synthetic stories")
+  parser.add_argument('--output', help="write the results to this file")
+  args = parser.parse_args()
+
+  results = run_suite(args.workloads, args.translate, args.turns)
+  text = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(text + "\n")
+  else:
+    print(text)
+
+if __name__ == '__main__':
+  main()
@@ -2,33 +2,55 @@
 
 import sys
 import os.path
-from zvm import zmachine, trivialzui
+from zvm import zmachine, trivialzui, zstoryimage, zstringtable
 
 def usage():
-    print("""Usage: %s <story file>
+    print("""Usage: %s [--debug | --no-debug] [--precompile-strings]
+          <story file>
 
 Run a Z-Machine story under ZVM.
+
+  --debug      Write a debug log to debug.log, and a disassembly of
+               the executed code to disasm.log.
+  --no-debug   Do not log anything (the default).
+  --precompile-strings
+               Decode the strings of the story before starting it, and
+               keep them in a file next to the story file for later
+               runs.
 """ % sys.argv[0])
     sys.exit(1)
 
 def main():
-    if len(sys.argv) != 2:
+    args = sys.argv[1:]
+    debugmode = False
+    precompile_strings = False
+    while args and args[0].startswith("--"):
+        option = args.pop(0)
+        if option == "--debug":
+            debugmode = True
+        elif option == "--no-debug":
+            debugmode = False
+        elif option == "--precompile-strings":
+            precompile_strings = True
+        else:
+            usage()
+    if len(args) != 1:
         usage()
-    story_file = sys.argv[1]
+    story_file = args[0]
     if not os.path.isfile(story_file):
         print("%s is not a file." % story_file)
         usage()
     try:
-        f = open(story_file, "rb")
-        story_image = f.read()
-        f.close()
-    except IOError:
+        story_image = zstoryimage.load_story(story_file)
+    except (IOError, zstoryimage.ZStoryImageError):
         print("Error accessing %s" % story_file)
         sys.exit(1)
+    if precompile_strings:
+        zstringtable.precompile(story_image, story_file)
 
     machine = zmachine.ZMachine(story_image,
                                 ui=trivialzui.create_zui(),
-                                debugmode=True)
+                                debugmode=debugmode)
     machine.run()
 
 if __name__ == '__main__':
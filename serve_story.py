@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import sys
+import os.path
+import asyncio
+from zvm import zserver, zstoryimage
+
+def usage():
+    print("""Usage: %s [--port PORT] [--max-sessions N]
+                    [--max-instructions N] <story file>
+
+Serve a Z-Machine story over TCP: each connection plays its own
+session of the story, one line of input at a time. The strings of the
+story are decoded up front, and kept in a file next to the story file.
+
+  --port PORT           Port to listen on (default: 8023).
+  --max-sessions N      Refuse connections beyond N sessions.
+  --max-instructions N  Stop sessions running over N instructions in
+                        a single turn.
+""" % sys.argv[0])
+    sys.exit(1)
+
+def main():
+    args = sys.argv[1:]
+    options = {'--port': 8023, '--max-sessions': None,
+               '--max-instructions': None}
+    while args and args[0].startswith("--"):
+        option = args.pop(0)
+        if option not in options or not args:
+            usage()
+        try:
+            options[option] = int(args.pop(0))
+        except ValueError:
+            usage()
+    if len(args) != 1:
+        usage()
+    story_file = args[0]
+    if not os.path.isfile(story_file):
+        print("%s is not a file." % story_file)
+        usage()
+    try:
+        manager = zserver.ZSessionManager(
+            story_file, max_sessions=options['--max-sessions'],
+            max_instructions_per_turn=options['--max-instructions'],
+            precompile_strings=True)
+    except (IOError, zstoryimage.ZStoryImageError):
+        print("Error accessing %s" % story_file)
+        sys.exit(1)
+
+    try:
+        asyncio.run(manager.serve('', options['--port']))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
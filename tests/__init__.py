@@ -5,4 +5,11 @@
 
 # All tests in the test suite.
 __all__ = ( "bitfield_tests", "zscii_tests", "lexer_tests",
-            "quetzal_tests", "glk_tests" )
+            "quetzal_tests", "glk_tests", "zcpu_tests",
+            "zopdecoder_tests", "decodetables_tests",
+            "scriptedzui_tests", "zmemory_tests",
+            "zstoryimage_tests", "zserver_tests",
+            "zsessionpool_tests", "zstring_tests",
+            "zstringtable_tests", "zobjectparser_tests",
+            "zundo_tests", "zcheckpoint_tests",
+            "zstackmanager_tests" )
@@ -0,0 +1,63 @@
+#
+# Unit tests for the decoding tables.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm.bitfield import BitField
+from zvm import decodetables
+from zvm.decodetables import OPCODE_0OP, OPCODE_1OP, OPCODE_2OP, OPCODE_VAR
+from zvm.decodetables import SMALL_CONSTANT, VARIABLE, LARGE_CONSTANT
+
+class DecodeTablesTests(TestCase):
+    def testOpcodeForms(self):
+        # Long form, 2OP:20 (add) with a variable and a small constant.
+        self.assertEqual(decodetables.OPCODE_FORMS[0x54],
+                         (OPCODE_2OP, 20, (VARIABLE, SMALL_CONSTANT)))
+        # Short forms: 1OP:12 (jump) with a large constant, and 0OP:0.
+        self.assertEqual(decodetables.OPCODE_FORMS[0x8C],
+                         (OPCODE_1OP, 12, (LARGE_CONSTANT,)))
+        self.assertEqual(decodetables.OPCODE_FORMS[0xB0],
+                         (OPCODE_0OP, 0, ()))
+        # Variable forms get their operand types from the next byte.
+        self.assertEqual(decodetables.OPCODE_FORMS[0xE0],
+                         (OPCODE_VAR, 0, None))
+        self.assertEqual(decodetables.OPCODE_FORMS[0xC1],
+                         (OPCODE_2OP, 1, None))
+
+    def testOperandTypesMatchBitField(self):
+        for byte in range(256):
+            bf = BitField(byte)
+            expected = []
+            for operand_type in [bf[6:8], bf[4:6], bf[2:4], bf[0:2]]:
+                if operand_type == decodetables.ABSENT:
+                    break
+                expected.append(operand_type)
+            self.assertEqual(decodetables.OPERAND_TYPES[byte],
+                             tuple(expected))
+
+    def testBranchBytes(self):
+        self.assertEqual(decodetables.BRANCH_BYTES[0xC5], (True, 5, True))
+        self.assertEqual(decodetables.BRANCH_BYTES[0x45], (False, 5, True))
+        self.assertEqual(decodetables.BRANCH_BYTES[0x81], (True, 256, False))
+        # Bit 5 is the sign bit of long offsets.
+        self.assertEqual(decodetables.BRANCH_BYTES[0x3F],
+                         (False, -256, False))
+
+    def testPropertySizes(self):
+        self.assertEqual(decodetables.PROPERTY_SIZES_V3[0x65], (5, 4))
+        self.assertEqual(decodetables.PROPERTY_SIZES_V4[0x05], (5, 1))
+        self.assertEqual(decodetables.PROPERTY_SIZES_V4[0x45], (5, 2))
+        self.assertEqual(decodetables.PROPERTY_SIZES_V4[0x85], (5, None))
+        self.assertEqual(decodetables.PROPERTY_LONG_SIZES[0x88], 8)
+        self.assertEqual(decodetables.PROPERTY_LONG_SIZES[0x80], 64)
+
+    def testSignedConversion(self):
+        for value in (0, 1, 0x7FFF, 0x8000, 0xFFFF):
+            signed = decodetables.to_signed(value)
+            self.assertEqual(decodetables.to_unsigned(signed), value)
+        self.assertEqual(decodetables.to_signed(0xFFFF), -1)
+        self.assertEqual(decodetables.to_signed(0x8000), -32768)
+        self.assertEqual(decodetables.to_unsigned(-2), 0xFFFE)
+        self.assertEqual(decodetables.to_unsigned(0x10005), 5)
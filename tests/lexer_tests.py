@@ -6,7 +6,9 @@
 #
 from unittest import TestCase
 from zvm.zmemory import ZMemory
-from zvm.zlexer import ZLexer
+from zvm.zlexer import ZLexer, ZTokenizer
+from zvm.zstoryimage import ZStoryImage
+from tests.storybuild import Assembler, build_story, encode_dictionary_word
 
 phrase1 = "the quick brown fox"
 phrase2 = "the quick, brown,;fox\t might,,be   fe;el.ing ;; odd, .today"
@@ -26,13 +28,12 @@ class ZLexerTests(TestCase):
            "lexer didn't parse all dictionary entries"
 
   def testTokenisation(self):
-    lexer = ZLexer(self.mem)
-    separators = (',', ';', '.')
+    tokenizer = ZTokenizer((',', ';', '.'))
 
-    tokens = lexer._tokenise_string(phrase1, separators)
+    tokens = tokenizer.words(phrase1)
     assert tokens == ['the', 'quick', 'brown', 'fox']
 
-    tokens = lexer._tokenise_string(phrase2, separators)
+    tokens = tokenizer.words(phrase2)
     assert tokens == ['the', 'quick', ',', 'brown', ',', ';', 'fox', \
                       'might', ',', ',', 'be', 'fe', ';', 'el', '.', 'ing', \
                       ';', ';', 'odd', ',', '.', 'today']
@@ -46,3 +47,66 @@ class ZLexerTests(TestCase):
                        ['bird', 30576], ['are', 0], ['odd', 36525], \
                        ['and', 29874], ['round', 38361], [',', 0], \
                        ['no', 36300]]
+
+def make_story():
+  """Return a story with a standard dictionary, and a custom
+  dictionary in dynamic memory at 0x700."""
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('rtrue')
+  story = bytearray(build_story(asm, dictionary=["lamp", "take"]))
+  custom = bytes([1, ord('-'), 9, 0, 1]) + encode_dictionary_word("box")
+  story[0x700:0x700 + len(custom) + 3] = custom + b'\0\0\0'
+  return bytes(story)
+
+class ZLexerDictionaryTests(TestCase):
+  def testStandardDictionaryIsShared(self):
+    image = ZStoryImage.from_bytes(make_story())
+    lexer1 = ZLexer(ZMemory(image))
+    lexer2 = ZLexer(ZMemory(image))
+    self.assertTrue(lexer1._get_dictionary(lexer1._dict_addr) is
+                    lexer2._get_dictionary(lexer2._dict_addr))
+    self.assertEqual(lexer2.parse_input("take lamp, now"),
+                     [['take', lexer2._dict['take']],
+                      ['lamp', lexer2._dict['lamp']], [',', 0],
+                      ['now', 0]])
+
+  def testCustomDictionaryIsReloadedAfterWrites(self):
+    mem = ZMemory(make_story())
+    lexer = ZLexer(mem)
+    entry = 0x700 + 5
+    self.assertEqual(lexer.parse_input("a box-box", 0x700),
+                     [['a', 0], ['box', entry], ['-', 0], ['box', entry]])
+    self.assertTrue(lexer._get_dictionary(0x700) is
+                    lexer._get_dictionary(0x700))
+    # Turn the separator into a comma.
+    mem[0x701] = ord(',')
+    self.assertEqual(lexer.parse_input("box,box", 0x700),
+                     [['box', entry], [',', 0], ['box', entry]])
+
+  def testUnsortedDictionary(self):
+    story = bytearray(make_story())
+    # -1 entries: a single entry, not sorted.
+    story[0x703:0x705] = b'\xff\xff'
+    lexer = ZLexer(ZMemory(bytes(story)))
+    self.assertEqual(lexer.parse_input("box", 0x700), [['box', 0x705]])
+
+class ZTokenizerTests(TestCase):
+  def testSeparatorsAreEscaped(self):
+    tokenizer = ZTokenizer([']', '-', '^', '\\'])
+    self.assertEqual(tokenizer.words("a]b-c^d\\e"),
+                     ['a', ']', 'b', '-', 'c', '^', 'd', '\\', 'e'])
+
+  def testPositions(self):
+    tokenizer = ZTokenizer([','])
+    self.assertEqual(tokenizer.tokenise("take  lamp,box"),
+                     [('take', 0, 4), ('lamp', 6, 4), (',', 10, 1),
+                      ('box', 11, 3)])
+
+  def testTokeniseInput(self):
+    lexer = ZLexer(ZMemory(make_story()))
+    self.assertEqual(lexer.tokenise_input(" lamp-box", 0x700),
+                     [(0, 4, 1), (0, 1, 5), (0x700 + 5, 3, 6)])
+    self.assertEqual(lexer.tokenise_input("take lamp"),
+                     [(lexer._dict['take'], 4, 0),
+                      (lexer._dict['lamp'], 4, 5)])
@@ -40,3 +40,50 @@ class QuetzalParserTest(TestCase):
       b'IFhd': 13,
     }
     self.assertEqual(savefile_metadata, expected_metadata)
+
+  def testRoundTrip(self):
+    "Writing back a loaded save-file reproduces it."
+    machine = make_zmachine()
+    quetzal.QuetzalParser(machine).load("stories/curses.save1")
+    with open("stories/curses.save1", "rb") as savefile:
+      self.assertEqual(quetzal.QuetzalWriter(machine).generate(),
+                       savefile.read())
+
+  def testCompressedMemory(self):
+    "Runs of unchanged bytes longer than 256 bytes are split."
+    machine = make_zmachine()
+    mem = machine._mem
+    mem[0x1000] = mem[0x1000] ^ 0x55
+    mem[0x1000 + 600] = mem[0x1000 + 600] ^ 0xAA
+    data = quetzal.QuetzalWriter(machine)._generate_cmem_chunk()[8:]
+    # 0x1000 unchanged bytes, then 599 of them.
+    self.assertEqual(data, b"\0\xff" * 16 + b"\x55"
+                     + b"\0\xff\0\xff\0\x56" + b"\xaa")
+    restored = make_zmachine()
+    quetzal.QuetzalParser(restored)._parse_cmem(data)
+    self.assertEqual(bytes(restored._mem[0x1000:0x1300]),
+                     bytes(mem[0x1000:0x1300]))
+
+  def testAnnotation(self):
+    machine = make_zmachine()
+    writer = quetzal.QuetzalWriter(machine, annotation="Checkpoint")
+    parser = quetzal.QuetzalParser(make_zmachine())
+    parser.load_data(writer.generate())
+    self.assertEqual(parser.get_last_loaded()["annotation"],
+                     b"Checkpoint")
+
+  def testCompressedMemoryOutOfBounds(self):
+    machine = make_zmachine()
+    memlen = machine._mem._dynamic_end + 1
+    data = b"\0\xff" * (memlen // 256) + b"\0" + bytes([memlen % 256]) \
+           + b"\x01"
+    self.assertRaises(quetzal.QuetzalMemoryOutOfBounds,
+                      quetzal.QuetzalParser(machine)._parse_cmem, data)
+
+  def testUncompressedMemory(self):
+    machine = make_zmachine()
+    mem = machine._mem
+    data = bytearray(mem[0:mem._dynamic_end + 1])
+    data[0x1000] ^= 0x55
+    quetzal.QuetzalParser(machine)._parse_umem(bytes(data))
+    self.assertEqual(bytes(mem[0:mem._dynamic_end + 1]), bytes(data))
@@ -0,0 +1,45 @@
+#
+# Unit tests for the scripted user interface.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmachine, scriptedzui
+from tests.storybuild import Assembler, build_story, glob
+
+class ScriptedZUITests(TestCase):
+  def testReadLine(self):
+    ui = scriptedzui.create_zui(["look", "north"])
+    self.assertEqual(ui.keyboard_input.read_line(), "look")
+    self.assertEqual(ui.keyboard_input.read_line(max_length=2), "no")
+    self.assertRaises(scriptedzui.ScriptedInputExhausted,
+                      ui.keyboard_input.read_line)
+
+  def testReadChar(self):
+    ui = scriptedzui.create_zui(["ab"])
+    chars = [ui.keyboard_input.read_char() for i in range(3)]
+    self.assertEqual(chars, [ord('a'), ord('b'), 13])
+    ui.keyboard_input.feed("c")
+    self.assertEqual(ui.keyboard_input.read_char(), ord('c'))
+
+  def testOnInputIsCalledBeforeReading(self):
+    calls = []
+    ui = scriptedzui.create_zui(["x"], on_input=lambda: calls.append(1))
+    ui.keyboard_input.read_line()
+    self.assertRaises(scriptedzui.ScriptedInputExhausted,
+                      ui.keyboard_input.read_char)
+    self.assertEqual(len(calls), 2)
+
+  def testStoryOutputIsCollected(self):
+    asm = Assembler(0x1100)
+    asm.routine('main')
+    asm.op('print', text="hello")
+    asm.op('read_char', 1, 0, 0, store=glob(0))
+    asm.op('rtrue')
+    ui = scriptedzui.create_zui(["z"])
+    machine = zmachine.ZMachine(build_story(asm), ui)
+    machine.run(max_instructions=4)
+    self.assertEqual(ui.screen.get_output(), "hello")
+    self.assertEqual(ui.screen.get_output(), "")
+    self.assertEqual(machine._mem.read_global(0x10), ord('z'))
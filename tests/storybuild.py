@@ -0,0 +1,386 @@
+#
+# A tiny assembler and story-file builder, used to produce small
+# synthetic version 5 stories for tests and benchmarks.
+#
+# Real story files like 'curses' exercise far more of the Z-Machine
+# than ZVM currently implements, so tests that want to run actual code
+# through the CPU build their own little stories with this module.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Opcode declarations for version 5, mapping opcode names (as used in
+# the op_* method names of ZCpu) to a tuple of the form
+#
+#     (opcode_class, opcode_number, stores_result, branches)
+#
+# opcode_class is one of the strings '0OP', '1OP', '2OP', 'VAR' or
+# 'EXT'.
+OPCODES = {
+  'je': ('2OP', 1, False, True),
+  'jl': ('2OP', 2, False, True),
+  'jg': ('2OP', 3, False, True),
+  'dec_chk': ('2OP', 4, False, True),
+  'inc_chk': ('2OP', 5, False, True),
+  'jin': ('2OP', 6, False, True),
+  'test': ('2OP', 7, False, True),
+  'or': ('2OP', 8, True, False),
+  'and': ('2OP', 9, True, False),
+  'test_attr': ('2OP', 10, False, True),
+  'set_attr': ('2OP', 11, False, False),
+  'clear_attr': ('2OP', 12, False, False),
+  'store': ('2OP', 13, False, False),
+  'insert_obj': ('2OP', 14, False, False),
+  'loadw': ('2OP', 15, True, False),
+  'loadb': ('2OP', 16, True, False),
+  'get_prop': ('2OP', 17, True, False),
+  'get_prop_addr': ('2OP', 18, True, False),
+  'get_next_prop': ('2OP', 19, True, False),
+  'add': ('2OP', 20, True, False),
+  'sub': ('2OP', 21, True, False),
+  'mul': ('2OP', 22, True, False),
+  'div': ('2OP', 23, True, False),
+  'mod': ('2OP', 24, True, False),
+  'call_2s': ('2OP', 25, True, False),
+  'call_2n': ('2OP', 26, False, False),
+  'jz': ('1OP', 0, False, True),
+  'get_sibling': ('1OP', 1, True, True),
+  'get_child': ('1OP', 2, True, True),
+  'get_parent': ('1OP', 3, True, False),
+  'get_prop_len': ('1OP', 4, True, False),
+  'inc': ('1OP', 5, False, False),
+  'dec': ('1OP', 6, False, False),
+  'print_addr': ('1OP', 7, False, False),
+  'call_1s': ('1OP', 8, True, False),
+  'remove_obj': ('1OP', 9, False, False),
+  'print_obj': ('1OP', 10, False, False),
+  'ret': ('1OP', 11, False, False),
+  'jump': ('1OP', 12, False, False),
+  'print_paddr': ('1OP', 13, False, False),
+  'load': ('1OP', 14, True, False),
+  'call_1n': ('1OP', 15, False, False),
+  'rtrue': ('0OP', 0, False, False),
+  'rfalse': ('0OP', 1, False, False),
+  'print': ('0OP', 2, False, False),
+  'print_ret': ('0OP', 3, False, False),
+  'nop': ('0OP', 4, False, False),
+  'restart': ('0OP', 7, False, False),
+  'ret_popped': ('0OP', 8, False, False),
+  'catch': ('0OP', 9, True, False),
+  'quit': ('0OP', 10, False, False),
+  'new_line': ('0OP', 11, False, False),
+  'call_vs': ('VAR', 0, True, False),
+  'storew': ('VAR', 1, False, False),
+  'storeb': ('VAR', 2, False, False),
+  'put_prop': ('VAR', 3, False, False),
+  'aread': ('VAR', 4, True, False),
+  'print_char': ('VAR', 5, False, False),
+  'print_num': ('VAR', 6, False, False),
+  'random': ('VAR', 7, True, False),
+  'push': ('VAR', 8, False, False),
+  'pull': ('VAR', 9, False, False),
+  'read_char': ('VAR', 22, True, False),
+  'not': ('VAR', 24, True, False),
+  'call_vn': ('VAR', 25, False, False),
+  'tokenise': ('VAR', 27, False, False),
+  'save_undo': ('EXT', 9, True, False),
+  'restore_undo': ('EXT', 10, True, False),
+  }
+
+# The default alphabets of a version 5 story, used to encode text.
+A0 = "abcdefghijklmnopqrstuvwxyz"
+A1 = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+A2 = "\n0123456789.,!?_#'\"/\\-:()"
+
+
+class Var(object):
+  """An operand which refers to a variable rather than a constant.
+  Variable 0 is the top of the stack, 1-15 are locals and 16-255 are
+  globals."""
+
+  def __init__(self, number):
+    self.number = number
+
+SP = Var(0)
+
+def local(n):
+  """Return the operand for local variable N (counting from 1)."""
+  return Var(n)
+
+def glob(n):
+  """Return the operand for global variable N (counting from 0)."""
+  return Var(0x10 + n)
+
+
+class Label(object):
+  """A reference to a named position in the assembled code. When used
+  as an operand, assembles to the packed address of the routine
+  starting at that label."""
+
+  def __init__(self, name):
+    self.name = name
+
+
+def encode_zchars(text):
+  """Encode TEXT into a list of z-characters using the default v5
+  alphabets."""
+  zchars = []
+  for char in text:
+    if char == ' ':
+      zchars.append(0)
+    elif char in A0:
+      zchars.append(6 + A0.index(char))
+    elif char in A1:
+      zchars += [4, 6 + A1.index(char)]
+    elif char in A2:
+      zchars += [5, 7 + A2.index(char)]
+    else:
+      code = ord(char)
+      zchars += [5, 6, code >> 5, code & 0x1f]
+  return zchars
+
+def pack_zchars(zchars):
+  """Pack a list of z-characters into the bytes of a z-string, padding
+  with 5s and setting the end-of-string bit on the last word."""
+  zchars = list(zchars)
+  while len(zchars) == 0 or len(zchars) % 3:
+    zchars.append(5)
+  result = bytearray()
+  for i in range(0, len(zchars), 3):
+    word = (zchars[i] << 10) | (zchars[i+1] << 5) | zchars[i+2]
+    if i + 3 == len(zchars):
+      word |= 0x8000
+    result += bytes([word >> 8, word & 0xff])
+  return bytes(result)
+
+def encode_zstring(text):
+  """Return the bytes of the z-string encoding TEXT."""
+  return pack_zchars(encode_zchars(text))
+
+def encode_dictionary_word(text):
+  """Return the 6-byte v5 dictionary encoding of TEXT."""
+  zchars = encode_zchars(text)[:9]
+  zchars += [5] * (9 - len(zchars))
+  return pack_zchars(zchars)
+
+
+class Assembler(object):
+  """A two-pass assembler for version 5 Z-code.
+
+  Instructions are appended with op(), routines are started with
+  routine(), and labels with label(). Branch targets and jump targets
+  are given as label names; routine operands are given as Label
+  objects, which assemble to packed routine addresses."""
+
+  def __init__(self, base):
+    self.base = base
+    self._items = []
+    self._labels = {}
+    self._size = 0
+
+  def _append(self, item, size):
+    self._items.append((self._size, item))
+    self._size += size
+
+  def label(self, name):
+    self._labels[name] = self.base + self._size
+
+  def routine(self, name, num_locals=0):
+    """Start a new routine, aligned so that it has a packed address."""
+    while (self.base + self._size) % 4:
+      self._append(('raw', b'\0'), 1)
+    self.label(name)
+    self._append(('raw', bytes([num_locals])), 1)
+
+  def string(self, name, text):
+    """Append the z-string TEXT, aligned so that it has a packed
+    address. Label objects named NAME assemble to that address."""
+    while (self.base + self._size) % 4:
+      self._append(('raw', b'\0'), 1)
+    self.label(name)
+    self.raw(encode_zstring(text))
+
+  def raw(self, data):
+    self._append(('raw', bytes(data)), len(data))
+
+  def op(self, name, *operands, store=None, branch=None, text=None):
+    """Append an instruction. STORE is the result variable (a Var),
+    BRANCH is a tuple (label_name_or_0_or_1, branch_on_true), and TEXT
+    is the inline text of print and print_ret."""
+    opclass, number, stores, branches = OPCODES[name]
+    assert stores == (store is not None), "store mismatch for %s" % name
+    assert branches == (branch is not None), "branch mismatch for %s" % name
+    encoded_text = encode_zstring(text) if text is not None else b''
+    size = len(self._encode(name, operands, store, branch, encoded_text,
+                            0, lambda label: 0))
+    self._append(('op', name, operands, store, branch, encoded_text), size)
+
+  def _operand_type(self, operand):
+    if isinstance(operand, Var):
+      return 2
+    elif isinstance(operand, (Label, str)) or not (0 <= operand <= 255):
+      return 0
+    return 1
+
+  def _encode(self, name, operands, store, branch, text, addr, resolve):
+    opclass, number, stores, branches = OPCODES[name]
+    types = [self._operand_type(o) for o in operands]
+    code = bytearray()
+
+    if opclass == '2OP' and len(operands) == 2 and 0 not in types:
+      code.append((types[0] - 1) << 6 | (types[1] - 1) << 5 | number)
+    elif opclass == '1OP':
+      code.append(0x80 | types[0] << 4 | number)
+    elif opclass == '0OP':
+      code.append(0xb0 | number)
+    else:
+      if opclass == 'EXT':
+        code += bytes([0xbe, number])
+      elif opclass == '2OP':
+        code.append(0xc0 | number)
+      else:
+        code.append(0xe0 | number)
+      types_byte = 0
+      for i in range(4):
+        types_byte = (types_byte << 2) | (types[i] if i < len(types) else 3)
+      code.append(types_byte)
+
+    for operand, operand_type in zip(operands, types):
+      if operand_type == 2:
+        code.append(operand.number)
+      elif operand_type == 1:
+        code.append(operand)
+      else:
+        if isinstance(operand, Label):
+          value = resolve(operand.name) // 4
+        elif isinstance(operand, str):
+          # Jump targets: relative to the address after the operand.
+          value = (resolve(operand) - (addr + len(code) + 2) + 2) & 0xffff
+        else:
+          value = operand & 0xffff
+        code += bytes([value >> 8, value & 0xff])
+
+    if stores:
+      code.append(store.number)
+
+    if branches:
+      target, on_true = branch
+      if target in (0, 1):
+        code.append((0x80 if on_true else 0) | 0x40 | target)
+      else:
+        offset = (resolve(target) - (addr + len(code) + 2) + 2) & 0x3fff
+        code += bytes([(0x80 if on_true else 0) | (offset >> 8),
+                       offset & 0xff])
+
+    return bytes(code + text)
+
+  def assemble(self):
+    """Return the assembled bytes."""
+    result = bytearray()
+    for offset, item in self._items:
+      if item[0] == 'raw':
+        result += item[1]
+      else:
+        name, operands, store, branch, text = item[1:]
+        result += self._encode(name, operands, store, branch, text,
+                               self.base + offset, self._labels.__getitem__)
+    return bytes(result)
+
+  def address(self, name):
+    return self._labels[name]
+
+
+# Layout of the synthetic story's dynamic memory.
+GLOBALS_ADDR = 0x40
+OBJECTS_ADDR = GLOBALS_ADDR + 480
+STATIC_BASE = 0x800
+HIGH_BASE = 0x1000
+
+def build_story(asm, entry='main', objects=(), dictionary=(),
+                separators=".,", release=1, serial=b"070101"):
+  """Build a version 5 story image around the code in ASM.
+
+  Execution starts at the routine labelled ENTRY, through a small
+  stub that calls it, stores its result in the last global variable
+  and then quits. OBJECTS is a sequence of tuples
+  (short_name, parent, sibling, child, attributes, properties) where
+  attributes is a list of attribute numbers and properties a dict
+  mapping property numbers to bytes. DICTIONARY is a sequence of
+  words for the story's standard dictionary."""
+
+  # Object table: property defaults, then the object entries, then
+  # the property tables.
+  objtable = bytearray(126)
+  proptables = bytearray()
+  proptable_addr = OBJECTS_ADDR + 126 + 14 * len(objects)
+  entries = bytearray()
+  for name, parent, sibling, child, attributes, properties in objects:
+    attrs = 0
+    for attr in attributes:
+      attrs |= 1 << (47 - attr)
+    entries += attrs.to_bytes(6, 'big')
+    addr = proptable_addr + len(proptables)
+    for value in (parent, sibling, child, addr):
+      entries += value.to_bytes(2, 'big')
+    encoded_name = encode_zstring(name) if name else b''
+    proptables.append(len(encoded_name) // 2)
+    proptables += encoded_name
+    for number in sorted(properties, reverse=True):
+      data = properties[number]
+      if len(data) <= 2:
+        proptables.append(number | (0x40 if len(data) == 2 else 0))
+      else:
+        proptables += bytes([0x80 | number, 0x80 | (len(data) & 0x3f)])
+      proptables += data
+    proptables.append(0)
+  objtable += entries + proptables
+  assert OBJECTS_ADDR + len(objtable) <= STATIC_BASE
+
+  # Static memory: the dictionary, the abbreviations table and an
+  # empty string for all the abbreviations to point to.
+  static = bytearray()
+  dict_addr = STATIC_BASE
+  words = sorted(set(dictionary))
+  static.append(len(separators))
+  static += separators.encode('ascii')
+  static.append(9)
+  static += len(words).to_bytes(2, 'big')
+  for word in words:
+    static += encode_dictionary_word(word) + b'\0\0\0'
+  while len(static) % 2:
+    static.append(0)
+  empty_string_addr = STATIC_BASE + len(static)
+  static += encode_zstring("")
+  abbrev_addr = STATIC_BASE + len(static)
+  static += ((empty_string_addr // 2).to_bytes(2, 'big')) * 96
+  assert STATIC_BASE + len(static) <= HIGH_BASE
+
+  # High memory: the startup stub, then the assembled code.
+  assert asm.base > HIGH_BASE + 16
+  stub = Assembler(HIGH_BASE)
+  stub.op('call_vs', Label(entry), store=glob(239))
+  stub.op('quit')
+  stub._labels[entry] = asm.address(entry)
+  code = stub.assemble()
+
+  image = bytearray(asm.base)
+  image[OBJECTS_ADDR:OBJECTS_ADDR + len(objtable)] = objtable
+  image[STATIC_BASE:STATIC_BASE + len(static)] = static
+  image[HIGH_BASE:HIGH_BASE + len(code)] = code
+  image = image[:asm.base] + asm.assemble()
+  while len(image) % 4:
+    image.append(0)
+
+  header = {
+    0x00: (5, 1), 0x02: (release, 2), 0x04: (HIGH_BASE, 2),
+    0x06: (HIGH_BASE, 2), 0x08: (dict_addr, 2), 0x0a: (OBJECTS_ADDR, 2),
+    0x0c: (GLOBALS_ADDR, 2), 0x0e: (STATIC_BASE, 2),
+    0x18: (abbrev_addr, 2), 0x1a: (len(image) // 4, 2),
+    }
+  for addr, (value, size) in header.items():
+    image[addr:addr + size] = value.to_bytes(size, 'big')
+  image[0x12:0x18] = serial
+  checksum = sum(image[0x40:]) % 0x10000
+  image[0x1c:0x1e] = checksum.to_bytes(2, 'big')
+  return bytes(image)
@@ -0,0 +1,111 @@
+#
+# Unit tests for the checkpoint logs of sessions.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from zvm import zcheckpoint, zserver
+from tests.zserver_tests import make_echo_story
+
+class ZCheckpointTests(TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = self.log_path(1)
+    self.story = make_echo_story()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def log_path(self, session_id):
+    return os.path.join(self.tempdir,
+                        "%d%s" % (session_id, zcheckpoint.FILE_SUFFIX))
+
+  def play(self, session, lines):
+    for line in lines:
+      session.feed(line)
+      session.run_turn()
+
+  def testRecoverSession(self):
+    session = zserver.ZSession(1, self.story, checkpoint_path=self.path)
+    session.run_turn()
+    base_size = session.checkpoint_log.size
+    self.play(session, ["abc", "def"])
+    self.assertEqual(session.checkpoint_log.turns, 2)
+    # Turn records only hold the pages written during the turn.
+    mem = session.machine._mem
+    self.assertTrue(session.checkpoint_log.size - base_size
+                    < mem._dynamic_end)
+
+    recovered = zserver.ZSession.recover(2, self.story, self.path)
+    self.assertEqual(bytes(recovered.machine._mem._memory),
+                     bytes(mem._memory))
+    for copy in (session, recovered):
+      copy.feed("xyz")
+      self.assertEqual(copy.run_turn(), "x")
+
+  def testDamagedRecordIsIgnored(self):
+    session = zserver.ZSession(1, self.story, checkpoint_path=self.path)
+    session.run_turn()
+    self.play(session, ["abc"])
+    memory = bytes(session.machine._mem._memory)
+    self.play(session, ["def"])
+    session.checkpoint_log.close()
+    with open(self.path, 'r+b') as f:
+      f.truncate(os.path.getsize(self.path) - 3)
+
+    recovered = zserver.ZSession.recover(2, self.story, self.path)
+    self.assertEqual(bytes(recovered.machine._mem._memory), memory)
+    self.assertEqual(zcheckpoint.read_log(self.path)[1], [])
+
+  def testCompaction(self):
+    session = zserver.ZSession(1, self.story, checkpoint_path=self.path)
+    session.checkpoint_log.compact_every = 2
+    session.run_turn()
+    self.play(session, ["a", "b", "c", "d"])
+    self.assertEqual(session.checkpoint_log.turns, 1)
+    self.assertEqual(len(zcheckpoint.read_log(self.path)[1]), 1)
+    recovered = zserver.ZSession.recover(2, self.story, self.path)
+    self.assertEqual(bytes(recovered.machine._mem._memory),
+                     bytes(session.machine._mem._memory))
+
+  def testManagerRecoversSessions(self):
+    manager = zserver.ZSessionManager(self.story,
+                                      checkpoint_dir=self.tempdir)
+    async def play():
+      first, output = await manager.create_session()
+      second, output = await manager.create_session()
+      await manager.send(first, "abc")
+      await manager.send(second, "quit")
+      return first, second
+    first, second = asyncio.run(play())
+    # Logs of finished sessions are removed.
+    self.assertEqual(os.listdir(self.tempdir),
+                     [os.path.basename(self.log_path(first))])
+
+    manager = zserver.ZSessionManager(self.story,
+                                      checkpoint_dir=self.tempdir)
+    self.assertEqual(manager.recover_sessions(), [first])
+    self.assertEqual(asyncio.run(manager.send(first, "def")), "d")
+    session_id, output = asyncio.run(manager.create_session())
+    self.assertEqual(session_id, first + 1)
+    manager.close_session(first)
+    self.assertFalse(os.path.exists(self.log_path(first)))
+
+  def testNewSessionsKeepLogsOfCrashedOnes(self):
+    session = zserver.ZSession(1, self.story, checkpoint_path=self.path)
+    session.run_turn()
+    self.play(session, ["abc"])
+    memory = bytes(session.machine._mem._memory)
+    # A new server starts a session before recovering the old ones.
+    manager = zserver.ZSessionManager(self.story,
+                                      checkpoint_dir=self.tempdir)
+    session_id, output = asyncio.run(manager.create_session())
+    self.assertEqual(session_id, 2)
+    self.assertEqual(manager.recover_sessions(), [1])
+    self.assertEqual(bytes(manager.sessions[1].machine._mem._memory),
+                     memory)
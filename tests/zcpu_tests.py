@@ -0,0 +1,211 @@
+#
+# Unit tests for the ZCpu class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmachine, trivialzui, zopdecoder, scriptedzui
+from zvm.zcpu import ZCpu, ZCpuIllegalInstruction
+from zvm.zcpu import STOPPED_INPUT, STOPPED_HALT
+from zvm.zmemory import ZMemoryIllegalWrite
+from tests.storybuild import Assembler, Label, SP, build_story, glob, local
+from tests.storybuild import STATIC_BASE
+
+def make_zmachine(asm):
+    return zmachine.ZMachine(build_story(asm), trivialzui.create_zui())
+
+def make_counter_story():
+    asm = Assembler(0x1100)
+    asm.routine('main')
+    asm.label('loop')
+    asm.op('add', glob(0), 1, store=glob(0))
+    asm.op('jump', 'loop')
+    return asm
+
+class ZCpuDispatchTests(TestCase):
+    def testDispatchTableIsVersionSpecific(self):
+        cpu = make_zmachine(make_counter_story())._cpu
+        # 1OP:15 is call_1n in v5, and not in earlier versions.
+        handler = cpu._dispatch[(zopdecoder.OPCODE_1OP << 8) | 15]
+        self.assertEqual(handler.__name__, "op_call_1n")
+        # 0OP:5 (save) is illegal as of v5.
+        handler = cpu._dispatch[(zopdecoder.OPCODE_0OP << 8) | 5]
+        self.assertRaises(ZCpuIllegalInstruction, handler)
+
+    def testDispatchTableHoldsBoundMethods(self):
+        cpu = make_zmachine(make_counter_story())._cpu
+        handler = cpu._dispatch[(zopdecoder.OPCODE_2OP << 8) | 20]
+        self.assertEqual(handler.__self__, cpu)
+        self.assertEqual(handler.__func__, ZCpu.op_add)
+
+    def testRunForLimitedInstructions(self):
+        machine = make_zmachine(make_counter_story())
+        # The startup stub calls main, then main alternates add/jump.
+        machine.run(max_instructions=21)
+        self.assertEqual(machine._cpu.instruction_count, 21)
+        self.assertEqual(machine._mem.read_global(0x10), 10)
+        machine.run(max_instructions=20)
+        self.assertEqual(machine._cpu.instruction_count, 41)
+        self.assertEqual(machine._mem.read_global(0x10), 20)
+
+class ZCpuTranslationTests(TestCase):
+    def make_story(self):
+        asm = Assembler(0x1100)
+        asm.routine('main', 1)
+        asm.label('loop')
+        asm.op('add', glob(0), 1, store=glob(0))
+        asm.op('call_2s', Label('triple'), glob(0), store=glob(1))
+        asm.op('inc', 1)
+        asm.op('jl', local(1), 50, branch=('loop', True))
+        asm.op('rtrue')
+        asm.routine('triple', 1)
+        asm.op('mul', local(1), 3, store=SP)
+        asm.op('add', SP, glob(2), store=glob(2))
+        asm.op('rtrue')
+        self.asm = asm
+        return build_story(asm)
+
+    def testTranslationMatchesInterpretation(self):
+        results = []
+        for translate in (False, True):
+            machine = zmachine.ZMachine(self.make_story(),
+                                        trivialzui.create_zui(),
+                                        translate=translate)
+            machine.run(max_instructions=200)
+            results.append((machine._cpu.instruction_count,
+                            machine._opdecoder.program_counter,
+                            bytes(machine._mem._memory)))
+        self.assertEqual(results[0], results[1])
+
+    def testHaltingBlocksAreCounted(self):
+        asm = Assembler(0x1100)
+        asm.routine('main')
+        asm.op('add', glob(0), 1, store=glob(0))
+        asm.op('add', glob(0), 1, store=glob(0))
+        asm.op('quit')
+        for translate in (False, True):
+            machine = zmachine.ZMachine(build_story(asm),
+                                        trivialzui.create_zui(),
+                                        translate=translate)
+            self.assertEqual(machine.run(), STOPPED_HALT)
+            # The startup stub's call, then the whole of main.
+            self.assertEqual(machine._cpu.instruction_count, 4)
+
+    def testBlocksAreCached(self):
+        machine = zmachine.ZMachine(self.make_story(),
+                                    trivialzui.create_zui(),
+                                    translate=True)
+        machine.run(max_instructions=200)
+        blocks = machine._cpu._translator.blocks
+        # The main loop is a block of 5 instructions, ending with the
+        # rtrue after the loop. Execution leaves it at the call, and
+        # comes back to the block starting after the call.
+        self.assertEqual(blocks[self.asm.address('loop')].length, 5)
+        self.assertEqual(blocks[self.asm.address('triple') + 1].length, 3)
+        self.assertEqual(len(blocks), 5)
+
+    def testDynamicMemoryIsNotTranslated(self):
+        machine = zmachine.ZMachine(self.make_story(),
+                                    trivialzui.create_zui(),
+                                    translate=True)
+        self.assertEqual(machine._cpu._translator.translate(0x700), None)
+
+class ZCpuArithmeticTests(TestCase):
+    def run_op(self, opcode, a, b):
+        asm = Assembler(0x1100)
+        asm.routine('main')
+        asm.op(opcode, a, b, store=glob(0))
+        asm.op('rtrue')
+        machine = make_zmachine(asm)
+        machine.run(max_instructions=2)
+        return machine._mem.read_global(0x10)
+
+    def testDivisionTruncatesTowardsZero(self):
+        self.assertEqual(self.run_op('div', 7, 2), 3)
+        self.assertEqual(self.run_op('div', 0xFFF9, 2), 0xFFFD)  # -7/2
+        self.assertEqual(self.run_op('div', 7, 0xFFFE), 0xFFFD)  # 7/-2
+
+    def testArithmeticWrapsAround(self):
+        self.assertEqual(self.run_op('mul', 300, 300), 90000 & 0xFFFF)
+        self.assertEqual(self.run_op('add', 0xFFFF, 2), 1)
+
+class ZCpuStoreTests(TestCase):
+    def run_store(self, opcode, address, translate, index=1):
+        asm = Assembler(0x1100)
+        asm.routine('main')
+        asm.op(opcode, address, index, 0x1234)
+        asm.op('quit')
+        machine = zmachine.ZMachine(build_story(asm),
+                                    trivialzui.create_zui(),
+                                    translate=translate)
+        machine.run()
+        return machine._mem
+
+    def testStoresToDynamicMemory(self):
+        for translate in (False, True):
+            mem = self.run_store('storew', 0x600, translate)
+            self.assertEqual(mem.read_word(0x602), 0x1234)
+            mem = self.run_store('storeb', 0x600, translate)
+            self.assertEqual(mem[0x601], 0x34)
+
+    def testStoresToTheHeaderFollowItsPermissions(self):
+        for translate in (False, True):
+            # Flags 2 may be set by the game, the version may not.
+            mem = self.run_store('storeb', 0x10, translate)
+            self.assertEqual(mem[0x11], 0x34)
+            for opcode in ('storew', 'storeb'):
+                self.assertRaises(ZMemoryIllegalWrite, self.run_store,
+                                  opcode, 0, translate, index=0)
+
+    def testStoresToStaticMemoryAreIllegal(self):
+        for translate in (False, True):
+            for opcode in ('storew', 'storeb'):
+                self.assertRaises(ZMemoryIllegalWrite, self.run_store,
+                                  opcode, STATIC_BASE, translate)
+
+class ZCpuInputTests(TestCase):
+    TEXT_BUFFER = 0x600
+    PARSE_BUFFER = 0x680
+
+    def make_machine(self, script):
+        asm = Assembler(0x1100)
+        asm.routine('main')
+        asm.op('storeb', self.TEXT_BUFFER, 0, 20)
+        asm.op('storeb', self.PARSE_BUFFER, 0, 4)
+        asm.op('aread', self.TEXT_BUFFER, self.PARSE_BUFFER, store=glob(0))
+        asm.op('rtrue')
+        ui = scriptedzui.create_zui(script)
+        return zmachine.ZMachine(build_story(asm, dictionary=["take",
+                                                              "lamp"]),
+                                 ui)
+
+    def testReadSuspendsUntilInputIsAvailable(self):
+        machine = self.make_machine([])
+        self.assertEqual(machine.run(), STOPPED_INPUT)
+        self.assertTrue(machine._cpu.waiting_for_input)
+        count = machine._cpu.instruction_count
+        self.assertEqual(machine.run(), STOPPED_INPUT)
+        self.assertEqual(machine._cpu.instruction_count, count)
+        machine._ui.keyboard_input.feed("Take lamp")
+        self.assertEqual(machine.run(), STOPPED_HALT)
+        self.assertFalse(machine._cpu.waiting_for_input)
+        self.assertEqual(machine._mem.read_global(0x10), 13)
+        self.assertEqual(machine.run(), STOPPED_HALT)
+
+    def testReadFillsTextAndParseBuffers(self):
+        machine = self.make_machine(["Take lamp, now"])
+        machine.run()
+        mem = machine._mem
+        text = self.TEXT_BUFFER
+        self.assertEqual(mem[text + 1], 14)
+        self.assertEqual(bytes(mem[text + 2:text + 16]), b"take lamp, now")
+        parse = self.PARSE_BUFFER
+        self.assertEqual(mem[parse + 1], 4)
+        entries = [(mem.read_word(parse + 2 + 4 * i), mem[parse + 4 + 4 * i],
+                    mem[parse + 5 + 4 * i]) for i in range(4)]
+        self.assertNotEqual(entries[0][0], 0)
+        self.assertNotEqual(entries[1][0], 0)
+        self.assertEqual([entry[1:] for entry in entries],
+                         [(4, 2), (4, 7), (1, 11), (3, 13)])
+        self.assertEqual(entries[3][0], 0)
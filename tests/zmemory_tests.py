@@ -0,0 +1,84 @@
+#
+# Unit tests for the ZMemory class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm.zmemory import ZMemory, ZMemoryIllegalWrite, ZMemoryOutOfBounds
+from tests.storybuild import Assembler, build_story, STATIC_BASE
+
+def make_memory():
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('rtrue')
+  return ZMemory(build_story(asm))
+
+class ZMemoryFastPathTests(TestCase):
+  def testFastWordAccess(self):
+    mem = make_memory()
+    mem.write_word_fast(0x700, 0xBEEF)
+    self.assertEqual(mem.read_word(0x700), 0xBEEF)
+    self.assertEqual(mem.read_word_fast(0x700), 0xBEEF)
+    self.assertEqual(mem.raw[0x700], 0xBE)
+    mem.write_byte_fast(0x702, 0x42)
+    self.assertEqual(mem[0x702], 0x42)
+
+  def testFastGlobalAccess(self):
+    mem = make_memory()
+    mem.write_global(0x12, 1234)
+    self.assertEqual(mem.read_global_fast(0x12), 1234)
+
+  def testFastWritesNotifyObservers(self):
+    mem = make_memory()
+    writes = []
+    mem.add_write_observer(lambda start, end: writes.append((start, end)))
+    mem.write_word_fast(0x700, 1)
+    self.assertEqual(writes, [(0x700, 0x702)])
+
+  def testRangeChecks(self):
+    mem = make_memory()
+    mem.check_writable(0x700, 0x710)
+    self.assertRaises(ZMemoryIllegalWrite, mem.check_writable, 0x10, 0x12)
+    self.assertRaises(ZMemoryIllegalWrite, mem.check_writable,
+                      STATIC_BASE - 1, STATIC_BASE + 1)
+    self.assertRaises(ZMemoryOutOfBounds, mem.check_readable,
+                      len(mem.raw) - 1, len(mem.raw) + 1)
+
+  def testStaticSnapshot(self):
+    mem = make_memory()
+    mem.snapshot_static()
+    mem.write_word_fast(0x700, 1)
+    mem.verify_static()
+    mem.write_word_fast(STATIC_BASE + 4, 1)
+    self.assertRaises(ZMemoryIllegalWrite, mem.verify_static)
+
+class ZMemoryDirtyPageTests(TestCase):
+  def testWritesMarkPages(self):
+    mem = make_memory()
+    mem.clear_dirty()
+    self.assertEqual(mem.dirty_pages(), [])
+    mem[0x700] = 1
+    mem.write_global(0x10, 1)
+    mem.write_word(0x5FF, 0xFFFF)
+    mem.game_set_header(0x10, 1)
+    self.assertEqual(mem.dirty_pages(), [0, 5, 6, 7])
+    self.assertTrue(mem.is_dirty(0x6F0, 0x710))
+    self.assertFalse(mem.is_dirty(0x100, 0x500))
+    mem.clear_dirty()
+    mem[0x300:0x420] = bytes(0x120)
+    mem.write_word_fast(0x6FF, 1)
+    self.assertEqual(mem.dirty_pages(), [3, 4, 6, 7])
+
+  def testExportDirtyPages(self):
+    story = make_memory().raw
+    mem = ZMemory(story, page_size=64)
+    self.assertEqual(mem.page_count, (len(story) + 63) // 64)
+    mem.clear_dirty()
+    mem[0x700:0x704] = b"abcd"
+    mem[0x741] = 0x65
+    exported = mem.export_dirty()
+    self.assertEqual([(addr, len(data)) for addr, data in exported],
+                     [(0x700, 128)])
+    self.assertEqual(exported[0][1][:4], b"abcd")
+    self.assertEqual(exported[0][1][0x41], 0x65)
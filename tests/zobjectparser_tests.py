@@ -0,0 +1,153 @@
+#
+# Unit tests for the object parser and its copy of the object table.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmemory, zobjectparser
+from zvm.zobjectparser import ZObjectParser
+from tests.storybuild import Assembler, build_story, OBJECTS_ADDR
+
+def make_parser():
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('rtrue')
+  objects = [
+    ("room", 0, 0, 2, [1], {5: b'\x00\x10', 10: b'\x01'}),
+    ("lamp", 1, 3, 0, [2, 47], {5: b'\x00\x01', 7: b'\x00\x02',
+                                20: b'abcd'}),
+    ("box", 1, 4, 0, [], {}),
+    ("key", 1, 0, 0, [], {}),
+    ("other room", 0, 0, 0, [], {}),
+    ]
+  mem = zmemory.ZMemory(build_story(asm, objects=objects))
+  return mem, ZObjectParser(mem)
+
+def children(parser, objectnum):
+  result = []
+  child = parser.get_child(objectnum)
+  while child:
+    result.append(child)
+    child = parser.get_sibling(child)
+  return result
+
+class ZObjectTreeTests(TestCase):
+  def testTreeIsRead(self):
+    mem, parser = make_parser()
+    self.assertEqual(parser.count_objects(), 5)
+    self.assertEqual(children(parser, 1), [2, 3, 4])
+    self.assertEqual(parser.get_parent(3), 1)
+    self.assertEqual(parser.get_all_attributes(2), [2, 47])
+    self.assertEqual(parser.get_shortname(5), "other room")
+
+  def testInsertObject(self):
+    mem, parser = make_parser()
+    # Move an object from the middle of its siblings.
+    parser.insert_object(5, 3)
+    self.assertEqual(children(parser, 1), [2, 4])
+    self.assertEqual(children(parser, 5), [3])
+    self.assertEqual(parser.get_parent(3), 5)
+    # Move the first child of its parent to the front again.
+    parser.insert_object(1, 2)
+    self.assertEqual(children(parser, 1), [2, 4])
+    # Memory agrees with the parser's copy of the tree.
+    fresh = ZObjectParser(mem)
+    for objectnum in range(1, 6):
+      self.assertEqual(children(fresh, objectnum),
+                       children(parser, objectnum))
+      self.assertEqual(fresh.get_parent(objectnum),
+                       parser.get_parent(objectnum))
+
+  def testAttributes(self):
+    mem, parser = make_parser()
+    parser.set_attribute(3, 10, True)
+    parser.set_attribute(2, 47, False)
+    self.assertEqual(parser.get_attribute(3, 10), 1)
+    self.assertEqual(parser.get_attribute(2, 47), 0)
+    self.assertEqual(ZObjectParser(mem).get_all_attributes(3), [10])
+
+  def testWritesToObjectTableAreSeen(self):
+    mem, parser = make_parser()
+    # Write the parent and sibling of object 4 as the game would,
+    # through storew, and its first attribute byte through storeb.
+    entry = OBJECTS_ADDR + 126 + 14 * 3
+    mem.write_word(entry + 6, 5)
+    mem.write_word(entry + 8, 2)
+    mem[entry] = 0x80
+    self.assertEqual(parser.get_parent(4), 5)
+    self.assertEqual(parser.get_sibling(4), 2)
+    self.assertEqual(parser.get_all_attributes(4), [0])
+    # Writing the whole table, like restoring a game does.
+    mem[entry:entry + 14] = bytes(12) + mem[entry + 12:entry + 14]
+    self.assertEqual(parser.get_parent(4), 0)
+    self.assertEqual(parser.get_attribute(4, 0), 0)
+
+
+class ZObjectAttributeTests(TestCase):
+  def testMasks(self):
+    mem, parser = make_parser()
+    self.assertEqual(parser.get_attributes_mask(2),
+                     parser.attribute_mask([2, 47]))
+    self.assertEqual(parser.attribute_mask([0, 47]), (1 << 47) | 1)
+    self.assertRaises(zobjectparser.ZObjectIllegalAttributeNumber,
+                      parser.attribute_mask, [48])
+
+  def testBulkQueries(self):
+    mem, parser = make_parser()
+    parser.set_attribute(4, 2, True)
+    for numpy in (zobjectparser.numpy, None):
+      saved, zobjectparser.numpy = zobjectparser.numpy, numpy
+      try:
+        self.assertEqual(parser.find_objects_with_attribute(2), [2, 4])
+        self.assertEqual(parser.find_objects_with_attribute(1), [1])
+        self.assertEqual(parser.find_objects_matching(
+            parser.attribute_mask([2]), parser.attribute_mask([47])), [4])
+        self.assertEqual(parser.find_objects_matching(0),
+                         [1, 2, 3, 4, 5])
+      finally:
+        zobjectparser.numpy = saved
+
+
+class ZObjectPropertyTests(TestCase):
+  def testGetProperties(self):
+    mem, parser = make_parser()
+    self.assertEqual(parser.get_prop(1, 5), 0x10)
+    self.assertEqual(parser.get_prop(1, 10), 1)
+    # Default values of missing properties.
+    self.assertEqual(parser.get_prop(3, 5), 0)
+    self.assertEqual(parser.get_prop_addr(3, 5), 0)
+    addr = parser.get_prop_addr(2, 20)
+    self.assertEqual(bytes(mem[addr:addr + 4]), b'abcd')
+    self.assertEqual(parser.get_prop_len(addr), 4)
+    self.assertEqual(parser.get_prop_len(parser.get_prop_addr(1, 10)), 1)
+    self.assertEqual(parser.get_prop_len(0), 0)
+
+  def testGetNextProp(self):
+    mem, parser = make_parser()
+    numbers = []
+    propnum = parser.get_next_prop(2, 0)
+    while propnum:
+      numbers.append(propnum)
+      propnum = parser.get_next_prop(2, propnum)
+    self.assertEqual(numbers, [20, 7, 5])
+    self.assertEqual(parser.get_next_prop(3, 0), 0)
+
+  def testPutProp(self):
+    mem, parser = make_parser()
+    parser.set_property(2, 7, 0x1234)
+    self.assertEqual(parser.get_prop(2, 7), 0x1234)
+    self.assertEqual(ZObjectParser(mem).get_prop(2, 7), 0x1234)
+
+  def testLayoutWritesDropTheIndex(self):
+    mem, parser = make_parser()
+    self.assertEqual(parser.get_prop(1, 10), 1)
+    # Renumber property 10 of the room to 11, through its size byte.
+    addr = parser.get_prop_addr(1, 10)
+    mem[addr - 1] = 11
+    self.assertEqual(parser.get_prop_addr(1, 10), 0)
+    self.assertEqual(parser.get_prop(1, 11), 1)
+    # Point the room to the property table of the lamp.
+    entry = OBJECTS_ADDR + 126
+    mem.write_word(entry + 12, mem.read_word(entry + 14 + 12))
+    self.assertEqual(parser.get_prop(1, 7), 2)
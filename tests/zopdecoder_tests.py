@@ -0,0 +1,109 @@
+#
+# Unit tests for the ZOpDecoder class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm.zmemory import ZMemory
+from zvm.zstackmanager import ZStackManager
+from zvm import zopdecoder
+from tests.storybuild import Assembler, build_story, glob
+
+def make_decoder():
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.label('loop')
+  asm.op('add', glob(0), 300, store=glob(1))
+  asm.op('je', glob(1), 5, branch=('loop', False))
+  asm.op('print', text="hello")
+  asm.op('rtrue')
+  mem = ZMemory(build_story(asm))
+  decoder = zopdecoder.ZOpDecoder(mem, ZStackManager(mem))
+  decoder.program_counter = asm.address('loop')
+  return mem, decoder
+
+class ZOpDecoderTests(TestCase):
+  def testDecodeStaticShape(self):
+    mem, decoder = make_decoder()
+    pc = decoder.program_counter
+    (opclass, opnum, operands, types, store, branch,
+     text, next_pc) = decoder.decode_instruction(pc)
+    self.assertEqual((opclass, opnum), (zopdecoder.OPCODE_2OP, 20))
+    self.assertEqual(operands, (0x10, 300))
+    self.assertEqual(types, (zopdecoder.VARIABLE,
+                             zopdecoder.LARGE_CONSTANT))
+    self.assertEqual(store, 0x11)
+    self.assertEqual(branch, None)
+    self.assertEqual(next_pc, pc + 6)
+
+    (opclass, opnum, operands, types, store, branch,
+     text, next_pc) = decoder.decode_instruction(next_pc)
+    self.assertEqual((opclass, opnum), (zopdecoder.OPCODE_2OP, 1))
+    self.assertEqual(store, None)
+    # Branch offsets are relative to the end of the instruction, minus 2.
+    self.assertEqual(branch, (False, pc - next_pc + 2))
+
+  def testExecutionReadsVariableOperands(self):
+    mem, decoder = make_decoder()
+    pc = decoder.program_counter
+    mem.write_global(0x10, 7)
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_2OP, 20, [7, 300]))
+    self.assertEqual(decoder.get_store_address(), 0x11)
+    mem.write_global(0x10, 9)
+    decoder.program_counter = pc
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_2OP, 20, [9, 300]))
+    self.assertEqual(list(decoder._decode_cache), [pc])
+
+  def testCurrentInstructionCanBeRestored(self):
+    mem, decoder = make_decoder()
+    decoder.get_next_instruction()
+    current = decoder.get_current_instruction()
+    decoder.get_next_instruction()
+    decoder.set_current_instruction(current)
+    self.assertEqual(decoder.get_store_address(), 0x11)
+
+  def testProgramCounterSkipsInlineText(self):
+    mem, decoder = make_decoder()
+    decoder.get_next_instruction()
+    decoder.get_next_instruction()
+    text_pc = decoder.program_counter
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_0OP, 2, []))
+    self.assertEqual(decoder.get_zstring(), text_pc + 1)
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_0OP, 0, []))
+
+  def testDynamicMemoryCodeIsInvalidated(self):
+    mem, decoder = make_decoder()
+    # Assemble 'add 1 2 -> g0' into a free spot of dynamic memory.
+    mem[0x700:0x704] = bytes([0x14, 1, 2, 0x10])
+    decoder.program_counter = 0x700
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_2OP, 20, [1, 2]))
+    # Turn it into 'sub 1 3 -> g0'.
+    mem[0x700] = 0x15
+    mem.write_word(0x701, 0x0103)
+    decoder.program_counter = 0x700
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_2OP, 21, [1, 3]))
+
+  def testInstructionsAcrossPagesAreInvalidated(self):
+    mem, decoder = make_decoder()
+    # 'add 1 2 -> g0', straddling the pages at 0x600 and 0x700.
+    mem[0x6FE:0x702] = bytes([0x14, 1, 2, 0x10])
+    decoder.program_counter = 0x6FE
+    decoder.get_next_instruction()
+    self.assertIn(0x6FE, decoder._decode_cache)
+    # Writes to other bytes of the pages keep it.
+    mem[0x6F0] = 0
+    mem[0x710] = 0
+    self.assertIn(0x6FE, decoder._decode_cache)
+    mem[0x700] = 3
+    self.assertNotIn(0x6FE, decoder._decode_cache)
+    self.assertEqual(decoder._dynamic_pages, {})
+    decoder.program_counter = 0x6FE
+    self.assertEqual(decoder.get_next_instruction(),
+                     (zopdecoder.OPCODE_2OP, 20, [1, 3]))
@@ -0,0 +1,106 @@
+#
+# Unit tests for the multi-session server.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import asyncio
+from unittest import TestCase
+from zvm import zserver
+from tests.storybuild import Assembler, build_story, glob
+
+TEXT_BUFFER = 0x600
+PARSE_BUFFER = 0x680
+
+def make_echo_story():
+  """Return a story which reads lines, and prints the first character
+  of each, until it reads a line starting with 'q'."""
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('storeb', TEXT_BUFFER, 0, 40)
+  asm.op('storeb', PARSE_BUFFER, 0, 8)
+  asm.op('print', text="ready")
+  asm.label('turn')
+  asm.op('aread', TEXT_BUFFER, PARSE_BUFFER, store=glob(0))
+  asm.op('loadb', TEXT_BUFFER, 2, store=glob(1))
+  asm.op('je', glob(1), ord('q'), branch=('quit', True))
+  asm.op('print_char', glob(1))
+  asm.op('jump', 'turn')
+  asm.label('quit')
+  asm.op('rtrue')
+  return build_story(asm, dictionary=["quit"])
+
+def make_runaway_story():
+  """Return a story which loops forever without reading input."""
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.label('loop')
+  asm.op('add', glob(0), 1, store=glob(0))
+  asm.op('jump', 'loop')
+  return build_story(asm)
+
+def run(coroutine):
+  return asyncio.run(coroutine)
+
+class ZServerTests(TestCase):
+  def testSessionsSuspendAndResume(self):
+    manager = zserver.ZSessionManager(make_echo_story(),
+                                      slice_instructions=3)
+    async def play():
+      first, output1 = await manager.create_session()
+      second, output2 = await manager.create_session()
+      self.assertEqual((output1, output2), ("ready", "ready"))
+      self.assertEqual(manager.sessions[first].state,
+                       zserver.SESSION_WAITING)
+      replies = await asyncio.gather(manager.send(first, "xyzzy"),
+                                     manager.send(second, "plugh"))
+      self.assertEqual(replies, ["x", "p"])
+      self.assertEqual(await manager.send(first, "abc"), "a")
+      await manager.send(first, "quit")
+      self.assertTrue(manager.sessions[first].finished)
+      self.assertFalse(manager.sessions[second].finished)
+      with self.assertRaises(zserver.ZSessionFinished):
+        await manager.send(first, "more")
+    run(play())
+
+  def testInstructionLimitStopsRunawaySessions(self):
+    manager = zserver.ZSessionManager(make_runaway_story(),
+                                      max_instructions_per_turn=1000)
+    session_id, output = run(manager.create_session())
+    session = manager.sessions[session_id]
+    self.assertTrue(session.finished)
+    self.assertEqual(session.stop_reason, "instruction limit")
+    self.assertEqual(session.machine.instruction_count, 1000)
+
+  def testSnapshotRestoresWaitingSession(self):
+    story = make_echo_story()
+    session = zserver.ZSession(1, story)
+    session.run_turn()
+    session.feed("abc")
+    self.assertEqual(session.run_turn(), "a")
+    snapshot = session.snapshot()
+    restored = zserver.ZSession.from_snapshot(2, story, snapshot)
+    for copy in (session, restored):
+      copy.feed("xyz")
+      self.assertEqual(copy.run_turn(), "x")
+    self.assertEqual(bytes(session.machine._mem._memory),
+                     bytes(restored.machine._mem._memory))
+
+  def testStoryContentsAreShared(self):
+    manager = zserver.ZSessionManager(make_echo_story(),
+                                      precompile_strings=True)
+    first, output = run(manager.create_session())
+    second, output = run(manager.create_session())
+    self.assertEqual(output, "ready")
+    self.assertTrue(manager.sessions[first].machine._mem.image is
+                    manager.sessions[second].machine._mem.image)
+
+  def testMaxSessions(self):
+    manager = zserver.ZSessionManager(make_echo_story(), max_sessions=1)
+    session_id, output = run(manager.create_session())
+    self.assertRaises(zserver.ZTooManySessions, run,
+                      manager.create_session())
+    manager.close_session(session_id)
+    self.assertRaises(zserver.ZNoSuchSession, manager.close_session,
+                      session_id)
+    run(manager.create_session())
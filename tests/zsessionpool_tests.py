@@ -0,0 +1,95 @@
+#
+# Unit tests for the pool of session worker processes.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import threading
+from unittest import TestCase
+from zvm import zsessionpool
+from tests.zserver_tests import make_echo_story, make_runaway_story
+
+class ZSessionPoolTests(TestCase):
+  def setUp(self):
+    self.pool = None
+
+  def tearDown(self):
+    if self.pool is not None:
+      self.pool.close()
+
+  def testSessionsAreShardedAndPlayed(self):
+    self.pool = zsessionpool.ZSessionPool(make_echo_story(), num_workers=2)
+    sessions = [self.pool.create_session() for i in range(6)]
+    for session_id, future in sessions:
+      self.assertEqual(future.result(), "ready")
+    workers = set(self.pool.worker_of(session_id)
+                  for session_id, future in sessions)
+    self.assertEqual(workers, set([0, 1]))
+    replies = [self.pool.send(session_id, "word %d" % session_id)
+               for session_id, future in sessions]
+    self.assertEqual([reply.result() for reply in replies], ["w"] * 6)
+    stats = self.pool.stats()
+    self.assertEqual(sum(worker['sessions'] for worker in stats), 6)
+    self.assertEqual([worker['queue_depth'] for worker in stats], [0, 0])
+    self.assertTrue(all(worker['instructions'] > 0 for worker in stats))
+
+  def testMigration(self):
+    self.pool = zsessionpool.ZSessionPool(make_echo_story(), num_workers=2)
+    session_id, future = self.pool.create_session()
+    future.result()
+    self.assertEqual(self.pool.send(session_id, "abc").result(), "a")
+    source = self.pool.worker_of(session_id)
+    self.pool.migrate(session_id, 1 - source)
+    self.assertEqual(self.pool.worker_of(session_id), 1 - source)
+    self.assertEqual(self.pool.send(session_id, "xyz").result(), "x")
+    self.assertEqual(self.pool.stats()[source]['sessions'], 0)
+
+  def testRebalanceMovesBusySessions(self):
+    self.pool = zsessionpool.ZSessionPool(make_echo_story(), num_workers=2)
+    # Sessions 1 and 3 land on the same worker.
+    self.assertEqual(self.pool._shard(1), self.pool._shard(3))
+    for session_id in (1, 3):
+      self.pool.create_session(session_id)[1].result()
+    worker = self.pool.worker_of(1)
+    self.assertEqual(self.pool.rebalance(), 1)
+    self.assertNotEqual(self.pool.worker_of(1), self.pool.worker_of(3))
+    self.assertEqual(self.pool.rebalance(), 0)
+
+  def testBackpressure(self):
+    self.pool = zsessionpool.ZSessionPool(make_runaway_story(),
+                                          num_workers=1, max_queue_depth=1,
+                                          submit_timeout=0,
+                                          max_instructions_per_turn=200000)
+    session_id, future = self.pool.create_session()
+    self.assertRaises(zsessionpool.ZPoolBusy, self.pool.create_session)
+    self.assertEqual(self.pool.stats()[0]['queue_depth'], 1)
+    future.result()
+    self.assertEqual(self.pool.stats()[0]['queue_depth'], 0)
+
+  def testBusyWorkerOnlyHoldsUpItsSessions(self):
+    self.pool = zsessionpool.ZSessionPool(make_echo_story(), num_workers=2,
+                                          max_queue_depth=1)
+    other = [session_id for session_id in range(2, 10)
+             if self.pool._shard(session_id) != self.pool._shard(1)][0]
+    # Fill the queue of the worker of session 1.
+    busy = self.pool._shard(1)
+    busy.slots.acquire()
+    waiting = threading.Thread(target=self.pool.create_session, args=(1,))
+    waiting.start()
+    try:
+      self.pool.create_session(other)[1].result()
+      self.assertTrue(waiting.is_alive())
+    finally:
+      busy.slots.release()
+      waiting.join()
+    self.assertEqual(self.pool.send(1, "abc").result(), "a")
+
+  def testRequestsForMovingSessionsAreRejected(self):
+    self.pool = zsessionpool.ZSessionPool(make_echo_story(), num_workers=2)
+    session_id, future = self.pool.create_session()
+    future.result()
+    self.pool._moving.add(session_id)
+    self.assertRaises(zsessionpool.ZPoolSessionMoving, self.pool.send,
+                      session_id, "abc")
+    self.pool._moving.discard(session_id)
+    self.assertEqual(self.pool.send(session_id, "abc").result(), "a")
@@ -0,0 +1,60 @@
+#
+# Unit tests for the stack manager.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zstoryimage
+from zvm.zmemory import ZMemory
+from zvm.zstackmanager import ZStackManager, ZStackNoSuchVariable
+from tests.storybuild import Assembler, build_story
+
+def make_story():
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('rtrue')
+  asm.routine('three', 3)
+  asm.op('rtrue')
+  return asm, zstoryimage.ZStoryImage.from_bytes(build_story(asm))
+
+class ZStackManagerTests(TestCase):
+  def testCallsAndReturns(self):
+    asm, image = make_story()
+    stack = ZStackManager(ZMemory(image))
+    routine = asm.address('three')
+    self.assertEqual(stack.start_routine(routine, 0x10, 0x2000, [5, 6]),
+                     routine + 1)
+    self.assertEqual([stack.get_local_variable(i) for i in range(3)],
+                     [5, 6, 0])
+    self.assertRaises(ZStackNoSuchVariable, stack.get_local_variable, 3)
+    stack.push_stack(7)
+    # Extra arguments are dropped.
+    stack.start_routine(routine, 2, 0x3000, [1, 2, 3, 4])
+    self.assertEqual(stack.get_frames()[2][2:4], (3, [1, 2, 3]))
+    self.assertEqual(stack.finish_routine(9), 0x3000)
+    self.assertEqual(stack.get_local_variable(1), 9)
+    self.assertEqual(stack.pop_stack(), 7)
+    self.assertEqual(stack.get_stack_frame_index(), 1)
+
+  def testRoutineHeadersAreShared(self):
+    asm, image = make_story()
+    routine = asm.address('three')
+    ZStackManager(ZMemory(image)).start_routine(routine, None, 0, [])
+    self.assertEqual(image.routines[routine], (3, (0, 0, 0), routine + 1))
+    # Other machines running the story use the parsed header.
+    image.routines[routine] = (1, (42,), routine + 1)
+    stack = ZStackManager(ZMemory(image))
+    stack.start_routine(routine, None, 0, [])
+    self.assertEqual(stack.get_local_variable(0), 42)
+
+  def testRoutinesInDynamicMemoryAreNotCached(self):
+    asm, image = make_story()
+    mem = ZMemory(image)
+    stack = ZStackManager(mem)
+    mem[0x700] = 2
+    stack.start_routine(0x700, None, 0, [])
+    mem[0x700] = 1
+    self.assertEqual(stack.start_routine(0x700, None, 0, [8]), 0x701)
+    self.assertRaises(ZStackNoSuchVariable, stack.get_local_variable, 1)
+    self.assertEqual(image.routines, {})
@@ -0,0 +1,67 @@
+#
+# Unit tests for the ZStoryImage class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+from zvm import zmachine, trivialzui, zstoryimage
+from zvm.zmemory import ZMemory
+from tests.storybuild import Assembler, build_story
+
+def make_story():
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('rtrue')
+  return build_story(asm)
+
+class ZStoryImageTests(TestCase):
+  def testMemoriesArePrivate(self):
+    story = make_story()
+    image = zstoryimage.ZStoryImage.from_bytes(story)
+    mem1 = ZMemory(image)
+    mem2 = ZMemory(image)
+    mem1[0x700] = 42
+    self.assertEqual(mem1[0x700], 42)
+    self.assertEqual(mem2[0x700], story[0x700])
+    self.assertEqual(image[0x700], story[0x700])
+    self.assertEqual(bytes(mem2.raw), bytes(story))
+
+  def testLoadStoryIsShared(self):
+    story = make_story()
+    fd, path = tempfile.mkstemp(suffix='.z5')
+    try:
+      os.write(fd, story)
+      os.close(fd)
+      image = zstoryimage.load_story(path)
+      self.assertTrue(zstoryimage.load_story(path) is image)
+      mem = ZMemory(image)
+      mem[0x700:0x702] = [1, 2]
+      self.assertEqual(mem.read_word(0x700), 0x0102)
+      self.assertEqual(image[0x700:0x702], story[0x700:0x702])
+      with open(path, 'rb') as f:
+        self.assertEqual(f.read(), bytes(story))
+    finally:
+      os.remove(path)
+
+  def testTooSmall(self):
+    self.assertRaises(zstoryimage.ZStoryImageTooSmall,
+                      zstoryimage.ZStoryImage.from_bytes, b"\x05" * 10)
+
+  @skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc/self/fd")
+  def testNoFileDescriptorsLeak(self):
+    story = make_story()
+    count = len(os.listdir('/proc/self/fd'))
+    machines = [zmachine.ZMachine(story, trivialzui.create_zui())
+                for i in range(10)]
+    self.assertEqual(len(os.listdir('/proc/self/fd')), count)
+    image = zstoryimage.ZStoryImage.from_bytes(story)
+    mem = ZMemory(image)
+    image.close()
+    # Memories outlive the image, until they are dropped.
+    mem[0x700] = 1
+    self.assertEqual(mem.read_word(0x6FF), story[0x6FF] << 8 | 1)
+    del mem
+    self.assertEqual(len(os.listdir('/proc/self/fd')), count)
@@ -0,0 +1,82 @@
+#
+# Unit tests for the string factory and its cache.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmemory, zstring
+from tests.storybuild import Assembler, build_story
+
+def make_zmemory():
+    asm = Assembler(0x1100)
+    asm.routine('main')
+    asm.op('rtrue')
+    asm.string('hello', "Hello, sailor!")
+    asm.string('bye', "Goodbye.")
+    objects = [("lamp", 0, 0, 0, [], {}), ("box", 0, 0, 0, [], {})]
+    return zmemory.ZMemory(build_story(asm, objects=objects)), asm
+
+class ZStringFactoryCacheTests(TestCase):
+    def testHitsAndMisses(self):
+        mem, asm = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        for i in range(3):
+            self.assertEqual(factory.get(asm.address('hello')),
+                             "Hello, sailor!")
+        self.assertEqual((factory.cache_hits, factory.cache_misses), (2, 1))
+        factory.clear_cache()
+        self.assertEqual((factory.cache_hits, factory.cache_misses), (0, 0))
+
+    def testLeastRecentlyUsedStringsAreEvicted(self):
+        mem, asm = make_zmemory()
+        factory = zstring.ZStringFactory(mem, cache_size=1)
+        factory.get(asm.address('hello'))
+        factory.get(asm.address('bye'))
+        factory.get(asm.address('hello'))
+        self.assertEqual((factory.cache_hits, factory.cache_misses), (0, 3))
+
+    def testDynamicStringsAreInvalidatedOnWrite(self):
+        mem, asm = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        # The short name of the first object follows its length byte.
+        objects = mem.read_word(0x0a) + 126
+        name_addr = mem.read_word(objects + 12) + 1
+        self.assertEqual(factory.get(name_addr), "lamp")
+        # Writes elsewhere keep the string cached.
+        mem.write_global(0x10, 42)
+        self.assertEqual(factory.get(name_addr), "lamp")
+        self.assertEqual(factory.cache_hits, 1)
+        # Turn "lamp" into "lame".
+        word = mem.read_word(name_addr + 2)
+        mem.write_word(name_addr + 2, (word & ~(0x1f << 10)) | (10 << 10))
+        self.assertEqual(factory.get(name_addr), "lame")
+        self.assertEqual(factory.cache_misses, 2)
+
+    def testGetMany(self):
+        mem, asm = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        addresses = [asm.address('hello'), asm.address('bye')]
+        self.assertEqual(factory.get_many(addresses, cache=False),
+                         ["Hello, sailor!", "Goodbye."])
+        self.assertEqual(factory.cache_misses, 0)
+        factory.get_many(addresses)
+        self.assertEqual(factory.get_many(addresses),
+                         ["Hello, sailor!", "Goodbye."])
+        self.assertEqual(factory.cache_hits, 2)
+
+class ZCharTranslatorTests(TestCase):
+    def testShiftsAndEscapes(self):
+        mem, asm = make_zmemory()
+        z = zstring.ZCharTranslator(mem)
+        # 'T' shifted to A1, '!' shifted to A2, then an A2/6 escape
+        # for ZSCII 64 ('@'), after which the alphabet is back to A0.
+        zchars = [4, 25, 10, 5, 20, 5, 6, 2, 0, 6]
+        self.assertEqual(z.get(zchars), [ord(c) for c in "Te!@a"])
+
+    def testAbbreviationsAreRejectedWhenNotAllowed(self):
+        mem, asm = make_zmemory()
+        z = zstring.ZCharTranslator(mem)
+        self.assertEqual(z.get([1, 0, 6]), [ord('a')])
+        self.assertRaises(zstring.ZStringIllegalAbbrevInString,
+                          z.get, [1, 0], False)
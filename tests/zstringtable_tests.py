@@ -0,0 +1,82 @@
+#
+# Unit tests for the precompiled string tables.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from zvm import zstoryimage, zstringtable
+from zvm.zmachine import ZMachine
+from zvm.zmemory import ZMemory
+from zvm import scriptedzui
+from tests.storybuild import Assembler, Label, glob, build_story
+
+def make_story(serial=b"070101"):
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('print', text="Welcome. ")
+  asm.op('jz', glob(0), branch=('skip', False))
+  asm.op('call_1n', Label('helper'))
+  asm.label('skip')
+  asm.op('print_paddr', Label('farewell'))
+  asm.op('rtrue')
+  asm.routine('helper')
+  asm.op('print_ret', text="Helping.")
+  asm.routine('unreachable')
+  asm.op('print', text="Never found.")
+  asm.op('rtrue')
+  asm.string('farewell', "Goodbye.")
+  asm.string('described', "A shiny lamp.")
+  description = (asm.address('described') // 4).to_bytes(2, 'big')
+  objects = [("lamp", 0, 0, 0, [], {7: description})]
+  return asm, build_story(asm, objects=objects, serial=serial)
+
+class ZStringTableTests(TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testScanFindsReachableStrings(self):
+    asm, story = make_story()
+    image = zstoryimage.ZStoryImage.from_bytes(story)
+    strings = set(zstringtable.precompile(image).values())
+    for text in ["Welcome. ", "Helping.", "Goodbye.", "A shiny lamp.",
+                 "lamp"]:
+      self.assertIn(text, strings)
+    self.assertNotIn("Never found.", strings)
+    self.assertEqual(image.strings[asm.address('farewell')], "Goodbye.")
+
+  def testMachinesStartWithStringsDecoded(self):
+    asm, story = make_story()
+    image = zstoryimage.ZStoryImage.from_bytes(story)
+    zstringtable.precompile(image)
+    ui = scriptedzui.create_zui()
+    machine = ZMachine(image, ui)
+    machine.run()
+    output = ui.screen.get_output()
+    self.assertTrue(output.startswith("Welcome. Helping."))
+    self.assertTrue(output.endswith("Goodbye."))
+    self.assertEqual(machine._stringfactory.cache_misses, 0)
+
+  def testTableIsSavedNextToStory(self):
+    asm, story = make_story()
+    path = os.path.join(self.tempdir, 'story.z5')
+    with open(path, 'wb') as f:
+      f.write(story)
+    image = zstoryimage.ZStoryImage.from_bytes(story)
+    strings = zstringtable.precompile(image, path)
+    table_path = path + zstringtable.FILE_SUFFIX
+    self.assertTrue(os.path.isfile(table_path))
+    image = zstoryimage.ZStoryImage.from_bytes(story)
+    self.assertEqual(zstringtable.precompile(image, path), strings)
+
+    # Another story, with the same path, doesn't use the table.
+    other_asm, other_story = make_story(serial=b"070102")
+    key = zstringtable.story_key(ZMemory(
+      zstoryimage.ZStoryImage.from_bytes(other_story)))
+    self.assertEqual(zstringtable.load_table(table_path, key), None)
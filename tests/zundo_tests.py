@@ -0,0 +1,142 @@
+#
+# Unit tests for the undo buffer.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmachine, trivialzui
+from zvm.zmemory import ZMemory
+from zvm.zstackmanager import ZStackManager
+from zvm.zundo import ZUndoBuffer
+from tests.storybuild import Assembler, Label, SP, build_story, glob, local
+
+TABLE = 0x600
+
+def make_undo_story():
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('call_1n', Label('turn'))
+  asm.op('quit')
+  asm.routine('turn', 1)
+  asm.op('store', 1, 7)
+  asm.op('push', 42)
+  asm.op('save_undo', store=glob(0))
+  asm.op('je', glob(0), 2, branch=('undone', True))
+  # Change memory and stacks, then undo the changes.
+  asm.op('storew', TABLE, 3, 0x1234)
+  asm.op('store', glob(1), 99)
+  asm.op('store', 1, 8)
+  asm.op('push', 43)
+  asm.op('restore_undo', store=glob(2))
+  asm.op('rfalse')
+  asm.label('undone')
+  asm.op('add', local(1), 0, store=glob(3))
+  asm.op('add', SP, 0, store=glob(4))
+  asm.op('rtrue')
+  return build_story(asm)
+
+def make_buffer(**options):
+  asm = Assembler(0x1100)
+  asm.routine('main')
+  asm.op('rtrue')
+  mem = ZMemory(build_story(asm))
+  stack = ZStackManager(mem)
+  return mem, stack, ZUndoBuffer(mem, stack, **options)
+
+class ZUndoOpcodeTests(TestCase):
+  def testRestoreUndoResumesAfterSaveUndo(self):
+    machine = zmachine.ZMachine(make_undo_story(), trivialzui.create_zui())
+    machine.run()
+    mem = machine._mem
+    self.assertEqual(mem.read_global(0x10), 2)
+    self.assertEqual(mem.read_word(TABLE + 6), 0)
+    self.assertEqual(mem.read_global(0x11), 0)
+    self.assertEqual(mem.read_global(0x12), 0)
+    self.assertEqual(mem.read_global(0x13), 7)
+    self.assertEqual(mem.read_global(0x14), 42)
+    self.assertEqual(len(machine._undo), 0)
+
+  def testNoUndoBuffer(self):
+    machine = zmachine.ZMachine(make_undo_story(), trivialzui.create_zui(),
+                                undo_levels=0)
+    machine.run()
+    mem = machine._mem
+    # save_undo stores -1, and restore_undo fails.
+    self.assertEqual(mem.read_global(0x10), 0xFFFF)
+    self.assertEqual(mem.read_global(0x12), 0)
+    self.assertEqual(mem.read_word(TABLE + 6), 0x1234)
+
+
+class ZUndoBufferTests(TestCase):
+  def testSeveralLevels(self):
+    mem, stack, undo = make_buffer()
+    for turn in range(1, 4):
+      mem[TABLE] = turn
+      stack.push_stack(turn)
+      undo.save(0x2000 + turn, 0x10)
+    mem[TABLE] = 4
+    mem[TABLE + 100] = 4
+    for turn in (3, 2, 1):
+      state = undo.restore()
+      self.assertEqual(state.program_counter, 0x2000 + turn)
+      self.assertEqual(mem[TABLE], turn)
+      self.assertEqual(mem[TABLE + 100], 0)
+      self.assertEqual(stack.get_frames()[0][4], list(range(1, turn + 1)))
+    self.assertEqual(undo.restore(), None)
+    self.assertEqual(undo.size, 0)
+
+  def testOnlyChangesAreKept(self):
+    mem, stack, undo = make_buffer()
+    undo.save(0x2000, 0x10)
+    mem[TABLE:TABLE + 4] = b"abcd"
+    undo.save(0x2000, 0x10)
+    self.assertEqual(undo.size, 2 * 8 + 4)
+
+  def testOnlyWrittenPagesAreCompared(self):
+    mem, stack, undo = make_buffer()
+    undo.save(0x2000, 0x10)
+    mem[TABLE] = 1
+    # Bytes changed behind the back of memory's write APIs are missed.
+    mem.raw[TABLE + 0x100] = 1
+    undo.save(0x2001, 0x10)
+    self.assertEqual(undo.size, 2 * 8 + 1)
+    mem[TABLE] = 2
+    undo.restore()
+    self.assertEqual(mem[TABLE], 1)
+    self.assertEqual(mem[TABLE + 0x100], 1)
+
+  def testSaveAfterRestore(self):
+    mem, stack, undo = make_buffer()
+    for turn in range(1, 3):
+      mem[TABLE - 0x100 * turn] = turn
+      undo.save(0x2000 + turn, 0x10)
+    mem[TABLE] = 9
+    undo.restore()
+    mem[TABLE - 0x300] = 3
+    undo.save(0x2003, 0x10)
+    undo.restore()
+    undo.restore()
+    self.assertEqual(mem[TABLE], 0)
+    self.assertEqual(mem[TABLE - 0x100], 1)
+    self.assertEqual(mem[TABLE - 0x200], 0)
+    self.assertEqual(mem[TABLE - 0x300], 0)
+    self.assertEqual(undo.size, 0)
+
+  def testOldestStatesAreDropped(self):
+    mem, stack, undo = make_buffer(levels=2)
+    for turn in range(1, 4):
+      mem[TABLE] = turn
+      undo.save(0x2000 + turn, 0x10)
+    self.assertEqual(len(undo), 2)
+    self.assertEqual(undo.restore().program_counter, 0x2003)
+    self.assertEqual(undo.restore().program_counter, 0x2002)
+    self.assertEqual(mem[TABLE], 2)
+    self.assertEqual(undo.restore(), None)
+
+    mem, stack, undo = make_buffer(budget=100)
+    for turn in range(1, 4):
+      mem[TABLE:TABLE + 50] = bytes([turn]) * 50
+      undo.save(0x2000 + turn, 0x10)
+    self.assertEqual(len(undo), 2)
+    self.assertTrue(undo.size <= 100)
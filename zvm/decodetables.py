@@ -0,0 +1,130 @@
+#
+# Precomputed tables for decoding the bit-packed bytes of Z-code:
+# opcode bytes, operand type bytes, branch bytes and property size
+# bytes, along with plain integer helpers for 16-bit signed values.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# All the formats decoded here pack several fields in a single byte,
+# so each table has one entry per possible byte value, computed once
+# at import time.  Decoding a byte is a single list lookup, instead of
+# building a BitField and slicing it field by field.
+
+# Constants defining the known instruction types. These types are
+# related to the number of operands the opcode has: for each operand
+# count, there is a separate opcode table, and the actual opcode
+# number is an index into that table.
+OPCODE_0OP = 0
+OPCODE_1OP = 1
+OPCODE_2OP = 2
+OPCODE_VAR = 3
+OPCODE_EXT = 4
+
+# Constants defining the possible operand types.
+LARGE_CONSTANT = 0x0
+SMALL_CONSTANT = 0x1
+VARIABLE = 0x2
+ABSENT = 0x3
+
+# The first byte of extended opcodes (in version 5 and later).
+EXTENDED_OPCODE_BYTE = 0xBE
+
+
+def _operand_types(byte):
+  """Return the tuple of operand types encoded in an operand types
+  BYTE, up to the first absent operand."""
+  types = []
+  for shift in (6, 4, 2, 0):
+    operand_type = (byte >> shift) & 0x3
+    if operand_type == ABSENT:
+      break
+    types.append(operand_type)
+  return tuple(types)
+
+def _opcode_form(byte):
+  """Return the (opcode_class, opcode_number, operand_types) decoding
+  of the first BYTE of a non-extended instruction. The operand types
+  are None for the variable form, where they are given by the
+  following operand types byte."""
+  if not byte & 0x80:
+    # Long form: always 2OP, with operand types in bits 6 and 5.
+    long_types = (SMALL_CONSTANT, VARIABLE)
+    return (OPCODE_2OP, byte & 0x1f,
+            (long_types[(byte >> 6) & 1], long_types[(byte >> 5) & 1]))
+  elif not byte & 0x40:
+    # Short form: 1OP, or 0OP if the operand type is absent.
+    operand_type = (byte >> 4) & 0x3
+    if operand_type == ABSENT:
+      return (OPCODE_0OP, byte & 0x0f, ())
+    return (OPCODE_1OP, byte & 0x0f, (operand_type,))
+  else:
+    # Variable form: VAR, or 2OP if bit 5 is clear.
+    if byte & 0x20:
+      return (OPCODE_VAR, byte & 0x1f, None)
+    return (OPCODE_2OP, byte & 0x1f, None)
+
+def _branch_byte(byte):
+  """Return the (branch_if_true, offset, is_short) decoding of the
+  first branch BYTE. For short branches, OFFSET is the whole branch
+  offset. For long ones, it is the signed contribution of the high
+  bits, to which the second branch byte must be added."""
+  branch_if_true = bool(byte & 0x80)
+  if byte & 0x40:
+    return (branch_if_true, byte & 0x3f, True)
+  # The long offset is a signed 14-bit number.
+  offset = (byte & 0x1f) << 8
+  if byte & 0x20:
+    offset -= 0x2000
+  return (branch_if_true, offset, False)
+
+def _property_size_v3(byte):
+  """Return the (property_number, size) decoding of a version 1-3
+  property size BYTE."""
+  return (byte & 0x1f, (byte >> 5) + 1)
+
+def _property_size_v4(byte):
+  """Return the (property_number, size) decoding of the first
+  property size byte in version 4 and later. The size is None when
+  it is given by a second size byte."""
+  if byte & 0x80:
+    return (byte & 0x3f, None)
+  if byte & 0x40:
+    return (byte & 0x3f, 2)
+  return (byte & 0x3f, 1)
+
+def _property_long_size(byte):
+  """Return the property size given by the second size BYTE of a
+  version 4+ property. A size of 0 means 64."""
+  return (byte & 0x3f) or 64
+
+
+#--------- Public APIs -----------
+
+# Decoding of the first byte of an instruction, see _opcode_form.
+OPCODE_FORMS = [_opcode_form(byte) for byte in range(256)]
+
+# Operand types encoded in an operand types byte.
+OPERAND_TYPES = [_operand_types(byte) for byte in range(256)]
+
+# Decoding of the first branch byte, see _branch_byte.
+BRANCH_BYTES = [_branch_byte(byte) for byte in range(256)]
+
+# Decoding of property size bytes, see _property_size_v3,
+# _property_size_v4 and _property_long_size.
+PROPERTY_SIZES_V3 = [_property_size_v3(byte) for byte in range(256)]
+PROPERTY_SIZES_V4 = [_property_size_v4(byte) for byte in range(256)]
+PROPERTY_LONG_SIZES = [_property_long_size(byte) for byte in range(256)]
+
+
+def to_signed(value):
+  """Turn the given 16-bit VALUE into a signed integer."""
+  if value & 0x8000:
+    return value - 0x10000
+  return value
+
+def to_unsigned(value):
+  """Turn the given integer VALUE into a 16-bit value ready for
+  storage, wrapping it around as the Z-machine's arithmetic does."""
+  return value & 0xFFFF
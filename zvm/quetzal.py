@@ -12,13 +12,13 @@
 # root directory of this distribution.
 #
 
-# Woohoo!  Python has a module to parse IFF files, which is a generic
-# interchange format.  A Quetzal file is in fact a type of IFF file.
-import chunk
+# A Quetzal file is a type of IFF file, which is a generic interchange
+# format.
 import os
+import re
+import struct
 
-from . import bitfield
-from . import zstackmanager
+from . import zlogging
 from .zlogging import log
 
 # The general format of Queztal is that of a "FORM" IFF file, which is
@@ -59,6 +59,15 @@ class QuetzalStackFrameOverflow(QuetzalError):
   "Stack frame parsing went beyond bounds of 'Stks' chunk."
 
 
+# Runs of unchanged bytes, in the XOR of dynamic memory with the
+# original story.
+_ZERO_RUNS = re.compile(b"\0+")
+
+# Encoded runs of unchanged bytes in a CMem chunk: a zero, followed by
+# the number of extra unchanged bytes.
+_ENCODED_RUNS = re.compile(b"\0(.)", re.DOTALL)
+
+
 class QuetzalParser(object):
   """A class to read a Quetzal save-file and modify a z-machine."""
 
@@ -88,10 +97,10 @@ class QuetzalParser(object):
     chunk_pc = (data[10] << 16) + (data[11] << 8) + data[12]
     self._zmachine._opdecoder.program_counter = chunk_pc
 
-    log("  Found release number %d" % chunk_release)
-    log("  Found serial number %d" % int(chunk_serial))
-    log("  Found checksum %d" % chunk_checksum)
-    log("  Initial program counter value is %d" % chunk_pc)
+    log("  Found release number %d", chunk_release)
+    log("  Found serial number %s", chunk_serial)
+    log("  Found checksum %d", chunk_checksum)
+    log("  Initial program counter value is %d", chunk_pc)
     self._last_loaded_metadata["release number"] = chunk_release
     self._last_loaded_metadata["serial number"] = chunk_serial
     self._last_loaded_metadata["checksum"] = chunk_checksum
@@ -117,41 +126,35 @@ class QuetzalParser(object):
     log("  Decompressing dynamic memory image")
     self._seen_mem_or_stks = True
 
-    # Just duplicate the dynamic memory block of the pristine story image,
-    # and then make tweaks to it as we decode the runlength-encoding.
     pmem = self._zmachine._pristine_mem
     cmem = self._zmachine._mem
-    savegame_mem = list(pmem[pmem._dynamic_start:(pmem._dynamic_end + 1)])
-    memlen = len(savegame_mem)
-    memcounter = 0
-    log("  Dynamic memory length is %d" % memlen)
+    start, end = cmem._dynamic_start, cmem._dynamic_end + 1
+    memlen = end - start
+    log("  Dynamic memory length is %d", memlen)
     self._last_loaded_metadata["memory length"] = memlen
 
-    runlength_bytes = data
-    bytelen = len(runlength_bytes)
+    # Rebuild the XOR of the saved memory with the original story:
+    # copy the changed bytes between encoded runs, and leave the runs
+    # zero.  If the data stops short of the end of memory, that's
+    # totally fine, it just means there are no more differences.
+    diff = bytearray(memlen)
+    memcounter = 0
     bytecounter = 0
-
-    log("  Decompressing dynamic memory image")
-    while bytecounter < bytelen:
-      byte = runlength_bytes[bytecounter]
-      if byte != 0:
-        savegame_mem[memcounter] = byte ^ pmem[memcounter]
-        memcounter += 1
-        bytecounter += 1
-        log("   Set byte %d:%d" % (memcounter, savegame_mem[memcounter]))
-      else:
-        bytecounter += 1
-        num_extra_zeros = runlength_bytes[bytecounter]
-        memcounter += (1 + num_extra_zeros)
-        bytecounter += 1
-        log("   Skipped %d unchanged bytes" % (1 + num_extra_zeros))
-      if memcounter >= memlen:
+    for run in _ENCODED_RUNS.finditer(data):
+      changed = run.start() - bytecounter
+      if memcounter + changed >= memlen:
         raise QuetzalMemoryOutOfBounds
-
-    # If memcounter finishes less then memlen, that's totally fine, it
-    # just means there are no more diffs to apply.
-
-    cmem[cmem._dynamic_start:(cmem._dynamic_end + 1)] = savegame_mem
+      diff[memcounter:memcounter + changed] = data[bytecounter:run.start()]
+      memcounter += changed + 1 + data[run.start() + 1]
+      bytecounter = run.end()
+    changed = len(data) - bytecounter
+    if memcounter + changed > memlen:
+      raise QuetzalMemoryOutOfBounds
+    diff[memcounter:memcounter + changed] = data[bytecounter:]
+
+    savegame_mem = (int.from_bytes(diff, 'big')
+                    ^ int.from_bytes(pmem[start:end], 'big'))
+    cmem[start:end] = savegame_mem.to_bytes(memlen, 'big')
     log("  Successfully installed new dynamic memory.")
 
 
@@ -166,15 +169,14 @@ class QuetzalParser(object):
     self._seen_mem_or_stks = True
 
     cmem = self._zmachine._mem
-    dynamic_len = (cmem._dynamic_end - cmem.dynamic_start) + 1
-    log("  Dynamic memory length is %d" % dynamic_len)
+    dynamic_len = (cmem._dynamic_end - cmem._dynamic_start) + 1
+    log("  Dynamic memory length is %d", dynamic_len)
     self._last_loaded_metadata["dynamic memory length"] = dynamic_len
 
-    savegame_mem = [ord(x) for x in data]
-    if len(savegame_mem) != dynamic_len:
+    if len(data) != dynamic_len:
       raise QuetzalMemoryMismatch
 
-    cmem[cmem._dynamic_start:(cmem._dynamic_end + 1)] = savegame_mem
+    cmem[cmem._dynamic_start:(cmem._dynamic_end + 1)] = data
     log("  Successfully installed new dynamic memory.")
 
 
@@ -183,12 +185,13 @@ class QuetzalParser(object):
 
     log("  Begin parsing of stack frames")
 
-    # Our strategy here is simply to create an entirely new
-    # ZStackManager object and populate it with a series of ZRoutine
-    # stack-frames parses from the quetzal file.  We then attach this
-    # new ZStackManager to our z-machine, and allow the old one to be
-    # garbage collected.
-    stackmanager = zstackmanager.ZStackManager(self._zmachine._mem)
+    # Our strategy here is simply to empty the stacks of the
+    # z-machine's ZStackManager, and populate them with the series of
+    # stack-frames parsed from the quetzal file.  The first frame is a
+    # dummy frame, holding the values pushed outside of any routine,
+    # which belong to the bottom of the data stack.
+    stackmanager = self._zmachine._stackmanager
+    stackmanager.clear()
 
     self._seen_mem_or_stks = True
     bytes = data
@@ -197,51 +200,44 @@ class QuetzalParser(object):
 
     # Read successive stack frames:
     while (ptr < total_len):
-      log("  Parsing stack frame...")
-      return_pc = (bytes[ptr] << 16) + (bytes[ptr + 1] << 8) + bytes[ptr + 3]
-      ptr += 3
-      flags_bitfield = bitfield.BitField(bytes[ptr])
-      ptr += 1
-      varnum = bytes[ptr]  ### TODO: tells us which variable gets the result
-      ptr += 1
-      argflag = bytes[ptr]
-      ptr += 1
-      evalstack_size = (bytes[ptr] << 8) + bytes[ptr + 1]
-      ptr += 2
-
-      # read anywhere from 0 to 15 local vars
-      local_vars = []
-      for i in range(flags_bitfield[0:3]):
-        var = (bytes[ptr] << 8) + bytes[ptr + 1]
-        ptr += 2
-        local_vars.append(var)
-      log("    Found %d local vars" % len(local_vars))
-
-      # least recent to most recent stack values:
-      stack_values = []
-      for i in range(evalstack_size):
-        val = (bytes[ptr] << 8) + bytes[ptr + 1]
-        ptr += 2
-        stack_values.append(val)
-      log("    Found %d local stack values" % len(stack_values))
-
-      ### Interesting... the reconstructed stack frames have no 'start
-      ### address'.  I guess it doesn't matter, since we only need to
-      ### pop back to particular return addresses to resume each
-      ### routine.
-
-      ### TODO: I can exactly which of the 7 args is "supplied", but I
-      ### don't understand where the args *are*??
-
-      routine = zstackmanager.ZRoutine(0, return_pc, self._zmachine._mem,
-                                       [], local_vars, stack_values)
-      stackmanager.push_routine(routine)
-      log("    Added new frame to stack.")
-
-      if (ptr > total_len):
+      if ptr + 8 > total_len:
         raise QuetzalStackFrameOverflow
+      return_pc_high, return_pc_low, flags, varnum, argflag, evalstack_size = \
+             struct.unpack_from(">BHBBBH", bytes, ptr)
+      return_pc = (return_pc_high << 16) | return_pc_low
+      ptr += 8
+      num_locals = flags & 0x0F
+
+      if ptr + 2 * (num_locals + evalstack_size) > total_len:
+        raise QuetzalStackFrameOverflow
+
+      # read anywhere from 0 to 15 local vars, then the least recent
+      # to most recent stack values.
+      values = struct.unpack_from(">%dH" % (num_locals + evalstack_size),
+                                  bytes, ptr)
+      ptr += 2 * (num_locals + evalstack_size)
+      local_vars = values[:num_locals]
+      stack_values = values[num_locals:]
+      if zlogging.debug_enabled:
+        log("    Found frame with %d local vars and %d stack values",
+            num_locals, evalstack_size)
+
+      if (stackmanager.get_stack_frame_index() == 0
+          and return_pc == 0 and num_locals == 0):
+        # The dummy frame.
+        for value in stack_values:
+          stackmanager.push_stack(value)
+        continue
+
+      # The frame's return address is where its caller resumes.
+      if flags & 0x10:
+        store_variable = None
+      else:
+        store_variable = varnum
+      stackmanager.push_frame(return_pc, store_variable,
+                              bin(argflag).count("1"), local_vars,
+                              stack_values)
 
-    self._zmachine._stackmanager = stackmanager
     log("  Successfully installed all stack frames.")
 
 
@@ -249,7 +245,7 @@ class QuetzalParser(object):
     """Parse a chunk of type IntD, which is interpreter-dependent info."""
 
     log("  Begin parsing of interpreter-dependent metadata")
-    bytes = [ord(x) for x in data]
+    bytes = data
 
     os_id = bytes[0:3]
     flags = bytes[4]
@@ -268,19 +264,19 @@ class QuetzalParser(object):
   def _parse_auth(self, data):
     """Parse a chunk of type AUTH.  Display the author."""
 
-    log("Author of file: %s" % data)
+    log("Author of file: %s", data)
     self._last_loaded_metadata["author"] = data
 
   def _parse_copyright(self, data):
     """Parse a chunk of type (c) .  Display the copyright."""
 
-    log("Copyright: (C) %s" % data)
+    log("Copyright: (C) %s", data)
     self._last_loaded_metadata["copyright"] = data
 
   def _parse_anno(self, data):
     """Parse a chunk of type ANNO.  Display any annotation"""
 
-    log("Annotation: %s" % data)
+    log("Annotation: %s", data)
     self._last_loaded_metadata["annotation"] = data
 
 
@@ -296,67 +292,63 @@ class QuetzalParser(object):
     """Parse each chunk of the Quetzal file at SAVEFILE_PATH,
     initializing associated zmachine subsystems as needed."""
 
-    self._last_loaded_metadata = {}
-
     if not os.path.isfile(savefile_path):
       raise QuetzalNoSuchSavefile
 
-    log("Attempting to load saved game from '%s'" % savefile_path)
-    self._file = open(savefile_path, 'rb')
+    log("Attempting to load saved game from '%s'", savefile_path)
+    with open(savefile_path, 'rb') as f:
+      self.load_data(f.read())
+
+  def load_data(self, data):
+    """Parse each chunk of DATA, the contents of a Quetzal file,
+    initializing associated zmachine subsystems as needed."""
 
-    # The python 'chunk' module is pretty dumb; it doesn't understand
-    # the FORM chunk and the way it contains nested chunks.
-    # Therefore, we deliberately seek 12 bytes into the file so that
-    # we can start sucking out chunks.  This also allows us to
-    # validate that the FORM type is "IFZS".
-    header = self._file.read(4)
-    if header != b"FORM":
+    self._last_loaded_metadata = {}
+    self._seen_mem_or_stks = False
+
+    # The FORM chunk holds the type of the file, "IFZS", and then the
+    # chunks of the file, each padded to an even length.
+    if len(data) < 12 or data[0:4] != b"FORM":
       raise QuetzalUnrecognizedFileFormat
-    bytestring = self._file.read(4)
-    self._len = bytestring[0] << 24
-    self._len += bytestring[1] << 16
-    self._len += bytestring[2] << 8
-    self._len += bytestring[3]
-    log("Total length of FORM data is %d" % self._len)
+    self._len = struct.unpack_from(">I", data, 4)[0]
+    log("Total length of FORM data is %d", self._len)
     self._last_loaded_metadata["total length"] = self._len
 
-    type = self._file.read(4)
-    if type != b"IFZS":
+    if data[8:12] != b"IFZS":
       raise QuetzalUnrecognizedFileFormat
 
-    try:
-      while 1:
-        c = chunk.Chunk(self._file)
-        chunkname = c.getname()
-        chunksize = c.getsize()
-        data = c.read(chunksize)
-        log("** Found chunk ID %s: length %d" % (chunkname, chunksize))
-        self._last_loaded_metadata[chunkname] = chunksize
-
-        if chunkname == b"IFhd":
-          self._parse_ifhd(data)
-        elif chunkname == b"CMem":
-          self._parse_cmem(data)
-        elif chunkname == b"UMem":
-          self._parse_umem(data)
-        elif chunkname == b"Stks":
-          self._parse_stks(data)
-        elif chunkname == b"IntD":
-          self._parse_intd(data)
-        elif chunkname == b"AUTH":
-          self._parse_auth(data)
-        elif chunkname == b"(c) ":
-          self._parse_copyright(data)
-        elif chunkname == b"ANNO":
-          self._parse_anno(data)
-        else:
-          # spec says to ignore and skip past unrecognized chunks
-          pass
-
-    except EOFError:
-      pass
-
-    self._file.close()
+    end = min(len(data), 8 + self._len)
+    offset = 12
+    while offset + 8 <= end:
+      chunkname, chunksize = struct.unpack_from(">4sI", data, offset)
+      offset += 8
+      chunkdata = data[offset:offset + chunksize]
+      if len(chunkdata) < chunksize:
+        raise QuetzalMalformedChunk
+      offset += chunksize + (chunksize & 1)
+      log("** Found chunk ID %s: length %d", chunkname, chunksize)
+      self._last_loaded_metadata[chunkname] = chunksize
+
+      if chunkname == b"IFhd":
+        self._parse_ifhd(chunkdata)
+      elif chunkname == b"CMem":
+        self._parse_cmem(chunkdata)
+      elif chunkname == b"UMem":
+        self._parse_umem(chunkdata)
+      elif chunkname == b"Stks":
+        self._parse_stks(chunkdata)
+      elif chunkname == b"IntD":
+        self._parse_intd(chunkdata)
+      elif chunkname == b"AUTH":
+        self._parse_auth(chunkdata)
+      elif chunkname == b"(c) ":
+        self._parse_copyright(chunkdata)
+      elif chunkname == b"ANNO":
+        self._parse_anno(chunkdata)
+      else:
+        # spec says to ignore and skip past unrecognized chunks
+        pass
+
     log("Finished parsing Quetzal file.")
 
 
@@ -368,97 +360,131 @@ class QuetzalWriter(object):
   """A class to write the current state of a z-machine into a
   Quetzal-format file."""
 
-  def __init__(self, zmachine):
+  def __init__(self, zmachine, annotation=None):
+    """Create a writer saving the state of ZMACHINE. If ANNOTATION is
+    given, the file carries it as a note in an ANNO chunk."""
     log("Creating new instance of QuetzalWriter")
     self._zmachine = zmachine
+    self._annotation = annotation
+
+  def _make_chunk(self, name, data):
+    """Return a chunk of type NAME holding DATA, padded to an even
+    length as IFF requires."""
+    chunk = name + struct.pack(">I", len(data)) + bytes(data)
+    if len(data) % 2:
+      chunk += b"\0"
+    return chunk
 
   def _generate_ifhd_chunk(self):
     """Return a chunk of type IFhd, containing metadata about the
     zmachine and story being played."""
 
-    ### TODO: write this.  payload must be *exactly* 13 bytes, even if
-    ### it means padding the program counter.
+    mem = self._zmachine._mem
+    release = mem.read_word(2)
+    serial = bytes(mem[0x12:0x18])
 
-    ### Some old infocom games don't have checksums stored in header.
-    ### If not, generate it from the *original* story file memory
-    ### image and put it into this chunk.  See ZMemory.generate_checksum().
-    pass
+    # Some old infocom games don't have checksums stored in header.
+    # If not, generate it from the *original* story file memory image.
+    checksum = mem.read_word(0x1C)
+    if checksum == 0:
+      checksum = sum(bytes(self._zmachine._pristine_mem[0x40:])) % 0x10000
 
-    return "0"
+    pc = self._zmachine._opdecoder.program_counter
+    data = struct.pack(">H6sH", release, serial, checksum) \
+           + pc.to_bytes(3, 'big')
+    return self._make_chunk(b"IFhd", data)
 
 
   def _generate_cmem_chunk(self):
     """Return a compressed chunk of data representing the compressed
-    image of the zmachine's main memory."""
-
-    ### TODO:  debug this when ready
-    return "0"
-
-    # XOR the original game image with the current one
-    diffarray = list(self._zmachine._pristine_mem)
-    for index in range(len(self._zmachine._pristine_mem._total_size)):
-      diffarray[index] = self._zmachine._pristine_mem[index] \
-                         ^ self._zmachine._mem[index]
-    log("XOR array is %s" % diffarray)
-
-    # Run-length encode the resulting list of 0's and 1's.
-    result = []
-    zerocounter = 0;
-    for index in range(len(diffarray)):
-      if diffarray[index] == 0:
-        zerocounter += 1
-        continue;
-      else:
-        if zerocounter > 0:
-          result.append(0)
-          result.append(zerocounter)
-          zerocounter = 0
-        result.append(diffarray[index])
-    return result
+    image of the zmachine's dynamic memory."""
+
+    # XOR the original game image with the current one, and run-length
+    # encode the runs of zeroes: a zero byte is followed by the number
+    # of extra zeroes in the run (up to 255).  Trailing zeroes are
+    # dropped.  The XOR is done on dynamic memory as a whole, as one
+    # big integer, and the runs are found by a regex, so that no
+    # Python code runs per byte.
+    pmem = self._zmachine._pristine_mem
+    cmem = self._zmachine._mem
+    start, end = cmem._dynamic_start, cmem._dynamic_end + 1
+    diff = (int.from_bytes(cmem.raw[start:end], 'big')
+            ^ int.from_bytes(pmem[start:end], 'big'))
+    diff = diff.to_bytes(end - start, 'big').rstrip(b"\0")
+
+    result = bytearray()
+    position = 0
+    for run in _ZERO_RUNS.finditer(diff):
+      result += diff[position:run.start()]
+      full_runs, rest = divmod(run.end() - run.start(), 256)
+      result += b"\0\xff" * full_runs
+      if rest:
+        result += bytes((0, rest - 1))
+      position = run.end()
+    result += diff[position:]
+    return self._make_chunk(b"CMem", result)
 
 
   def _generate_stks_chunk(self):
     """Return a stacks chunk, describing the stack state of the
     zmachine at this moment."""
 
-    ### TODO:  write this
-    return "0"
+    frames = self._zmachine._stackmanager.get_frames()
+    data = bytearray()
+    for index, (return_pc, store_var, num_args, local_vars,
+                stack) in enumerate(frames):
+      flags = len(local_vars)
+      if index == 0:
+        # The dummy frame, holding the values pushed outside of any
+        # routine.
+        varnum = 0
+      elif store_var is None:
+        flags |= 0x10
+        varnum = 0
+      else:
+        varnum = store_var
+      argflag = (1 << num_args) - 1
+      data += return_pc.to_bytes(3, 'big')
+      data += struct.pack(">BBBH", flags, varnum, argflag, len(stack))
+      data += struct.pack(">%dH" % (len(local_vars) + len(stack)),
+                          *(local_vars + stack))
+    return self._make_chunk(b"Stks", data)
 
 
   def _generate_anno_chunk(self):
-    """Return an annotation chunk, containing metadata about the ZVM
-    interpreter which created the savefile."""
+    """Return an annotation chunk, holding the annotation of the
+    writer, or nothing if it has none."""
 
-    ### TODO:  write this
-    return "0"
+    if self._annotation is None:
+      return b""
+    return self._make_chunk(b"ANNO", self._annotation.encode('utf-8'))
 
 
   #--------- Public APIs -----------
 
 
+  def generate(self, memory=True):
+    """Return the current zmachine state, as the contents of a
+    Quetzal file. If MEMORY is false, the file has no memory chunk:
+    loading it only restores the stacks and program counter, for
+    callers restoring memory by other means (see zcheckpoint)."""
+
+    if memory:
+      cmem_chunk = self._generate_cmem_chunk()
+    else:
+      cmem_chunk = b""
+    chunks = b"".join([self._generate_ifhd_chunk(),
+                       cmem_chunk,
+                       self._generate_stks_chunk(),
+                       self._generate_anno_chunk()])
+    return b"FORM" + struct.pack(">I", 4 + len(chunks)) + b"IFZS" + chunks
+
   def write(self, savefile_path):
     """Write the current zmachine state to a new Quetzal-file at
     SAVEFILE_PATH."""
 
-    log("Attempting to write game-state to '%s'" % savefile_path)
-    self._file = open(savefile_path, 'w')
-
-    ifhd_chunk = self._generate_ifhd_chunk()
-    cmem_chunk = self._generate_cmem_chunk()
-    stks_chunk = self._generate_stks_chunk()
-    anno_chunk = self._generate_anno_chunk()
-
-    total_chunk_size = len(ifhd_chunk) + len(cmem_chunk) \
-                       + len(stks_chunk) + len(anno_chunk)
-
-    # Write main FORM chunk to hold other chunks
-    self._file.write("FORM")
-    ### TODO: self._file_write(total_chunk_size) -- spread it over 4 bytes
-    self._file.write("IFZS")
-
-    # Write nested chunks.
-    for chunk in (ifhd_chunk, cmem_chunk, stks_chunk, anno_chunk):
-      self._file.write(chunk)
-      log("Wrote a chunk.")
-    self._file.close()
+    log("Attempting to write game-state to '%s'", savefile_path)
+    data = self.generate()
+    with open(savefile_path, 'wb') as f:
+      f.write(data)
     log("Done writing game-state to savefile.")
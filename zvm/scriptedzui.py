@@ -0,0 +1,167 @@
+#
+# A non-interactive user interface for a Z-Machine, which reads its
+# input from a script of commands and collects its output in memory.
+# It is meant for automated runs of stories: tests, benchmarks and
+# servers.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+from . import zaudio
+from . import zscreen
+from . import zstream
+from . import zfilesystem
+from . import zui
+
+class ScriptedZUIError(Exception):
+  "General exception for the scripted UI."
+  pass
+
+class ScriptedInputExhausted(ScriptedZUIError, zstream.ZInputNotReady):
+  """The story asked for input after the end of the script. The
+  machine suspends until more input is fed to the script."""
+  pass
+
+class ScriptedAudio(zaudio.ZAudio):
+  def __init__(self):
+    zaudio.ZAudio.__init__(self)
+    self.features = {
+      "has_more_than_a_bleep": False,
+      }
+
+  def play_bleep(self, bleep_type):
+    pass
+
+class ScriptedScreen(zscreen.ZScreen):
+  def __init__(self, keep_output=True):
+    """Create a screen which appends everything written to it to its
+    'output' list, unless KEEP_OUTPUT is false, in which case output
+    is discarded."""
+    zscreen.ZScreen.__init__(self)
+    self._rows = zscreen.INFINITE_ROWS
+    self.output = []
+    self.__keep_output = keep_output
+
+  def split_window(self, height):
+    pass
+
+  def select_window(self, window_num):
+    pass
+
+  def set_cursor_position(self, x, y):
+    pass
+
+  def erase_window(self, window=zscreen.WINDOW_LOWER,
+                   color=zscreen.COLOR_CURRENT):
+    pass
+
+  def erase_line(self):
+    pass
+
+  def set_font(self, font_number):
+    if font_number == zscreen.FONT_NORMAL:
+      return font_number
+    return None
+
+  def set_text_style(self, style):
+    pass
+
+  def write(self, string):
+    if self.__keep_output:
+      self.output.append(string)
+
+  def get_output(self):
+    """Return all the text written so far, and forget it."""
+    text = ''.join(self.output)
+    del self.output[:]
+    return text
+
+class ScriptedKeyboardInputStream(zstream.ZInputStream):
+  def __init__(self, script, on_input=None):
+    """Create an input stream reading from SCRIPT, a sequence of input
+    lines. read_line() returns the next line of the script, and
+    read_char() returns the characters of the script one by one, with
+    a carriage return at the end of each line.
+
+    If ON_INPUT is given, it is called without arguments each time
+    the story asks for input, before the input is read."""
+    zstream.ZInputStream.__init__(self)
+    self.features = {
+      "has_timed_input" : False,
+      }
+    self._lines = list(script)
+    self._pending_chars = ""
+    self._on_input = on_input
+
+  def feed(self, line):
+    """Append LINE to the script."""
+    self._lines.append(line)
+
+  def _next_line(self):
+    if not self._lines:
+      raise ScriptedInputExhausted
+    return self._lines.pop(0)
+
+  def read_line(self, original_text=None, max_length=0,
+                terminating_characters=None,
+                timed_input_routine=None, timed_input_interval=0):
+    if self._on_input is not None:
+      self._on_input()
+    if self._pending_chars:
+      result = self._pending_chars.rstrip("\r")
+      self._pending_chars = ""
+    else:
+      result = self._next_line()
+    if max_length > 0:
+      result = result[:max_length]
+    return str(result)
+
+  def read_char(self, timed_input_routine=None,
+                timed_input_interval=0):
+    if self._on_input is not None:
+      self._on_input()
+    if not self._pending_chars:
+      self._pending_chars = self._next_line() + "\r"
+    char = self._pending_chars[0]
+    self._pending_chars = self._pending_chars[1:]
+    return ord(char)
+
+class ScriptedFilesystem(zfilesystem.ZFilesystem):
+  """A filesystem keeping saved games in memory, under the names
+  suggested by the story."""
+
+  def __init__(self):
+    self.saved_games = {}
+    self._last_saved = None
+
+  def save_game(self, data, suggested_filename=None):
+    self._last_saved = suggested_filename
+    self.saved_games[suggested_filename] = data
+    return True
+
+  def restore_game(self):
+    return self.saved_games.get(self._last_saved)
+
+  def open_transcript_file_for_writing(self):
+    return None
+
+  def open_transcript_file_for_reading(self):
+    return None
+
+def create_zui(script=(), keep_output=True, on_input=None):
+  """Creates and returns a ZUI instance reading its input from SCRIPT,
+  a sequence of input lines. See ScriptedScreen and
+  ScriptedKeyboardInputStream for KEEP_OUTPUT and ON_INPUT."""
+
+  audio = ScriptedAudio()
+  screen = ScriptedScreen(keep_output)
+  keyboard_input = ScriptedKeyboardInputStream(script, on_input)
+  filesystem = ScriptedFilesystem()
+
+  return zui.ZUI(
+    audio,
+    screen,
+    keyboard_input,
+    filesystem
+    )
@@ -52,13 +52,13 @@ class TrivialScreen(zscreen.ZScreen):
     self.__rows_since_last_input = 0
 
   def split_window(self, height):
-    log("TODO: split window here to height %d" % height)
+    log("TODO: split window here to height %d", height)
 
   def select_window(self, window_num):
-    log("TODO: select window %d here" % window_num)
+    log("TODO: select window %d here", window_num)
 
   def set_cursor_position(self, x, y):
-    log("TODO: set cursor position to (%d,%d) here" % (x,y))
+    log("TODO: set cursor position to (%d,%d) here", x,y)
 
   def erase_window(self, window=zscreen.WINDOW_LOWER,
                    color=zscreen.COLOR_CURRENT):
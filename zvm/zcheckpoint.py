@@ -0,0 +1,221 @@
+#
+# An append-only log of checkpoints of a game being played, from which
+# the game can be recovered after a crash.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Writing a whole Quetzal file at every turn writes all of dynamic
+# memory, most of which didn't change during the turn.  Instead, the
+# log starts with a base record, holding a Quetzal file of the game,
+# and every turn appends a turn record, holding the pages of dynamic
+# memory written during the turn (see the dirty map of ZMemory) and a
+# Quetzal file without memory, which holds the stacks and program
+# counter.  Recovering the game loads the base record into a fresh
+# machine, then writes the pages of each turn record over its memory,
+# and loads the stacks of the last one.  Every so often, the log is
+# compacted: it is rewritten as a single base record.
+#
+# The log owns the dirty map of the machine's memory: it clears the
+# map whenever it has recorded the pages written so far.
+#
+# Each record is a type, the length of its data and a CRC-32 of its
+# data, followed by the data.  A crash while a record is appended
+# leaves a truncated or corrupt record at the end of the log, which
+# recovery ignores: the game resumes at the turn before.
+
+import os
+import struct
+import zlib
+
+from . import quetzal
+from .zlogging import log
+
+class ZCheckpointError(Exception):
+  "General exception for checkpoint logs."
+  pass
+
+class ZCheckpointBadLog(ZCheckpointError):
+  "The file isn't a checkpoint log, or has no valid base record."
+  pass
+
+# Suffix of the names of checkpoint log files.
+FILE_SUFFIX = ".zlog"
+
+# Start of every checkpoint log file, with the version of the format.
+MAGIC = b"ZVMLOG01"
+
+# Types of records.
+RECORD_BASE = b"BASE"
+RECORD_TURN = b"TURN"
+
+# Number of turn records after which the log is compacted.
+DEFAULT_COMPACT_EVERY = 100
+
+# Record header: type, length of data, CRC-32 of data.
+_RECORD_HEADER = struct.Struct(">4sII")
+
+# Header of each run of pages in a turn record: address and length.
+_RUN_HEADER = struct.Struct(">II")
+
+_COUNT = struct.Struct(">I")
+
+
+def read_log(path):
+  """Read the checkpoint log at PATH. Return the data of its last base
+  record, and the list of the data of the turn records following it.
+  Records after a truncated or corrupt one are ignored."""
+
+  with open(path, 'rb') as f:
+    data = f.read()
+  if not data.startswith(MAGIC):
+    raise ZCheckpointBadLog
+
+  base = None
+  turns = []
+  offset = len(MAGIC)
+  while offset + _RECORD_HEADER.size <= len(data):
+    record_type, length, crc = _RECORD_HEADER.unpack_from(data, offset)
+    start = offset + _RECORD_HEADER.size
+    record = data[start:start + length]
+    if len(record) < length or zlib.crc32(record) != crc:
+      log("Ignoring damaged checkpoint record at offset %d", offset)
+      break
+    if record_type == RECORD_BASE:
+      base = record
+      turns = []
+    elif record_type == RECORD_TURN:
+      turns.append(record)
+    offset = start + length
+
+  if base is None:
+    raise ZCheckpointBadLog
+  return base, turns
+
+
+def recover(zmachine, path):
+  """Restore the game recorded in the checkpoint log at PATH into
+  ZMACHINE, a machine freshly created on the story of the game.
+  Return the number of turn records replayed."""
+
+  base, turns = read_log(path)
+  quetzal.QuetzalParser(zmachine).load_data(base)
+
+  mem = zmachine._mem
+  stacks = None
+  for data in turns:
+    count = _COUNT.unpack_from(data)[0]
+    offset = _COUNT.size
+    for _ in range(count):
+      addr, length = _RUN_HEADER.unpack_from(data, offset)
+      offset += _RUN_HEADER.size
+      mem[addr:addr + length] = data[offset:offset + length]
+      offset += length
+    stacks = data[offset:]
+  # The stacks of earlier turns are overwritten anyway.
+  if stacks is not None:
+    quetzal.QuetzalParser(zmachine).load_data(stacks)
+  log("Recovered game from %s, replaying %d turns", path, len(turns))
+  return len(turns)
+
+
+class ZCheckpointLog(object):
+
+  def __init__(self, zmachine, path, compact_every=DEFAULT_COMPACT_EVERY,
+               sync=False):
+    """Create a checkpoint log of the game played by ZMACHINE, in the
+    file at PATH. The file is written by the first checkpoint, and
+    compacted every COMPACT_EVERY checkpoints after that. If SYNC is
+    true, records are synced to disk as they are written, so that they
+    survive a crash of the host, and not only of the process."""
+
+    self._zmachine = zmachine
+    self.path = path
+    self.compact_every = compact_every
+    self.sync = sync
+    self._file = None
+
+    # Number of turn records since the base record, and size of the
+    # log in bytes.
+    self.turns = 0
+    self.size = 0
+
+
+  def _write_record(self, f, record_type, data):
+    """Write a record of type RECORD_TYPE holding DATA to F."""
+
+    f.write(_RECORD_HEADER.pack(record_type, len(data), zlib.crc32(data)))
+    f.write(data)
+    f.flush()
+    if self.sync:
+      os.fsync(f.fileno())
+    self.size += _RECORD_HEADER.size + len(data)
+
+
+  def _turn_data(self):
+    """Return the data of a turn record: the pages of dynamic memory
+    written since the last record, and the stacks."""
+
+    mem = self._zmachine._mem
+    end = mem._dynamic_end + 1
+    runs = [(addr, data[:end - addr]) for addr, data in mem.export_dirty()
+            if addr < end]
+    data = bytearray(_COUNT.pack(len(runs)))
+    for addr, run in runs:
+      data += _RUN_HEADER.pack(addr, len(run))
+      data += run
+    data += quetzal.QuetzalWriter(self._zmachine).generate(memory=False)
+    return bytes(data)
+
+
+  #--------- Public APIs -----------
+
+
+  def checkpoint(self):
+    """Record the current state of the game. The game must be waiting
+    for input, with its input instruction rewound (see
+    ZCpu.rewind_input)."""
+
+    if self._file is None or self.turns >= self.compact_every:
+      self.compact()
+      return
+    self._write_record(self._file, RECORD_TURN, self._turn_data())
+    self._zmachine._mem.clear_dirty()
+    self.turns += 1
+
+
+  def compact(self):
+    """Rewrite the log as a single base record, holding the current
+    state of the game."""
+
+    self.close()
+    temp_path = self.path + ".tmp"
+    self.size = len(MAGIC)
+    with open(temp_path, 'wb') as f:
+      f.write(MAGIC)
+      self._write_record(f, RECORD_BASE,
+                         quetzal.QuetzalWriter(self._zmachine).generate())
+    os.replace(temp_path, self.path)
+    self._zmachine._mem.clear_dirty()
+    self.turns = 0
+    self._file = open(self.path, 'ab')
+    log("Compacted checkpoint log %s", self.path)
+
+
+  def close(self):
+    """Close the log file. The next checkpoint compacts the log."""
+
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+  def remove(self):
+    """Close and delete the log file, when the game is over."""
+
+    self.close()
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
@@ -11,7 +11,11 @@ import time
 
 from . import zopdecoder
 from . import zscreen
-from . import bitfield
+from . import zstream
+from .zlexer import ZLexer
+from .decodetables import to_signed, to_unsigned
+from . import zlogging
+from .ztranslator import ZTranslator
 from .zlogging import log, log_disasm
 
 class ZCpuError(Exception):
@@ -29,9 +33,22 @@ class ZCpuDivideByZero(ZCpuError):
 class ZCpuNotImplemented(ZCpuError):
      "Opcode not yet implemented"
 
+class _ZCpuHalt(Exception):
+    "Raised internally to stop the execution loop"
+
+# Reasons for ZCpu.run() to return.
+STOPPED_LIMIT = 0   # The instruction limit was reached.
+STOPPED_INPUT = 1   # The story is waiting for input.
+STOPPED_HALT = 2    # The story quit, or hit an unimplemented opcode.
+
+# Opcodes reading input. They can suspend execution until input is
+# available, so they are never part of translated blocks.
+INPUT_OPCODES = frozenset(['op_sread', 'op_sread_v4', 'op_aread',
+                           'op_read_char'])
+
 class ZCpu(object):
     def __init__(self, zmem, zopdecoder, zstack, zobjects, zstring,
-                 zstreammanager, zui):
+                 zstreammanager, zui, zundo=None):
         self._memory = zmem
         self._opdecoder = zopdecoder
         self._stackmanager = zstack
@@ -39,59 +56,99 @@ class ZCpu(object):
         self._string = zstring
         self._streammanager = zstreammanager
         self._ui = zui
-
-    def _get_handler(self, opcode_class, opcode_number):
-        try:
-            opcode_decl = self.opcodes[opcode_class][opcode_number]
-        except IndexError:
-            opcode_decl = None
+        self._undo = zundo
+        self._dispatch = self._build_dispatch_table()
+        self._translator = None
+        self._lexer = None
+        self.instruction_count = 0
+
+        # The input instruction waiting for input, as a tuple
+        # (handler, operands, instruction shape), see _suspend().
+        self._pending_input = None
+        self._halted = False
+
+    def _resolve_opcode(self, opcode_decl):
+        """Return the function implementing the given opcode
+        declaration on the current machine version, or None if the
+        opcode is illegal on this version."""
         if not opcode_decl:
-            raise ZCpuIllegalInstruction
+            return None
 
         # If the opcode declaration is a sequence, we have extra
         # thinking to do.
         if not isinstance(opcode_decl, (list, tuple)):
-            opcode_func = opcode_decl
-        else:
-            # We have several different implementations for the
-            # opcode, and we need to select the right one based on
-            # version.
-            if isinstance(opcode_decl[0], (list, tuple)):
-                for func,version in opcode_decl:
-                    if version <= self._memory.version:
-                        opcode_func = func
-                        break
-            # Only one implementation, check that our machine is
-            # recent enough.
-            elif opcode_decl[1] <= self._memory.version:
-                opcode_func = opcode_decl[0]
-            else:
-                raise ZCpuIllegalInstruction
-
-        # The following is a hack, based on our policy of only
-        # documenting opcodes we implement. If we ever hit an
-        # undocumented opcode, we crash with a not implemented
-        # error.
-        if not opcode_func.__doc__:
-            return False, opcode_func
-        else:
-            return True, opcode_func
+            return opcode_decl
+
+        # We have several different implementations for the opcode,
+        # and we need to select the right one based on version.
+        if isinstance(opcode_decl[0], (list, tuple)):
+            for func,version in opcode_decl:
+                if version <= self._memory.version:
+                    return func
+            return None
+
+        # Only one implementation, check that our machine is recent
+        # enough.
+        if opcode_decl[1] <= self._memory.version:
+            return opcode_decl[0]
+        return None
+
+    def _build_dispatch_table(self):
+        """Compile the opcodes declaration into a flat dispatch table
+        for the version of the running story.
+
+        The table has one slot per opcode class and number, indexed by
+        (opcode_class << 8) | opcode_number. Each slot holds the bound
+        method implementing the opcode, or a trap which halts the
+        machine for illegal and unimplemented opcodes. This way, the
+        version checks are done once at boot instead of once per
+        executed instruction."""
+        table = [self._illegal_opcode] * (len(self.opcodes) << 8)
+        for opcode_class, decls in self.opcodes.items():
+            for opcode_number, opcode_decl in enumerate(decls):
+                func = self._resolve_opcode(opcode_decl)
+                if func is None:
+                    continue
+                # The following is a hack, based on our policy of only
+                # documenting opcodes we implement. If we ever hit an
+                # undocumented opcode, we stop execution.
+                if func.__doc__:
+                    handler = getattr(self, func.__name__)
+                else:
+                    handler = self._make_unimplemented_trap(func)
+                table[(opcode_class << 8) | opcode_number] = handler
+        return table
+
+    def _is_translatable(self, opcode_class, opcode_number):
+        """Return whether the given opcode can be compiled by the
+        translator, ie. whether it is neither illegal nor
+        unimplemented."""
+        handler = self._dispatch[(opcode_class << 8) | opcode_number]
+        return getattr(handler, '__self__', None) is self \
+               and handler != self._illegal_opcode \
+               and handler.__name__ not in INPUT_OPCODES
+
+    def _illegal_opcode(self, *operands):
+        """Trap for opcodes which do not exist on this machine."""
+        raise ZCpuIllegalInstruction
+
+    def _make_unimplemented_trap(self, func):
+        """Return a trap standing in for the unimplemented opcode
+        FUNC, which halts execution when reached."""
+        def trap(*operands):
+            log("Unimplemented opcode %s, halting execution", func.__name__)
+            raise _ZCpuHalt
+        trap.__name__ = func.__name__
+        return trap
 
     def _make_signed(self, a):
         """Turn the given 16-bit value into a signed integer."""
-        assert a < 2**16
-        # This is a little ugly.
-        bf = bitfield.BitField(a)
-        if bf[15]:
-            a = a - 2**16
-        return a
+        return to_signed(a)
 
     def _unmake_signed(self, a):
         """Turn the given signed integer into a 16-bit value ready for
         storage."""
-        if a < 0:
-            a = 2**16 + a
-        return a
+        return to_unsigned(a)
 
     def _read_variable(self, addr):
         """Return the value of the given variable, which can come from
@@ -116,16 +173,19 @@ class ZCpu(object):
 
         if result_addr != None:
             if result_addr == 0x0:
-                log("Push %d to stack" % result_value)
+                if zlogging.debug_enabled:
+                    log("Push %d to stack", result_value)
                 self._stackmanager.push_stack(result_value)
             elif 0x0 < result_addr < 0x10:
-                log("Local variable %d = %d" % (
-                    result_addr - 1, result_value))
+                if zlogging.debug_enabled:
+                    log("Local variable %d = %d",
+                        result_addr - 1, result_value)
                 self._stackmanager.set_local_variable(result_addr - 1,
                                                       result_value)
             else:
-                log("Global variable %d = %d" % (result_addr,
-                                                 result_value))
+                if zlogging.debug_enabled:
+                    log("Global variable %d = %d",
+                        result_addr, result_value)
                 self._memory.write_global(result_addr, result_value)
 
     def _call(self, routine_address, args, store_return_value):
@@ -149,35 +209,173 @@ class ZCpu(object):
 
         if test_result == branch_cond:
             if branch_offset == 0 or branch_offset == 1:
-                log("Return from routine with %d" % branch_offset)
+                if zlogging.debug_enabled:
+                    log("Return from routine with %d", branch_offset)
                 addr = self._stackmanager.finish_routine(branch_offset)
                 self._opdecoder.program_counter = addr
             else:
-                log("Jump to offset %+d" % branch_offset)
+                if zlogging.debug_enabled:
+                    log("Jump to offset %+d", branch_offset)
                 self._opdecoder.program_counter += (branch_offset - 2)
 
-    def run(self):
-        """The Magic Function that takes little bits and bytes, twirls
-        them around, and brings the magic to your screen!"""
-        log("Execution started")
-        while True:
-            current_pc = self._opdecoder.program_counter
-            log("Reading next opcode at address %x" % current_pc)
-            (opcode_class, opcode_number,
-             operands) = self._opdecoder.get_next_instruction()
-            implemented, func = self._get_handler(opcode_class,
-                                                  opcode_number)
+    def set_translation(self, enabled):
+        """Enable or disable the translation of Z-code into Python
+        functions (see ZTranslator). When disabled, all code is
+        interpreted."""
+        if enabled:
+            self._translator = ZTranslator(self._memory, self._opdecoder,
+                                           self._dispatch,
+                                           self._is_translatable,
+                                           _ZCpuHalt)
+        else:
+            self._translator = None
+
+    def _step(self):
+        """Interpret the instruction at the program counter."""
+        current_pc = self._opdecoder.program_counter
+        (opcode_class, opcode_number,
+         operands) = self._opdecoder.get_next_instruction()
+        func = self._dispatch[(opcode_class << 8) | opcode_number]
+        if zlogging.debug_enabled:
+            log("Reading next opcode at address %x", current_pc)
             log_disasm(current_pc, zopdecoder.OPCODE_STRINGS[opcode_class],
-                       opcode_number, func.__name__,
-                       ', '.join([str(x) for x in operands]))
-            if not implemented:
-                log("Unimplemented opcode %s, "
-                    "halting execution" % func.__name__)
-                break
+                       opcode_number, func.__name__, operands)
+        try:
+            func(*operands)
+        except zstream.ZInputNotReady:
+            self._suspend(func, operands, current_pc)
+            raise
+
+    def _suspend(self, func, operands, pc):
+        """Remember that the input instruction at PC, whose handler is
+        FUNC, is waiting for input. Its store and branch data stay
+        available through the saved instruction shape."""
+        log("Suspending execution until input is available")
+        self._pending_input = (
+            func, operands, self._opdecoder.get_current_instruction(), pc)
+
+    def _resume(self):
+        """Execute again the input instruction which suspended
+        execution. Raise ZInputNotReady if there is still no input."""
+        func, operands, current, pc = self._pending_input
+        self._opdecoder.set_current_instruction(current)
+        func(*operands)
+        self._pending_input = None
+        self.instruction_count += 1
+
+    @property
+    def waiting_for_input(self):
+        """True if execution is suspended until input is available."""
+        return self._pending_input is not None
+
+    def rewind_input(self):
+        """If execution is suspended until input is available, undo
+        the decoding of the input instruction: push back the operands
+        it popped from the stack, and point the program counter at it
+        again. The whole state of the machine is then held by its
+        memory, stacks and program counter, as in a Quetzal file, and
+        the instruction is decoded anew when execution resumes."""
+        if self._pending_input is None:
+            return
+        func, operands, current, pc = self._pending_input
+        if current[3] is not None:
+            for operand_type, variable, value in reversed(
+                    list(zip(current[3], current[2], operands))):
+                if operand_type == zopdecoder.VARIABLE and variable == 0:
+                    self._stackmanager.push_stack(value)
+        self._opdecoder.program_counter = pc
+        self._pending_input = None
+
+    def run(self, max_instructions=None):
+        """The Magic Function that takes little bits and bytes, twirls
+        them around, and brings the magic to your screen!
+
+        If MAX_INSTRUCTIONS is given, return after executing that many
+        instructions; execution can be resumed by calling run() again.
 
-            # The returned function is unbound, so we must pass
-            # self to it ourselves.
-            func(self, *operands)
+        If the story asks for input and the input stream has none yet
+        (it raises ZInputNotReady), execution is suspended and run()
+        returns. The next call to run() retries the input instruction.
+
+        Return STOPPED_LIMIT, STOPPED_INPUT or STOPPED_HALT, depending
+        on why execution stopped."""
+        log("Execution started")
+        if self._halted:
+            return STOPPED_HALT
+        # A limit of -1 is never reached, since the count starts at 0.
+        if max_instructions is None:
+            max_instructions = -1
+        if self._pending_input is not None and max_instructions != 0:
+            try:
+                self._resume()
+            except zstream.ZInputNotReady:
+                return STOPPED_INPUT
+            if max_instructions > 0:
+                max_instructions -= 1
+        if self._translator is not None:
+            return self._run_translated(max_instructions)
+        dispatch = self._dispatch
+        opdecoder = self._opdecoder
+        count = 0
+        try:
+            while count != max_instructions:
+                current_pc = opdecoder.program_counter
+                (opcode_class, opcode_number,
+                 operands) = opdecoder.get_next_instruction()
+                func = dispatch[(opcode_class << 8) | opcode_number]
+                if zlogging.debug_enabled:
+                    log("Reading next opcode at address %x", current_pc)
+                    log_disasm(current_pc,
+                               zopdecoder.OPCODE_STRINGS[opcode_class],
+                               opcode_number, func.__name__, operands)
+                func(*operands)
+                count += 1
+            return STOPPED_LIMIT
+        except zstream.ZInputNotReady:
+            self._suspend(func, operands, current_pc)
+            return STOPPED_INPUT
+        except _ZCpuHalt:
+            # The halting instruction was executed too.
+            count += 1
+            self._halted = True
+            return STOPPED_HALT
+        finally:
+            self.instruction_count += count
+
+    def _run_translated(self, max_instructions):
+        """Execution loop of the translating mode: run compiled blocks
+        of code where possible, and interpret the rest."""
+        blocks = self._translator.blocks
+        translate = self._translator.translate
+        opdecoder = self._opdecoder
+        count = 0
+        try:
+            while count != max_instructions:
+                pc = opdecoder.program_counter
+                if pc in blocks:
+                    block = blocks[pc]
+                else:
+                    block = translate(pc)
+                # Near the instruction limit, single-step so as to stop
+                # exactly on the limit.
+                if block is not None and (max_instructions < 0 or
+                        block.length <= max_instructions - count):
+                    count += block()
+                else:
+                    self._step()
+                    count += 1
+            return STOPPED_LIMIT
+        except zstream.ZInputNotReady:
+            return STOPPED_INPUT
+        except _ZCpuHalt as halt:
+            # A block which halts tells how many of its instructions
+            # ran, the halting one included; otherwise the halting
+            # instruction was single-stepped.
+            count += getattr(halt, 'instructions', 1)
+            self._halted = True
+            return STOPPED_HALT
+        finally:
+            self.instruction_count += count
 
     ##
     ## Opcode implementation functions start here.
@@ -244,17 +442,17 @@ class ZCpu(object):
         """Bitwise AND between the two arguments."""
         self._write_result(a & b)
 
-    def op_test_attr(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_test_attr(self, objectnum, attrnum):
+        """Branch if the object has the given attribute."""
+        self._branch(self._objects.get_attribute(objectnum, attrnum))
 
-    def op_set_attr(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_set_attr(self, objectnum, attrnum):
+        """Give the object the given attribute."""
+        self._objects.set_attribute(objectnum, attrnum, True)
 
-    def op_clear_attr(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_clear_attr(self, objectnum, attrnum):
+        """Take the given attribute away from the object."""
+        self._objects.set_attribute(objectnum, attrnum, False)
 
     def op_store(self, variable, value):
         """Store the given value to the given variable."""
@@ -284,13 +482,18 @@ class ZCpu(object):
         val = self._objects.get_prop(objectnum, propnum)
         self._write_result(val)
 
-    def op_get_prop_addr(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_get_prop_addr(self, objectnum, propnum):
+        """Store in the given result the address of an object's
+        property value, or 0 if the object doesn't have the
+        property."""
+        self._write_result(self._objects.get_prop_addr(objectnum, propnum))
 
-    def op_get_next_prop(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_get_next_prop(self, objectnum, propnum):
+        """Store in the given result the number of the property
+        following the given one in an object's property list (the
+        first one if the given number is 0), or 0 past the last
+        property."""
+        self._write_result(self._objects.get_next_prop(objectnum, propnum))
 
     def op_add(self, a, b):
         """Signed 16-bit addition."""
@@ -316,7 +519,11 @@ class ZCpu(object):
         b = self._make_signed(b)
         if b == 0:
             raise ZCpuDivideByZero
-        self._write_result(self._unmake_signed(a/b))
+        # Division truncates towards zero.
+        quotient = abs(a) // abs(b)
+        if (a < 0) != (b < 0):
+            quotient = -quotient
+        self._write_result(self._unmake_signed(quotient))
 
     def op_mod(self, *args):
         """TODO: Write docstring here."""
@@ -358,9 +565,10 @@ class ZCpu(object):
         self._write_result(
             self._objects.get_parent(object_num))
 
-    def op_get_prop_len(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_get_prop_len(self, addr):
+        """Store in the given result the length of the property value
+        at the given address."""
+        self._write_result(self._objects.get_prop_len(addr))
 
     def op_inc(self, variable):
         """Increment the given value."""
@@ -404,7 +612,7 @@ class ZCpu(object):
         # the offset.
         if (offset >= 2**15):
             offset = - 2**16 + offset
-        log("Jump unconditionally to relative offset %d" % offset)
+        log("Jump unconditionally to relative offset %d", offset)
 
         # Apparently reading the 2 bytes of operand *isn't* supposed
         # to increment the PC, thus we need to apply this offset to PC
@@ -412,7 +620,7 @@ class ZCpu(object):
         # modifier below.
         new_pc = self._opdecoder.program_counter + offset - 2
         self._opdecoder.program_counter = new_pc
-        log("PC has changed from from %x to %x" % (old_pc, new_pc))
+        log("PC has changed from from %x to %x", old_pc, new_pc)
 
 
     def op_print_paddr(self, string_paddr):
@@ -493,8 +701,9 @@ class ZCpu(object):
         raise ZCpuNotImplemented
 
     def op_quit(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+        """Stop the machine."""
+        log("Quit")
+        raise _ZCpuHalt
 
     def op_new_line(self, *args):
         """TODO: Write docstring here."""
@@ -533,28 +742,108 @@ class ZCpu(object):
     def op_storew(self, array, offset, value):
         """Store the given 16-bit value at array+2*byte_index."""
         store_address = array + 2*offset
-        self._memory.write_word(store_address, value)
-
-    def op_storeb(self, *args):
-        """TODO: Write docstring here."""
-
+        if store_address < 64:
+            # The game may only set some of the header fields.
+            self._memory.write_word(store_address, value)
+        else:
+            self._memory.check_writable(store_address, store_address + 2)
+            self._memory.write_word_fast(store_address, value)
+
+    def op_storeb(self, array, byte_index, value):
+        """Store the given byte value at (array+byte_index)."""
+        store_address = array + byte_index
+        if store_address < 64:
+            # The game may only set some of the header fields.
+            self._memory.game_set_header(store_address, value & 0xFF)
+        else:
+            self._memory.check_writable(store_address, store_address + 1)
+            self._memory.write_byte_fast(store_address, value & 0xFF)
 
     def op_put_prop(self, object_number, property_number, value):
         """Set an object's property to the given value."""
         self._objects.set_property(object_number, property_number, value)
 
-    def op_sread(self, *args):
-        """Not implemented yet, but documented so that the detection
-        code will be foiled."""
-
-
-    def op_sread_v4(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
-
-    def op_aread(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def _get_lexer(self):
+        """Return the lexer of the story, loading it on first use."""
+        if self._lexer is None:
+            self._lexer = ZLexer(self._memory, self._string)
+        return self._lexer
+
+    def _read_line(self, text_buffer, parse_buffer):
+        """Read a line of input into TEXT_BUFFER, in the format of the
+        machine version, and tokenise it into PARSE_BUFFER unless
+        PARSE_BUFFER is 0. Raise ZInputNotReady, before touching
+        memory, if no input is available yet."""
+        max_length = self._memory[text_buffer]
+        if self._memory.version <= 4:
+            # The buffer holds the text and a terminating zero.
+            max_length -= 1
+        text = self._ui.keyboard_input.read_line(max_length=max_length)
+        text = text.lower()[:max_length]
+
+        zscii = self._string.zscii
+        codes = []
+        for char in text:
+            try:
+                codes.append(zscii.utoz(char))
+            except IndexError:
+                codes.append(ord('?'))
+        if self._memory.version <= 4:
+            start = text_buffer + 1
+            self._memory[start:start + len(codes) + 1] = codes + [0]
+        else:
+            start = text_buffer + 2
+            self._memory[text_buffer + 1] = len(codes)
+            self._memory[start:start + len(codes)] = codes
+
+        if parse_buffer != 0:
+            self._tokenise(text, start - text_buffer, parse_buffer)
+
+    def _tokenise(self, text, text_offset, parse_buffer, dictionary=0,
+                  skip_unknown=False):
+        """Split TEXT into words and write them to PARSE_BUFFER. The
+        text starts at offset TEXT_OFFSET in its text buffer.
+        DICTIONARY is the address of the dictionary to use, or 0 for
+        the standard dictionary. If SKIP_UNKNOWN is true, leave the
+        entries of words which aren't in the dictionary untouched."""
+        tokens = self._get_lexer().tokenise_input(text, dictionary or None)
+        tokens = tokens[:self._memory[parse_buffer]]
+        if skip_unknown:
+            for index, (word_addr, length, position) in enumerate(tokens):
+                if word_addr:
+                    entry = parse_buffer + 2 + 4 * index
+                    self._memory[entry:entry + 4] = (
+                        word_addr >> 8, word_addr & 0xFF, length,
+                        position + text_offset)
+        elif tokens:
+            # Write all the entries of the parse buffer at once.
+            entries = bytearray()
+            for word_addr, length, position in tokens:
+                entries += bytes((word_addr >> 8, word_addr & 0xFF, length,
+                                  position + text_offset))
+            start = parse_buffer + 2
+            self._memory[start:start + len(entries)] = entries
+        self._memory[parse_buffer + 1] = len(tokens)
+
+    def op_sread(self, text_buffer, parse_buffer):
+        """Read a line of input from the keyboard into TEXT_BUFFER,
+        and tokenise it into PARSE_BUFFER."""
+        # The status line isn't supported by any UI yet.
+        self._read_line(text_buffer, parse_buffer)
+
+    def op_sread_v4(self, text_buffer, parse_buffer, time=0, routine=0):
+        """Read a line of input from the keyboard into TEXT_BUFFER,
+        and tokenise it into PARSE_BUFFER. Timed input is not
+        supported, TIME and ROUTINE are ignored."""
+        self._read_line(text_buffer, parse_buffer)
+
+    def op_aread(self, text_buffer, parse_buffer=0, time=0, routine=0):
+        """Read a line of input from the keyboard into TEXT_BUFFER,
+        tokenise it into PARSE_BUFFER unless it is 0, and store the
+        terminating character. Timed input is not supported, TIME and
+        ROUTINE are ignored."""
+        self._read_line(text_buffer, parse_buffer)
+        self._write_result(13)
 
     def op_print_char(self, char):
         """Output the given ZSCII character."""
@@ -574,10 +863,10 @@ class ZCpu(object):
         """
         result = 0
         if n > 0:
-            log("Generate random number in [1:%d]" % n)
+            log("Generate random number in [1:%d]", n)
             result = random.randint(1, n)
         elif n < 0:
-            log("Seed PRNG with %d" % n)
+            log("Seed PRNG with %d", n)
             random.seed(n)
         else:
             log("Seed PRNG with time")
@@ -703,9 +992,18 @@ class ZCpu(object):
         """TODO: Write docstring here."""
         raise ZCpuNotImplemented
 
-    def op_tokenize(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_tokenize(self, text_buffer, parse_buffer, dictionary=0,
+                    flag=0):
+        """Tokenise the text in TEXT_BUFFER into PARSE_BUFFER, using
+        the given DICTIONARY (or the standard one if 0). If FLAG is
+        set, words which aren't in the dictionary are left untouched
+        in the parse buffer."""
+        length = self._memory[text_buffer + 1]
+        start = text_buffer + 2
+        zscii = self._string.zscii
+        text = ''.join([zscii.ztou(code) for code in
+                        self._memory[start:start + length]])
+        self._tokenise(text, 2, parse_buffer, dictionary, bool(flag))
 
     def op_encode_text(self, *args):
         """TODO: Write docstring here."""
@@ -745,13 +1043,34 @@ class ZCpu(object):
         """TODO: Write docstring here."""
         raise ZCpuNotImplemented
 
-    def op_save_undo(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
-
-    def op_restore_undo(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_save_undo(self):
+        """Save the state of the machine in the undo buffer, and store
+        1 on success, 0 on failure, or -1 if the interpreter keeps no
+        undo buffer. When the state is restored, execution resumes
+        after this instruction, which then stores 2."""
+        if self._undo is None:
+            self._write_result(self._unmake_signed(-1))
+            return
+        store_addr = self._opdecoder.get_store_address()
+        # Save before storing the result, which may be pushed to the
+        # stack.
+        if self._undo.save(self._opdecoder.program_counter, store_addr):
+            self._write_result(1, store_addr)
+        else:
+            self._write_result(0, store_addr)
+
+    def op_restore_undo(self):
+        """Restore the state of the machine saved by the last
+        save_undo, and resume execution there. Store 0 if there is no
+        saved state."""
+        state = None
+        if self._undo is not None:
+            state = self._undo.restore()
+        if state is None:
+            self._write_result(0)
+            return
+        self._opdecoder.program_counter = state.program_counter
+        self._write_result(2, state.store_addr)
 
     def op_print_unicode(self, *args):
         """TODO: Write docstring here."""
@@ -7,6 +7,7 @@
 #
 
 import re
+from .decodetables import to_signed
 from .zstring import ZStringFactory, ZsciiTranslator
 
 class ZLexerError(Exception):
@@ -24,19 +25,97 @@ class ZLexerError(Exception):
 # Note that the main API here (tokenise_input()) can work with any
 # dictionary, not just the standard one.
 
+# Loaded dictionaries are kept, by address, so that each is decoded
+# only once.  Dictionaries in static memory never change, and are
+# shared by all the lexers of machines running the same story image
+# (see zstoryimage), so that a server hosting many sessions of a story
+# decodes its standard dictionary once.  Dictionaries in dynamic
+# memory belong to their machine, and are dropped when their bytes
+# are written to.
+
+
+class ZTokenizer(object):
+  """A tokenizer splitting strings into words, and into the word
+  separators of a dictionary."""
+
+  def __init__(self, separators):
+    """Create a tokenizer for the unicode characters of SEPARATORS.
+    Whitespace always separates words too."""
+
+    self.separators = frozenset(separators)
+    if self.separators:
+      # Separators like ']', '-' or '^' have a meaning in character
+      # classes, and must be escaped.
+      sep_class = "".join(re.escape(sep) for sep in sorted(self.separators))
+      self.regex = re.compile(r"[%s]|\w+" % sep_class)
+    else:
+      self.regex = re.compile(r"\w+")
+
+  def tokenise(self, string):
+    """Split STRING into words. Return a list of (word, position,
+    length) tuples, POSITION being the offset of the word in
+    STRING."""
+
+    return [(match.group(), match.start(), match.end() - match.start())
+            for match in self.regex.finditer(string)]
+
+  def words(self, string):
+    """Split STRING into words, and return the list of words."""
+
+    return self.regex.findall(string)
+
+
+class ZDictionary(object):
+  """A dictionary loaded from memory."""
+
+  def __init__(self, address, zseparators, separators, entry_length,
+               words, end):
+    """Create a dictionary loaded from ADDRESS, up to END. ZSEPARATORS
+    and SEPARATORS are its word separators, as zscii codes and as
+    unicode characters, and WORDS maps its unicode words to the
+    addresses of their entries, which are ENTRY_LENGTH bytes long."""
+
+    self.address = address
+    self.zseparators = zseparators
+    self.separators = separators
+    self.entry_length = entry_length
+    self.words = words
+    self.end = end
+    self.tokenizer = ZTokenizer(separators)
+
+
 class ZLexer(object):
 
-  def __init__(self, mem):
+  def __init__(self, mem, stringfactory=None):
+    """Create a lexer for the story in MEM, decoding dictionary words
+    with STRINGFACTORY, or with a factory of its own if None."""
 
     self._memory = mem
-    self._stringfactory = ZStringFactory(self._memory)
+    if stringfactory is None:
+      stringfactory = ZStringFactory(self._memory)
+    self._stringfactory = stringfactory
     self._zsciitranslator = ZsciiTranslator(self._memory)
 
+    # Dictionaries loaded by this lexer, by address, and those shared
+    # with other machines running the story.
+    self._dictionaries = {}
+    if mem.image is not None:
+      self._shared_dictionaries = mem.image.dictionaries
+    else:
+      self._shared_dictionaries = None
+    self._observing_writes = False
+
     # Load and parse game's 'standard' dictionary from static memory.
-    dict_addr = self._memory.read_word(0x08)
+    self._dict_addr = self._memory.read_word(0x08)
     self._num_entries, self._entry_length, self._separators, entries_addr = \
-                       self._parse_dict_header(dict_addr)
-    self._dict = self.get_dictionary(dict_addr)
+                       self._parse_dict_header(self._dict_addr)
+    self._dict = self._get_dictionary(self._dict_addr).words
+
+    # Dictionary words are truncated to this many characters.
+    if self._memory.version <= 3:
+      self._resolution = 6
+    else:
+      self._resolution = 9
 
 
   def _parse_dict_header(self, address):
@@ -46,33 +125,65 @@ class ZLexer(object):
 
     addr = address
     num_separators = self._memory[addr]
-    separators = self._memory[(addr + 1):(addr + num_separators)]
+    separators = self._memory[(addr + 1):(addr + 1 + num_separators)]
     addr += (1 + num_separators)
     entry_length = self._memory[addr]
     addr += 1
-    num_entries = self._memory.read_word(addr)
+    # A negative number of entries means that the entries aren't
+    # sorted, which doesn't matter here.
+    num_entries = abs(to_signed(self._memory.read_word(addr)))
     addr += 2
 
     return num_entries, entry_length, separators, addr
 
 
-  def _tokenise_string(self, string, separators):
-     """Split unicode STRING into a list of words, and return the list.
-    Whitespace always counts as a word separator, but so do any
-    unicode characters provided in the list of SEPARATORS.  Note,
-    however, that instances of these separators caunt as words
-    themselves."""
+  def _load_dictionary(self, address):
+    """Decode the dictionary at ADDRESS, and return it as a
+    ZDictionary."""
 
-     # re.findall(r'[,.;]|\w+', 'abc, def')
-     sep_string = ""
-     for sep in separators:
-       sep_string += sep
-     if sep_string == "":
-       regex = r"\w+"
-     else:
-       regex = r"[%s]|\w+" % sep_string
+    num_entries, entry_length, zseparators, addr = \
+                 self._parse_dict_header(address)
 
-     return re.findall(regex, string)
+    # Our list of word separators are actually zscii codes that must
+    # be converted to unicode before we can use them.
+    separators = [self._zsciitranslator.ztou(code) for code in zseparators]
+
+    addresses = range(addr, addr + num_entries * entry_length, entry_length)
+    words = self._stringfactory.get_many(addresses, cache=False)
+    return ZDictionary(address, list(zseparators), separators, entry_length,
+                       dict(zip(words, addresses)),
+                       addr + num_entries * entry_length)
+
+
+  def _get_dictionary(self, address):
+    """Return the ZDictionary at ADDRESS, loading it on first use."""
+
+    dictionary = self._dictionaries.get(address)
+    if dictionary is not None:
+      return dictionary
+
+    static = address > self._memory._dynamic_end
+    if static and self._shared_dictionaries is not None:
+      dictionary = self._shared_dictionaries.get(address)
+    if dictionary is None:
+      dictionary = self._load_dictionary(address)
+      if static and self._shared_dictionaries is not None:
+        dictionary = self._shared_dictionaries.setdefault(address,
+                                                          dictionary)
+    if not static and not self._observing_writes:
+      self._memory.add_write_observer(self._on_memory_write)
+      self._observing_writes = True
+    self._dictionaries[address] = dictionary
+    return dictionary
+
+
+  def _on_memory_write(self, start, end):
+    """Drop the loaded dictionaries overlapping the written range."""
+
+    stale = [address for address, dictionary in self._dictionaries.items()
+             if address < end and start < dictionary.end]
+    for address in stale:
+      del self._dictionaries[address]
 
 
   #--------- Public APIs -----------
@@ -84,17 +195,7 @@ class ZLexer(object):
     unicode strings to the address of the word in the original
     dictionary.  Return the new dictionary."""
 
-    dict = {}
-
-    num_entries, entry_length, separators, addr = \
-                 self._parse_dict_header(address)
-
-    for i in range(0, num_entries):
-      text_key = self._stringfactory.get(addr)
-      dict[text_key] = addr
-      addr += entry_length
-
-    return dict
+    return dict(self._get_dictionary(address).words)
 
 
   def parse_input(self, string, dict_addr=None):
@@ -114,27 +215,30 @@ class ZLexer(object):
     """
 
     if dict_addr is None:
-      zseparators = self._separators
-      dict = self._dict
-    else:
-      num_entries, entry_length, zseparators, addr = \
-                   self._parse_dict_header(dict_addr)
-      dict = self.get_dictionary(dict_addr)
+      dict_addr = self._dict_addr
+    dictionary = self._get_dictionary(dict_addr)
 
-    # Our list of word separators are actually zscii codes that must
-    # be converted to unicode before we can use them.
-    separators = []
-    for code in zseparators:
-      separators.append(self._zsciitranslator.ztou(code))
+    words = dictionary.words
+    resolution = self._resolution
+    return [[word, words.get(word[:resolution], 0)]
+            for word in dictionary.tokenizer.words(string)]
 
-    token_list = self._tokenise_string(string, separators)
 
-    final_list = []
-    for word in token_list:
-      if word in dict:
-        byte_addr = dict[word]
-      else:
-        byte_addr = 0
-      final_list.append([word, byte_addr])
+  def tokenise_input(self, string, dict_addr=None):
+    """Split the unicode STRING into words, and look them up in the
+    dictionary at DICT_ADDR, or in the standard dictionary if None.
 
-    return final_list
+    Return a list of (byte_address_of_word_in_dictionary (or 0 if not
+    in dictionary), length, position) tuples, in the order of the
+    entries of a parse buffer. POSITION is the offset of the word in
+    STRING."""
+
+    if dict_addr is None:
+      dict_addr = self._dict_addr
+    dictionary = self._get_dictionary(dict_addr)
+
+    words = dictionary.words
+    resolution = self._resolution
+    return [(words.get(word[:resolution], 0), length, position)
+            for word, position, length
+            in dictionary.tokenizer.tokenise(string)]
@@ -4,41 +4,71 @@
 # dumping is no longer adequate. This logging facility, based on
 # python's logging module, provides file logging.
 #
+# Logging is off by default, and costs next to nothing while it is
+# off: the log files are only created when debugging is turned on, and
+# messages are only formatted when they are actually written.  Code on
+# the hot paths of the interpreter should additionally test
+# debug_enabled before calling log(), so that not even the arguments
+# of the message are computed.
+#
 
 import logging
 
-# Top-level initialization
-logging.getLogger().setLevel(logging.DEBUG)
+mainlog = logging.getLogger('mainlog')
+disasm = logging.getLogger('disasm')
 
-# Create the logging objects regardless.  If debugmode is False, then
-# they won't actually do anything when used.
-mainlog = logging.FileHandler('debug.log', 'a')
-mainlog.setLevel(logging.DEBUG)
-mainlog.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
-logging.getLogger('mainlog').addHandler(mainlog)
+# Keep the messages of the Z-Machine out of the root logger.
+mainlog.propagate = False
+disasm.propagate = False
+mainlog.setLevel(logging.CRITICAL)
+disasm.setLevel(logging.CRITICAL)
 
-# We'll store the disassembly in a separate file, for better
-# readability.
-disasm = logging.FileHandler('disasm.log', 'a')
-disasm.setLevel(logging.DEBUG)
-disasm.setFormatter(logging.Formatter('%(message)s'))
-logging.getLogger('disasm').addHandler(disasm)
+# True when debug logging is on.
+debug_enabled = False
 
-mainlog = logging.getLogger('mainlog')
-mainlog.info('*** Log reopened ***')
-disasm = logging.getLogger('disasm')
-disasm.info('*** Log reopened ***')
+_handlers_installed = False
+
+def _install_handlers():
+  """Attach the file handlers to the loggers. The files themselves
+  are only opened when the first message is written to them."""
+  global _handlers_installed
+  if _handlers_installed:
+    return
+  handler = logging.FileHandler('debug.log', 'a', delay=True)
+  handler.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
+  mainlog.addHandler(handler)
+
+  # We'll store the disassembly in a separate file, for better
+  # readability.
+  handler = logging.FileHandler('disasm.log', 'a', delay=True)
+  handler.setFormatter(logging.Formatter('%(message)s'))
+  disasm.addHandler(handler)
+  _handlers_installed = True
+
+  mainlog.info('*** Log reopened ***')
+  disasm.info('*** Log reopened ***')
 
 # Pubilc routines used by other modules
 def set_debug(state):
-  if state:
-    logging.getLogger().setLevel(logging.DEBUG)
+  global debug_enabled
+  debug_enabled = bool(state)
+  if debug_enabled:
+    mainlog.setLevel(logging.DEBUG)
+    disasm.setLevel(logging.DEBUG)
+    _install_handlers()
   else:
-    logging.getLogger().setLevel(logging.CRITICAL)
+    mainlog.setLevel(logging.CRITICAL)
+    disasm.setLevel(logging.CRITICAL)
 
-def log(msg):
-  mainlog.debug(msg)
+def log(msg, *args):
+  """Log MSG, formatted with ARGS if there are any. The formatting
+  only happens if debug logging is on."""
+  if debug_enabled:
+    mainlog.debug(msg, *args)
 
-def log_disasm(pc, opcode_type, opcode_num, opcode_name, args):
-  disasm.debug("%06x  %s:%02x %s %s" % (pc, opcode_type, opcode_num,
-                                        opcode_name, args))
+def log_disasm(pc, opcode_type, opcode_num, opcode_name, operands):
+  """Log the disassembly of the instruction at PC, with the given
+  sequence of OPERANDS."""
+  if debug_enabled:
+    disasm.debug("%06x  %s:%02x %s %s", pc, opcode_type, opcode_num,
+                 opcode_name, ', '.join([str(x) for x in operands]))
@@ -7,11 +7,13 @@
 
 from .zstring import ZStringFactory
 from .zmemory import ZMemory
+from .zstoryimage import ZStoryImage
 from .zopdecoder import ZOpDecoder
 from .zstackmanager import ZStackManager
 from .zobjectparser import ZObjectParser
 from .zcpu import ZCpu
 from .zstreammanager import ZStreamManager
+from .zundo import ZUndoBuffer, DEFAULT_LEVELS, DEFAULT_BUDGET
 from . import zlogging
 
 class ZMachineError(Exception):
@@ -20,22 +22,58 @@ class ZMachineError(Exception):
 class ZMachine(object):
   """The Z-Machine black box."""
 
-  def __init__(self, story, ui, debugmode=False):
+  def __init__(self, story, ui, debugmode=False, translate=False,
+               undo_levels=DEFAULT_LEVELS, undo_budget=DEFAULT_BUDGET):
+    """Create a machine running STORY, the contents of a story file
+    or a ZStoryImage. Machines created on the same ZStoryImage share
+    the memory holding the story (see zstoryimage); a machine created
+    on the contents of a story file has a private copy of it.
+
+    The machine keeps up to UNDO_LEVELS states saved by the story for
+    undo, holding up to UNDO_BUDGET bytes (see zundo). With no levels,
+    the machine tells the story it cannot undo."""
     zlogging.set_debug(debugmode)
-    self._pristine_mem = ZMemory(story) # the original memory image
+    self._pristine_mem = story # the original memory image, read-only
     self._mem = ZMemory(story) # the memory image which changes during play
     self._stringfactory = ZStringFactory(self._mem)
-    self._objectparser = ZObjectParser(self._mem)
+    if isinstance(story, ZStoryImage) and story.strings is not None:
+      self._stringfactory.preload(story.strings)
+    self._objectparser = ZObjectParser(self._mem, self._stringfactory)
     self._stackmanager = ZStackManager(self._mem)
     self._opdecoder = ZOpDecoder(self._mem, self._stackmanager)
     self._opdecoder.program_counter = self._mem.read_word(0x06)
     self._ui = ui
     self._stream_manager = ZStreamManager(self._mem, self._ui)
+    if undo_levels > 0:
+      self._undo = ZUndoBuffer(self._mem, self._stackmanager,
+                               undo_levels, undo_budget)
+    else:
+      self._undo = None
     self._cpu = ZCpu(self._mem, self._opdecoder, self._stackmanager,
                      self._objectparser, self._stringfactory,
-                     self._stream_manager, self._ui)
+                     self._stream_manager, self._ui, self._undo)
+    self._cpu.set_translation(translate)
+    self._debugmode = debugmode
+    if debugmode:
+      # Catch writes to static memory through the unchecked APIs.
+      self._mem.snapshot_static()
 
   #--------- Public APIs -----------
 
-  def run(self):
-    return self._cpu.run()
+  def run(self, max_instructions=None):
+    try:
+      return self._cpu.run(max_instructions)
+    finally:
+      if self._debugmode:
+        self._mem.verify_static()
+
+  @property
+  def instruction_count(self):
+    """Number of instructions executed by the machine so far."""
+    return self._cpu.instruction_count
+
+  def rewind_input(self):
+    """If the machine is waiting for input, point it back at its input
+    instruction, so that its whole state can be saved (see
+    ZCpu.rewind_input)."""
+    self._cpu.rewind_input()
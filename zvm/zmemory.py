@@ -5,8 +5,12 @@
 # root directory of this distribution.
 #
 
-from . import bitfield
+import re
+import struct
+
+from . import zlogging
 from .zlogging import log
+from .zstoryimage import ZStoryImage
 
 # This class that represents the "main memory" of the z-machine.  It's
 # readable and writable through normal indexing and slice notation,
@@ -14,7 +18,30 @@ from .zlogging import log
 # mem[22:90]).  The class validates memory layout, enforces read-only
 # areas of memory, and also the ability to return both word-addresses
 # and 'packed' addresses.
+#
+# The checked API above validates every access, which is too slow for
+# the code reading memory on every executed instruction.  For such
+# trusted callers, ZMemory also exposes the raw bytearray of memory,
+# along with byte and word accessors which do no checking at all (see the
+# fast-path APIs below).  Code using them validates its ranges once,
+# with check_readable() and check_writable(), instead of on every
+# access.  In debug mode, any write to static memory that slips
+# through is caught by comparing static memory with a snapshot.
+#
+# ZMemory also keeps track of the pages of memory written to since the
+# dirty map was last cleared, so that checkpoints of a running game
+# only need to look at, and save, what changed.  The dirty map holds
+# one byte per page, set to 1 by every write API, including the
+# unchecked ones.  Code writing to the raw buffer directly must mark
+# what it writes with mark_dirty().
 
+# Big-endian 16-bit words.
+_WORD = struct.Struct('>H')
+
+# Default size, in bytes, of the pages of the dirty map.
+DEFAULT_PAGE_SIZE = 256
+
+_DIRTY_RUNS = re.compile(b"\x01+")
 
 class ZMemoryError(Exception):
   "General exception for ZMemory class"
@@ -76,15 +103,30 @@ class ZMemory(object):
                   None, None, None, None,
                   None, None, None, None)
 
-  def __init__(self, initial_string):
+  def __init__(self, initial_string, page_size=DEFAULT_PAGE_SIZE):
     """Construct class based on a string that represents an initial
-    'snapshot' of main memory."""
+    'snapshot' of main memory, or on a ZStoryImage. Memories built on
+    the same ZStoryImage share the parts of the story they don't
+    modify. Writes are tracked by pages of PAGE_SIZE bytes, a power
+    of two."""
     if initial_string is None:
       raise ZMemoryBadInitialization
+    if page_size < 1 or page_size & (page_size - 1):
+      raise ZMemoryBadInitialization
 
     # Copy string into a _memory sequence that represents main memory.
     self._total_size = len(initial_string)
-    self._memory = bytearray(initial_string)
+    if isinstance(initial_string, ZStoryImage):
+      self._memory = initial_string.new_memory()
+      self.image = initial_string
+    else:
+      self._memory = bytearray(initial_string)
+      self.image = None
+
+    # Unchecked view of memory for trusted callers: a bytearray, or a
+    # copy-on-write mmap of the story. Never resize it.
+    self.raw = self._memory
+    self._static_snapshot = None
 
     # Figure out the different sections of memory
     self._static_start = self.read_word(0x0e)
@@ -95,6 +137,21 @@ class ZMemory(object):
     self._high_end = self._total_size
     self._global_variable_start = self.read_word(0x0c)
 
+    # Callbacks interested in writes to memory, see add_write_observer().
+    self._write_observers = []
+
+    # The dirty map, one byte per page, see dirty_pages().
+    self.page_size = page_size
+    self._page_shift = page_size.bit_length() - 1
+    self.page_count = (self._total_size + page_size - 1) >> self._page_shift
+    self._dirty = bytearray(self.page_count)
+
+    # The fast-path global accessors rely on the 240 globals being
+    # in dynamic memory.
+    if not (0x40 <= self._global_variable_start
+            and self._global_variable_start + 480 <= self._static_start):
+      raise ZMemoryBadMemoryLayout
+
     # Dynamic + static must not exceed 64k
     dynamic_plus_static = ((self._dynamic_end - self._dynamic_start)
                            + (self._static_end - self._static_start))
@@ -115,10 +172,10 @@ class ZMemory(object):
       raise ZMemoryUnsupportedVersion
 
     log("Memory system initialized, map follows")
-    log("  Dynamic memory: %x - %x" % (self._dynamic_start, self._dynamic_end))
-    log("  Static memory: %x - %x" % (self._static_start, self._static_end))
-    log("  High memory: %x - %x" % (self._high_start, self._high_end))
-    log("  Global variable start: %x" % self._global_variable_start)
+    log("  Dynamic memory: %x - %x", self._dynamic_start, self._dynamic_end)
+    log("  Static memory: %x - %x", self._static_start, self._static_end)
+    log("  High memory: %x - %x", self._high_start, self._high_end)
+    log("  Global variable start: %x", self._global_variable_start)
 
   def _check_bounds(self, index):
     if isinstance(index, slice):
@@ -146,6 +203,19 @@ class ZMemory(object):
     print(" Static memory: ", self._static_start, "-", self._static_end)
     print("   High memory: ", self._high_start, "-", self._high_end)
 
+  # Bounds of dynamic memory, the only part of memory the game can
+  # change.
+
+  @property
+  def dynamic_start(self):
+    """Address of the first byte of dynamic memory."""
+    return self._dynamic_start
+
+  @property
+  def dynamic_end(self):
+    """Address of the last byte of dynamic memory."""
+    return self._dynamic_end
+
   def __getitem__(self, index):
     """Return the byte value stored at address INDEX.."""
     self._check_bounds(index)
@@ -155,7 +225,18 @@ class ZMemory(object):
     """Set VALUE in memory address INDEX."""
     self._check_bounds(index)
     self._check_static(index)
+    if isinstance(index, slice):
+      # mmap'd memory only takes bytes-like values.
+      value = bytes(value)
     self._memory[index] = value
+    if isinstance(index, slice):
+      self.mark_dirty(index.start, index.stop)
+      if self._write_observers:
+        self._notify_write(index.start, index.stop)
+    else:
+      self._dirty[index >> self._page_shift] = 1
+      if self._write_observers:
+        self._notify_write(index, index + 1)
 
   def __getslice__(self, start, end):
     """Return a sequence of bytes from memory."""
@@ -169,7 +250,10 @@ class ZMemory(object):
     self._check_bounds(end - 1)
     self._check_static(start)
     self._check_static(end - 1)
-    self._memory[start:end] = sequence
+    self._memory[start:end] = bytes(sequence)
+    self.mark_dirty(start, end)
+    if self._write_observers:
+      self._notify_write(start, end)
 
   def word_address(self, address):
     """Return the 'actual' address of word address ADDRESS."""
@@ -211,6 +295,10 @@ class ZMemory(object):
     else:
       self._memory[address] = value_msb
       self._memory[address+1] = value_lsb
+      self._dirty[address >> self._page_shift] = 1
+      self._dirty[(address + 1) >> self._page_shift] = 1
+      if self._write_observers:
+        self._notify_write(address, address + 2)
 
   # Normal sequence syntax cannot be used to set bytes in the 64-byte
   # header.  Instead, the interpreter or game must call one of the
@@ -225,6 +313,9 @@ class ZMemory(object):
       raise ZMemoryIllegalWrite(address)
     if self.version >= perm_tuple[0] and perm_tuple[2]:
       self._memory[address] = value
+      self._dirty[address >> self._page_shift] = 1
+      if self._write_observers:
+        self._notify_write(address, address + 1)
     else:
       raise ZMemoryIllegalWrite(address)
 
@@ -237,6 +328,9 @@ class ZMemory(object):
       raise ZMemoryIllegalWrite(address)
     if self.version >= perm_tuple[0] and perm_tuple[1]:
       self._memory[address] = value
+      self._dirty[address >> self._page_shift] = 1
+      if self._write_observers:
+        self._notify_write(address, address + 1)
     else:
       raise ZMemoryIllegalWrite(address)
 
@@ -258,11 +352,139 @@ class ZMemory(object):
       raise ZMemoryOutOfBounds
     if not (0x00 <= value <= 0xFFFF):
       raise ZMemoryIllegalWrite(value)
-    log("Write %d to global variable %d" % (value, varnum))
+    if zlogging.debug_enabled:
+      log("Write %d to global variable %d", value, varnum)
     actual_address = self._global_variable_start + ((varnum - 0x10) * 2)
-    bf = bitfield.BitField(value)
-    self._memory[actual_address] = bf[8:15]
-    self._memory[actual_address + 1] = bf[0:7]
+    self._memory[actual_address] = value >> 8
+    self._memory[actual_address + 1] = value & 0xFF
+    self._dirty[actual_address >> self._page_shift] = 1
+    self._dirty[(actual_address + 1) >> self._page_shift] = 1
+    if self._write_observers:
+      self._notify_write(actual_address, actual_address + 2)
+
+  #--------- Fast-path APIs -----------
+  #
+  # These do no bounds or write-protection checks.  Callers are
+  # expected to validate their ranges beforehand.
+
+  def read_word_fast(self, address):
+    """Return the 16-bit value stored at ADDRESS, ADDRESS+1, without
+    any checks."""
+    return _WORD.unpack_from(self._memory, address)[0]
+
+  def write_word_fast(self, address, value):
+    """Write the 16-bit VALUE at ADDRESS, ADDRESS+1, without any
+    checks. Write observers are still notified."""
+    _WORD.pack_into(self._memory, address, value)
+    self._dirty[address >> self._page_shift] = 1
+    self._dirty[(address + 1) >> self._page_shift] = 1
+    if self._write_observers:
+      self._notify_write(address, address + 2)
+
+  def write_byte_fast(self, address, value):
+    """Write the byte VALUE at ADDRESS, without any checks. Write
+    observers are still notified."""
+    self._memory[address] = value
+    self._dirty[address >> self._page_shift] = 1
+    if self._write_observers:
+      self._notify_write(address, address + 1)
+
+  def read_global_fast(self, varnum):
+    """Return the value of global variable VARNUM, which must be
+    between 0x10 and 0xFF, without any checks."""
+    return _WORD.unpack_from(
+      self._memory, self._global_variable_start + ((varnum - 0x10) * 2))[0]
+
+  def check_readable(self, start, end):
+    """Raise ZMemoryOutOfBounds unless addresses START up to (but not
+    including) END are all in memory."""
+    if not (0 <= start <= end <= self._total_size):
+      raise ZMemoryOutOfBounds
+
+  def check_writable(self, start, end):
+    """Raise an exception unless addresses START up to (but not
+    including) END may all be written to by the game, ie. are in
+    dynamic memory, past the header."""
+    self.check_readable(start, end)
+    if start < 64 or end > self._static_start:
+      raise ZMemoryIllegalWrite(start)
+
+  def snapshot_static(self):
+    """Remember the contents of static memory, for verify_static()."""
+    self._static_snapshot = bytes(
+      self._memory[self._static_start:self._static_end])
+
+  def verify_static(self):
+    """Raise ZMemoryIllegalWrite if static memory changed since the
+    last call to snapshot_static()."""
+    if self._static_snapshot is None:
+      return
+    current = self._memory[self._static_start:self._static_end]
+    if current != self._static_snapshot:
+      for offset, byte in enumerate(self._static_snapshot):
+        if current[offset] != byte:
+          raise ZMemoryIllegalWrite(self._static_start + offset)
+
+  # Caches built on top of memory (decoded instructions, strings,
+  # objects...) need to know when the bytes they were built from
+  # change.  They register an observer, which is called after every
+  # write with the range of addresses that was written.
+
+  def add_write_observer(self, callback):
+    """Call CALLBACK(start, end) after every write to memory, with the
+    written addresses being START up to (but not including) END."""
+    self._write_observers.append(callback)
+
+  def remove_write_observer(self, callback):
+    """Stop calling CALLBACK on memory writes."""
+    self._write_observers.remove(callback)
+
+  def _notify_write(self, start, end):
+    for callback in self._write_observers:
+      callback(start, end)
+
+  # The dirty map.  It has a single owner, which clears it once it has
+  # dealt with the pages written so far (for instance, by saving them
+  # in a checkpoint).
+
+  def mark_dirty(self, start, end):
+    """Mark the pages holding addresses START up to (but not
+    including) END as written to."""
+    if start >= end:
+      return
+    first = start >> self._page_shift
+    last = (end - 1) >> self._page_shift
+    self._dirty[first:last + 1] = b"\x01" * (last + 1 - first)
+
+  def dirty_pages(self):
+    """Return the sorted list of the numbers of the pages written to
+    since the dirty map was last cleared. Page N holds the addresses
+    from N * page_size up to (N + 1) * page_size."""
+    return [page for run in _DIRTY_RUNS.finditer(self._dirty)
+            for page in range(run.start(), run.end())]
+
+  def is_dirty(self, start, end):
+    """Return whether any of the addresses START up to (but not
+    including) END was written to since the dirty map was last
+    cleared."""
+    if start >= end:
+      return False
+    first = start >> self._page_shift
+    last = (end - 1) >> self._page_shift
+    return 1 in self._dirty[first:last + 1]
+
+  def clear_dirty(self):
+    """Mark all pages as clean."""
+    self._dirty[:] = bytes(len(self._dirty))
+
+  def export_dirty(self):
+    """Return the contents of the pages written to since the dirty
+    map was last cleared, as a list of (address, bytes) tuples, one
+    per run of consecutive dirty pages."""
+    shift = self._page_shift
+    return [(run.start() << shift,
+             bytes(self._memory[run.start() << shift:run.end() << shift]))
+            for run in _DIRTY_RUNS.finditer(self._dirty)]
 
   # The 'verify' opcode and the QueztalWriter class both need to have
   # a checksum of memory generated.
@@ -270,9 +492,4 @@ class ZMemory(object):
   def generate_checksum(self):
     """Return a checksum value which represents all the bytes of
     memory added from $0040 upwards, modulo $10000."""
-    count = 0x40
-    total = 0
-    while count < self._total_size:
-      total += self._memory[count]
-      count += 1
-    return (total % 0x10000)
+    return sum(self._memory[0x40:self._total_size]) % 0x10000
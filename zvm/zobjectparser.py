@@ -12,10 +12,42 @@
 # siblings.  Specifically, each object contains a pointer to a parent,
 # a pointer to its "next sibling" in the list, and a pointer to the
 # head of its own children-list.
+#
+# Parsers walk that tree all the time, so the parser keeps a copy of
+# the object table: arrays of the parent, sibling, child and property
+# table address of each object, and of its attributes as an integer
+# bitset (attribute 0 being the most significant bit).  The copy is
+# built when the parser is created.  The parser's own writes update
+# it along with memory, and other writes to the object table (by the
+# game's storeb and storew, or when restoring a saved game) are caught
+# by a memory write observer, which reloads the objects written to.
+# Objects beyond those counted by count_objects() aren't cached, and
+# are read from memory directly.
+#
+# The property lists of objects are indexed too, on first use: each
+# index maps the property numbers of an object to the address and
+# size of their values.  Values can change freely, but writes to the
+# bytes giving the layout of a property list (the length of the short
+# name, the size bytes of properties and the terminating zero) drop
+# the index of the object, as does a change of its property table
+# address.
+#
+# Attributes are also exposed as integer bitmasks, for tools scanning
+# the attributes of all objects at once.  These bulk queries are
+# vectorized with NumPy when it is installed.
+
+import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
-from .bitfield import BitField
+from .decodetables import PROPERTY_SIZES_V3, PROPERTY_SIZES_V4
+from .decodetables import PROPERTY_LONG_SIZES
 from .zmemory import ZMemory
 from .zstring import ZStringFactory
+from . import zlogging
 from .zlogging import log
 
 
@@ -56,19 +88,199 @@ class ZObjectMalformedTree(ZObjectError):
 
 class ZObjectParser(object):
 
-  def __init__(self, zmem):
+  def __init__(self, zmem, stringfactory=None):
+    """Create a parser of the objects in ZMEM, decoding their names
+    with STRINGFACTORY, or with a factory of its own if None."""
 
     self._memory = zmem
     self._propdefaults_addr = zmem.read_word(0x0a)
-    self._stringfactory = ZStringFactory(self._memory)
+    if stringfactory is None:
+      stringfactory = ZStringFactory(self._memory)
+    self._stringfactory = stringfactory
 
     if 1 <= self._memory.version <= 3:
       self._objecttree_addr = self._propdefaults_addr + 62
+      self._entry_size = 9
+      self._num_attributes = 32
     elif 4 <= self._memory.version <= 5:
       self._objecttree_addr = self._propdefaults_addr + 126
+      self._entry_size = 14
+      self._num_attributes = 48
+    else:
+      raise ZObjectIllegalVersion
+
+    self._load_tree()
+    self._memory.add_write_observer(self._on_memory_write)
+
+  def _load_tree(self):
+    """Build the cached copy of the object table."""
+
+    self._num_objects = self.count_objects()
+    self._objecttree_end = (self._objecttree_addr
+                            + self._entry_size * self._num_objects)
+    # Set while the parser writes to the object table itself, and
+    # updates its copy on its own.
+    self._writing = False
+    size = self._num_objects + 1   # Object numbers start at 1.
+    self._parents = array.array('H', bytes(2 * size))
+    self._siblings = array.array('H', bytes(2 * size))
+    self._children = array.array('H', bytes(2 * size))
+    self._proptables = array.array('H', bytes(2 * size))
+    self._attributes = [0] * size
+    # Indexes of property lists, by object number, see
+    # _get_property_index(). The addresses of the layout bytes of
+    # indexed property lists are mapped to the objects they belong to,
+    # within the range of addresses _property_range.
+    self._property_indexes = {}
+    self._property_headers = {}
+    self._property_range = (0, 0)
+    for objectnum in range(1, size):
+      self._load_object(objectnum)
+
+  def _load_object(self, objectnum):
+    """Copy the entry of object OBJECTNUM from memory."""
+
+    memory = self._memory.raw
+    addr = self._objecttree_addr + self._entry_size * (objectnum - 1)
+    if self._memory.version <= 3:
+      self._attributes[objectnum] = int.from_bytes(memory[addr:addr+4],
+                                                   'big')
+      self._parents[objectnum] = memory[addr + 4]
+      self._siblings[objectnum] = memory[addr + 5]
+      self._children[objectnum] = memory[addr + 6]
+      addr += 7
+    else:
+      self._attributes[objectnum] = int.from_bytes(memory[addr:addr+6],
+                                                   'big')
+      self._parents[objectnum] = (memory[addr + 6] << 8) | memory[addr + 7]
+      self._siblings[objectnum] = (memory[addr + 8] << 8) | memory[addr + 9]
+      self._children[objectnum] = (memory[addr + 10] << 8) | memory[addr + 11]
+      addr += 12
+    proptable = (memory[addr] << 8) | memory[addr + 1]
+    if proptable != self._proptables[objectnum]:
+      self._proptables[objectnum] = proptable
+      self._forget_properties(objectnum)
+
+  def _on_memory_write(self, start, end):
+    """Reload the cached objects overlapping the written range, and
+    drop the property indexes whose layout it overlaps."""
+
+    if self._writing:
+      return
+    if start < self._objecttree_end and end > self._objecttree_addr:
+      first = max(start - self._objecttree_addr, 0) // self._entry_size
+      last = (min(end, self._objecttree_end) - 1
+              - self._objecttree_addr) // self._entry_size
+      for objectnum in range(first + 1, last + 2):
+        self._load_object(objectnum)
+    low, high = self._property_range
+    if start < high and end > low:
+      headers = self._property_headers
+      if end - start > len(headers):
+        stale = [objectnums for addr, objectnums in headers.items()
+                 if start <= addr < end]
+      else:
+        stale = [headers[addr] for addr in range(start, end)
+                 if addr in headers]
+      for objectnums in stale:
+        for objectnum in list(objectnums):
+          self._forget_properties(objectnum)
+
+  def _read_properties(self, objectnum):
+    """Return a dictionary mapping the numbers of the properties
+    listed in the property table of object OBJECTNUM, in the order of
+    the table, to (addr, len) propval tuples. Also return the list of
+    addresses of the bytes giving the layout of the table."""
+
+    proplist = {}
+
+    # start at the beginning of the object's proptable
+    addr = self._get_proptable_addr(objectnum)
+    headers = [addr]
+    # skip past the shortname of the object
+    shortname_length = self._memory[addr]
+    addr += 1
+    addr += (2*shortname_length)
+
+    if 1 <= self._memory.version <= 3:
+      while self._memory[addr] != 0:
+        headers.append(addr)
+        pnum, size = PROPERTY_SIZES_V3[self._memory[addr]]
+        addr += 1
+        proplist[pnum] = (addr, size)
+        addr += size
+
+    elif 4 <= self._memory.version <= 5:
+      while self._memory[addr] != 0:
+        headers.append(addr)
+        pnum, size = PROPERTY_SIZES_V4[self._memory[addr]]
+        addr += 1
+        if size is None:
+          headers.append(addr)
+          size = PROPERTY_LONG_SIZES[self._memory[addr]]
+          addr += 1
+        proplist[pnum] = (addr, size)
+        addr += size
+
     else:
       raise ZObjectIllegalVersion
 
+    headers.append(addr)
+    return proplist, headers
+
+  def _get_property_index(self, objectnum):
+    """Return the index of the property list of object OBJECTNUM, as
+    a tuple of the dictionary returned by _read_properties(), of a
+    dictionary mapping each property number to the next one in the
+    list (or 0 for the last one), and of the addresses of the layout
+    bytes of the list."""
+
+    index = self._property_indexes.get(objectnum)
+    if index is not None:
+      return index
+    proplist, headers = self._read_properties(objectnum)
+    numbers = list(proplist)
+    next_props = dict(zip(numbers, numbers[1:] + [0]))
+    index = (proplist, next_props, headers)
+    if not (0 < objectnum <= self._num_objects):
+      return index
+    self._property_indexes[objectnum] = index
+    for addr in headers:
+      self._property_headers.setdefault(addr, set()).add(objectnum)
+    low, high = self._property_range
+    if low == high:
+      low, high = headers[0], headers[-1] + 1
+    self._property_range = (min(low, headers[0]),
+                            max(high, headers[-1] + 1))
+    return index
+
+  def _forget_properties(self, objectnum):
+    """Drop the index of the property list of object OBJECTNUM."""
+
+    index = self._property_indexes.pop(objectnum, None)
+    if index is None:
+      return
+    for addr in index[2]:
+      objectnums = self._property_headers[addr]
+      objectnums.discard(objectnum)
+      if not objectnums:
+        del self._property_headers[addr]
+
+  def _write_entry(self, addr, value, size):
+    """Write VALUE, of SIZE bytes, at ADDR in the object table,
+    without reloading the cached copy of the object."""
+
+    self._writing = True
+    try:
+      if size == 1:
+        self._memory[addr] = value
+      elif size == 2:
+        self._memory.write_word(addr, value)
+      else:
+        self._memory[addr:addr+size] = value.to_bytes(size, 'big')
+    finally:
+      self._writing = False
+
 
   def _get_object_addr(self, objectnum):
     """Return address of object number OBJECTNUM."""
@@ -80,13 +292,14 @@ class ZObjectParser(object):
       result = self._objecttree_addr + (9 * (objectnum - 1))
     elif 4 <= self._memory.version <= 5:
       if not (1 <= objectnum <= 65535):
-        log("error:  there is no object %d" % objectnum)
+        log("error:  there is no object %d", objectnum)
         raise ZObjectIllegalObjectNumber
       result = self._objecttree_addr + (14 * (objectnum - 1))
     else:
       raise ZObjectIllegalVersion
 
-    log("address of object %d is %d" % (objectnum, result))
+    if zlogging.debug_enabled:
+      log("address of object %d is %d", objectnum, result)
     return result
 
 
@@ -108,14 +321,17 @@ class ZObjectParser(object):
     else:
       raise ZObjectIllegalVersion
 
-    log ("parent/sibling/child of object %d is %d, %d, %d" %
-         (objectnum, result[0], result[1], result[2]))
+    if zlogging.debug_enabled:
+      log("parent/sibling/child of object %d is %d, %d, %d",
+          objectnum, result[0], result[1], result[2])
     return result
     
 
   def _get_proptable_addr(self, objectnum):
     """Return address of property table of object OBJECTNUM."""
 
+    if 0 < objectnum <= self._num_objects:
+      return self._proptables[objectnum]
     addr = self._get_object_addr(objectnum)
 
     # skip past attributes and relatives
@@ -147,50 +363,135 @@ class ZObjectParser(object):
 
   #--------- Public APIs -----------
 
+  def count_objects(self):
+    """Return the number of objects in the object table. The table
+    has no explicit length, but the property tables conventionally
+    follow the last object, so objects are counted up to the lowest
+    property table address."""
+
+    if 1 <= self._memory.version <= 3:
+      entry_size, max_objects = 9, 255
+    else:
+      entry_size, max_objects = 14, 65535
+    count = 0
+    lowest_proptable = self._memory._total_size
+    while count < max_objects:
+      addr = self._get_object_addr(count + 1) + entry_size
+      if addr > lowest_proptable:
+        break
+      count += 1
+      lowest_proptable = min(lowest_proptable,
+                             self._memory.read_word(addr - 2))
+    return count
+
   def get_attribute(self, objectnum, attrnum):
     """Return value (0 or 1) of attribute number ATTRNUM of object
     number OBJECTNUM."""
 
-    object_addr = self._get_object_addr(objectnum)
+    if not (0 <= attrnum < self._num_attributes):
+      raise ZObjectIllegalAttributeNumber
+    return (self.get_attributes_mask(objectnum)
+            >> (self._num_attributes - 1 - attrnum)) & 1
 
-    if 1 <= self._memory.version <= 3:
-      if not (0 <= attrnum <= 31):
-        raise ZObjectIllegalAttributeNumber
-      bf = BitField(self._memory[object_addr + (attrnum / 8)])
 
-    elif 4 <= self._memory.version <= 5:
-      if not (0 <= attrnum <= 47):
-        raise ZObjectIllegalAttributeNumber
-      bf = BitField(self._memory[object_addr + (attrnum / 8)])
+  def set_attribute(self, objectnum, attrnum, value):
+    """Set attribute number ATTRNUM of object number OBJECTNUM if
+    VALUE is true, or clear it otherwise."""
 
+    if not (0 <= attrnum < self._num_attributes):
+      raise ZObjectIllegalAttributeNumber
+    object_addr = self._get_object_addr(objectnum)
+    addr = object_addr + (attrnum >> 3)
+    mask = 0x80 >> (attrnum & 7)
+    attr_byte = self._memory[addr]
+    if value:
+      attr_byte |= mask
     else:
-      raise ZObjectIllegalVersion
-
-    return bf[7 - (attrnum % 8)]
+      attr_byte &= ~mask
+    self._write_entry(addr, attr_byte, 1)
+    if objectnum <= self._num_objects:
+      bit = 1 << (self._num_attributes - 1 - attrnum)
+      if value:
+        self._attributes[objectnum] |= bit
+      else:
+        self._attributes[objectnum] &= ~bit
 
 
   def get_all_attributes(self, objectnum):
     """Return a list of all attribute numbers that are set on object
     OBJECTNUM"""
 
-    if 1 <= self._memory.version <= 3:
-      max = 32
-    elif 4 <= self._memory.version <= 5:
-      max = 48
-    else:
-      raise ZObjectIllegalVersion
+    mask = self.get_attributes_mask(objectnum)
+    last = self._num_attributes - 1
+    return [i for i in range(self._num_attributes)
+            if (mask >> (last - i)) & 1]
+
+
+  def get_attributes_mask(self, objectnum):
+    """Return the attributes of object OBJECTNUM as an integer
+    bitmask, read as the big-endian number made of its 4 (versions 1
+    to 3) or 6 attribute bytes: attribute 0 is the most significant
+    bit. See attribute_mask()."""
+
+    if 0 < objectnum <= self._num_objects:
+      return self._attributes[objectnum]
+    addr = self._get_object_addr(objectnum)
+    attr_bytes = self._num_attributes // 8
+    return int.from_bytes(self._memory[addr:addr + attr_bytes], 'big')
+
+
+  def attribute_mask(self, attrnums):
+    """Return the bitmask of the attributes numbered ATTRNUMS, in the
+    format of get_attributes_mask()."""
+
+    mask = 0
+    for attrnum in attrnums:
+      if not (0 <= attrnum < self._num_attributes):
+        raise ZObjectIllegalAttributeNumber
+      mask |= 1 << (self._num_attributes - 1 - attrnum)
+    return mask
+
+
+  def find_objects_with_attribute(self, attrnum):
+    """Return the list of numbers of the objects having attribute
+    ATTRNUM set."""
+
+    return self.find_objects_matching(self.attribute_mask([attrnum]))
+
 
-    # really inefficient, but who cares?
-    attrs = []
-    for i in range (0, max):
-      if self.get_attribute(objectnum, i):
-        attrs.append(i)
-    return attrs
+  def find_objects_matching(self, mask, clear_mask=0):
+    """Return the list of numbers of the objects having all the
+    attributes of bitmask MASK set, and all those of CLEAR_MASK clear
+    (see attribute_mask()). Only the objects counted by
+    count_objects() are searched."""
+
+    count = self._num_objects
+    if numpy is not None and count:
+      # View the attribute bytes of the whole object table as an array
+      # of 64-bit big-endian integers.
+      attr_bytes = self._num_attributes // 8
+      table = numpy.frombuffer(self._memory.raw, dtype=numpy.uint8,
+                               count=count * self._entry_size,
+                               offset=self._objecttree_addr)
+      padded = numpy.zeros((count, 8), dtype=numpy.uint8)
+      padded[:, 8 - attr_bytes:] = \
+          table.reshape(count, self._entry_size)[:, :attr_bytes]
+      values = padded.view('>u8').ravel()
+      matches = ((values & numpy.uint64(mask)) == numpy.uint64(mask)) \
+                & ((values & numpy.uint64(clear_mask)) == 0)
+      return (numpy.flatnonzero(matches) + 1).tolist()
+
+    attributes = self._attributes
+    return [objectnum for objectnum in range(1, count + 1)
+            if attributes[objectnum] & mask == mask
+            and not attributes[objectnum] & clear_mask]
 
 
   def get_parent(self, objectnum):
     """Return object number of parent of object number OBJECTNUM."""
 
+    if 0 < objectnum <= self._num_objects:
+      return self._parents[objectnum]
     [parent, sibling, child] = self._get_parent_sibling_child(objectnum)
     return parent
 
@@ -198,6 +499,8 @@ class ZObjectParser(object):
   def get_child(self, objectnum):
     """Return object number of child of object number OBJECTNUM."""
 
+    if 0 < objectnum <= self._num_objects:
+      return self._children[objectnum]
     [parent, sibling, child] = self._get_parent_sibling_child(objectnum)
     return child
 
@@ -205,6 +508,8 @@ class ZObjectParser(object):
   def get_sibling(self, objectnum):
     """Return object number of sibling of object number OBJECTNUM."""
 
+    if 0 < objectnum <= self._num_objects:
+      return self._siblings[objectnum]
     [parent, sibling, child] = self._get_parent_sibling_child(objectnum)
     return sibling
 
@@ -214,11 +519,11 @@ class ZObjectParser(object):
 
     addr = self._get_object_addr(objectnum)
     if 1 <= self._memory.version <= 3:
-      self._memory[addr + 4] = new_parent_num
-    elif 4 <= self._memory.version <= 5:
-      self._memory.write_word(addr + 6, new_parent_num)
+      self._write_entry(addr + 4, new_parent_num, 1)
     else:
-      raise ZObjectIllegalVersion
+      self._write_entry(addr + 6, new_parent_num, 2)
+    if objectnum <= self._num_objects:
+      self._parents[objectnum] = new_parent_num
 
 
   def set_child(self, objectnum, new_child_num):
@@ -226,11 +531,11 @@ class ZObjectParser(object):
 
     addr = self._get_object_addr(objectnum)
     if 1 <= self._memory.version <= 3:
-      self._memory[addr + 6] = new_child_num
-    elif 4 <= self._memory.version <= 5:
-      self._memory.write_word(addr + 10, new_child_num)
+      self._write_entry(addr + 6, new_child_num, 1)
     else:
-      raise ZObjectIllegalVersion
+      self._write_entry(addr + 10, new_child_num, 2)
+    if objectnum <= self._num_objects:
+      self._children[objectnum] = new_child_num
 
 
   def set_sibling(self, objectnum, new_sibling_num):
@@ -238,46 +543,47 @@ class ZObjectParser(object):
 
     addr = self._get_object_addr(objectnum)
     if 1 <= self._memory.version <= 3:
-      self._memory[addr + 5] = new_sibling_num
-    elif 4 <= self._memory.version <= 5:
-      self._memory.write_word(addr + 8, new_sibling_num)
+      self._write_entry(addr + 5, new_sibling_num, 1)
     else:
-      raise ZObjectIllegalVersion
+      self._write_entry(addr + 8, new_sibling_num, 2)
+    if objectnum <= self._num_objects:
+      self._siblings[objectnum] = new_sibling_num
 
 
   def insert_object(self, parent_object, new_child):
     """Prepend object NEW_CHILD to the list of PARENT_OBJECT's children."""
 
     # Remember all the original pointers within the new_child
-    [p, s, c] = self._get_parent_sibling_child(new_child)
+    p = self.get_parent(new_child)
+    s = self.get_sibling(new_child)
+
+    if p != 0:
+      # Hunt down and remove the new_child from its old location
+      item = self.get_child(p)
+      if item == 0:
+        # new_object claimed to have parent p, but p has no children!?
+        raise ZObjectMalformedTree
+      elif item == new_child:  # done!  new_object was head of list
+        self.set_child(p, s) # note that s might be 0, that's fine.
+      else: # walk across list of sibling links
+        prev = item
+        current = self.get_sibling(item)
+        while current != 0:
+          if current == new_child:
+            self.set_sibling(prev, s) # s might be 0, that's fine.
+            break
+          prev = current
+          current = self.get_sibling(current)
+        else:
+          # we reached the end of the list, never got a match
+          raise ZObjectMalformedTree
 
-    # First insert new_child intto the parent_object
+    # Then insert new_child into the parent_object
     original_child = self.get_child(parent_object)
     self.set_sibling(new_child, original_child)
     self.set_parent(new_child, parent_object)
     self.set_child(parent_object, new_child)
 
-    if p == 0:  # no need to 'remove' new_child, since it wasn't in a tree
-      return
-
-    # Hunt down and remove the new_child from its old location
-    item = self.get_child(p)
-    if item == 0:
-      # new_object claimed to have parent p, but p has no children!?
-      raise ZObjectMalformedTree
-    elif item == new_child:  # done!  new_object was head of list
-      self.set_child(p, s) # note that s might be 0, that's fine.
-    else: # walk across list of sibling links
-      prev = item
-      current = self.get_sibling(item)
-      while current != 0:
-        if current == new_child:
-          self.set_sibling(prev, s) # s might be 0, that's fine.
-          break
-      else:
-        # we reached the end of the list, never got a match
-        raise ZObjectMalformedTree
-
 
   def get_shortname(self, objectnum):
     """Return 'short name' of object number OBJECTNUM as ascii string."""
@@ -303,106 +609,69 @@ class ZObjectParser(object):
     object number OBJECTNUM.  If object has no such property, then
     return the address & length of the 'default' value for the property."""
 
-    # start at the beginning of the object's proptable
-    addr = self._get_proptable_addr(objectnum)
-    # skip past the shortname of the object
-    addr += (2 * self._memory[addr])
-    pnum = 0
+    propval = self._get_property_index(objectnum)[0].get(propnum)
+    if propval is not None:
+      return propval
 
-    if 1 <= self._memory.version <= 3:
+    # property list ran out, so return default propval instead.
+    default_value_addr = self._get_default_property_addr(propnum)
+    return (default_value_addr, 2)
 
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[4:0]
-        size = bf[7:5] + 1
-        if pnum == propnum:
-          return (addr, size)
-        addr += size
 
-    elif 4 <= self._memory.version <= 5:
+  def get_prop_addr(self, objectnum, propnum):
+    """Return the address of the value of property PROPNUM of object
+    OBJECTNUM, or 0 if the object has no such property."""
 
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[5:0]
-        if bf[7]:
-          bf2 = BitField(self._memory[addr])
-          addr += 1
-          size = bf2[5:0]
-        else:
-          if bf[6]:
-            size = 2
-          else:
-            size = 1
-        if pnum == propnum:
-          return (addr, size)
-        addr += size
+    propval = self._get_property_index(objectnum)[0].get(propnum)
+    if propval is None:
+      return 0
+    return propval[0]
 
-    else:
-      raise ZObjectIllegalVersion
 
-    # property list ran out, so return default propval instead.
-    default_value_addr = self._get_default_property_addr(propnum)
-    return (default_value_addr, 2)
+  def get_next_prop(self, objectnum, propnum):
+    """Return the number of the property following property PROPNUM in
+    the property list of object OBJECTNUM, or the number of its first
+    property if PROPNUM is 0. Return 0 past the last property."""
 
+    (proplist, next_props, headers) = self._get_property_index(objectnum)
+    if propnum == 0:
+      return next(iter(proplist), 0)
+    if propnum not in next_props:
+      raise ZObjectIllegalPropertyNumber
+    return next_props[propnum]
 
-  def get_all_properties(self, objectnum):
-    """Return a dictionary of all properties listed in the property
-    table of object OBJECTNUM.  (Obviously, this discounts 'default'
-    property values.).  The dictionary maps property numbers to (addr,
-    len) propval tuples."""
 
-    proplist = {}
-
-    # start at the beginning of the object's proptable
-    addr = self._get_proptable_addr(objectnum)
-    # skip past the shortname of the object
-    shortname_length = self._memory[addr]
-    addr += 1
-    addr += (2*shortname_length)
+  def get_prop_len(self, addr):
+    """Return the length of the property value at address ADDR, as
+    returned by get_prop_addr(), or 0 if ADDR is 0."""
 
+    if addr == 0:
+      return 0
+    size_byte = self._memory[addr - 1]
     if 1 <= self._memory.version <= 3:
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[4:0]
-        size = bf[7:5] + 1
-        proplist[pnum] = (addr, size)
-        addr += size
+      return PROPERTY_SIZES_V3[size_byte][1]
+    elif size_byte & 0x80:
+      # The second of two size bytes.
+      return PROPERTY_LONG_SIZES[size_byte]
+    return PROPERTY_SIZES_V4[size_byte][1]
 
-    elif 4 <= self._memory.version <= 5:
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[0:6]
-        if bf[7]:
-          bf2 = BitField(self._memory[addr])
-          addr += 1
-          size = bf2[0:6]
-          if size == 0:
-            size = 64
-        else:
-          if bf[6]:
-            size = 2
-          else:
-            size = 1
-        proplist[pnum] = (addr, size)
-        addr += size
 
-    else:
-      raise ZObjectIllegalVersion
+  def get_all_properties(self, objectnum):
+    """Return a dictionary of all properties listed in the property
+    table of object OBJECTNUM.  (Obviously, this discounts 'default'
+    property values.).  The dictionary maps property numbers to (addr,
+    len) propval tuples."""
 
-    return proplist
+    return dict(self._get_property_index(objectnum)[0])
 
 
   def set_property(self, objectnum, propnum, value):
     """Set a property on an object."""
-    proplist = self.get_all_properties(objectnum)
-    if propnum not in proplist:
+    propval = self._get_property_index(objectnum)[0].get(propnum)
+    if propval is None:
       raise ZObjectIllegalPropertyNumber
 
-    addr, size = proplist[propnum]
+    addr, size = propval
     if size == 1:
       self._memory[addr] = (value & 0xFF)
     elif size == 2:
@@ -6,24 +6,21 @@
 # root directory of this distribution.
 #
 
-from .bitfield import BitField
 from .zmemory import ZMemory
+from .decodetables import OPCODE_FORMS, OPERAND_TYPES, BRANCH_BYTES
+from .decodetables import EXTENDED_OPCODE_BYTE
+# The constants of the instruction classes and operand types are
+# defined along with the decoding tables, and exported from here too.
+from .decodetables import OPCODE_0OP, OPCODE_1OP, OPCODE_2OP
+from .decodetables import OPCODE_VAR, OPCODE_EXT
+from .decodetables import LARGE_CONSTANT, SMALL_CONSTANT, VARIABLE, ABSENT
+from . import zlogging
 from .zlogging import log
 
 class ZOperationError(Exception):
   "General exception for ZOperation class"
   pass
 
-# Constants defining the known instruction types. These types are
-# related to the number of operands the opcode has: for each operand
-# count, there is a separate opcode table, and the actual opcode
-# number is an index into that table.
-OPCODE_0OP = 0
-OPCODE_1OP = 1
-OPCODE_2OP = 2
-OPCODE_VAR = 3
-OPCODE_EXT = 4
-
 # Mapping of those constants to strings describing the opcode
 # classes. Used for pretty-printing only.
 OPCODE_STRINGS = {
@@ -34,11 +31,50 @@ OPCODE_STRINGS = {
   OPCODE_EXT: 'EXT',
   }
 
-# Constants defining the possible operand types.
-LARGE_CONSTANT = 0x0
-SMALL_CONSTANT = 0x1
-VARIABLE = 0x2
-ABSENT = 0x3
+# Declaration of the opcodes which are followed by a store byte, by
+# branch bytes, or by an inline z-string. For each opcode class, the
+# sets are given as lists of (first_version, opcode_numbers) tuples,
+# in the same spirit as the version-specific opcode declarations of
+# ZCpu: an opcode number is only taken into account if the machine
+# version is at least first_version. If an opcode loses its store or
+# branch in later versions, the entry is a (first_version,
+# last_version, opcode_numbers) tuple instead.
+STORE_OPCODES = {
+  OPCODE_2OP: [(1, (8, 9, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24)),
+               (4, (25,))],
+  OPCODE_1OP: [(1, (1, 2, 3, 4, 8, 14)), (1, 4, (15,))],
+  OPCODE_0OP: [(4, 4, (5, 6)), (5, (9,))],
+  OPCODE_VAR: [(1, (0, 7)), (4, (12, 22, 23)), (5, (4, 24))],
+  OPCODE_EXT: [(5, (0, 1, 2, 3, 4, 9, 10, 12))],
+  }
+
+BRANCH_OPCODES = {
+  OPCODE_2OP: [(1, (1, 2, 3, 4, 5, 6, 7, 10))],
+  OPCODE_1OP: [(1, (0, 1, 2))],
+  OPCODE_0OP: [(1, 3, (5, 6)), (3, (13,)), (5, (15,))],
+  OPCODE_VAR: [(4, (23,)), (5, (31,))],
+  OPCODE_EXT: [],
+  }
+
+TEXT_OPCODES = {
+  OPCODE_0OP: [(1, (2, 3))],
+  }
+
+def _opcode_set(declaration, version):
+  """Return the set of (opcode_class, opcode_number) pairs described by
+  DECLARATION (see STORE_OPCODES) for machine VERSION."""
+  result = set()
+  for opcode_class, entries in declaration.items():
+    for entry in entries:
+      if len(entry) == 2:
+        first, numbers = entry
+        last = version
+      else:
+        first, last, numbers = entry
+      if first <= version <= last:
+        result.update((opcode_class, n) for n in numbers)
+  return result
+
 
 class ZOpDecoder(object):
   def __init__(self, zmem, zstack):
@@ -48,6 +84,28 @@ class ZOpDecoder(object):
     self._parse_map = {}
     self.program_counter = self._memory.read_word(0x6)
 
+    version = self._memory.version
+    self._store_opcodes = _opcode_set(STORE_OPCODES, version)
+    self._branch_opcodes = _opcode_set(BRANCH_OPCODES, version)
+    self._text_opcodes = _opcode_set(TEXT_OPCODES, version)
+
+    # The decode cache maps the address of an instruction to its
+    # static shape, as returned by decode_instruction(). Most code
+    # lives in static or high memory and never changes, but entries
+    # for instructions in dynamic memory must be dropped when their
+    # bytes are written to. Those are tracked separately, by the pages
+    # of memory (see ZMemory) their bytes are in, so that a write only
+    # looks at the instructions of the pages it touches. We only start
+    # watching memory writes once there are some.
+    self._decode_cache = {}
+    self._dynamic_pages = {}
+    self._page_shift = zmem.page_size.bit_length() - 1
+    self._observing_writes = False
+
+    # Static shape of the instruction being executed, for the store,
+    # branch and text accessors below.
+    self._current = None
+
   def _get_pc(self):
     byte = self._memory[self.program_counter]
     self.program_counter += 1
@@ -60,175 +118,216 @@ class ZOpDecoder(object):
 
        [opcode-class, opcode-number, [operand, operand, operand, ...]]
 
-    If the opcode has no operands, the operand list is present but empty."""
-
-    opcode = self._get_pc()
-
-    log("Decode opcode %x" % opcode)
+    If the opcode has no operands, the operand list is present but
+    empty. The program counter is moved past the whole instruction,
+    including its store, branch and text data, which the opcode
+    implementation can retrieve through get_store_address(),
+    get_branch_offset() and get_zstring()."""
+
+    pc = self.program_counter
+    instruction = self._decode_cache.get(pc)
+    if instruction is None:
+      instruction = self._cache_instruction(pc)
+    self._current = instruction
+    self.program_counter = instruction[7]
+
+    # Only variable operands need work at execution time; constant
+    # operands were resolved when decoding.
+    if instruction[3] is None:
+      return instruction[0], instruction[1], list(instruction[2])
+    operands = []
+    for operand_type, value in zip(instruction[3], instruction[2]):
+      if operand_type == VARIABLE:
+        value = self.read_variable(value)
+      operands.append(value)
+    return instruction[0], instruction[1], operands
+
+  def _cache_instruction(self, pc):
+    """Decode the instruction at PC, and remember its shape."""
+    instruction = self.decode_instruction(pc)
+    self._decode_cache[pc] = instruction
+    if pc <= self._memory.dynamic_end:
+      for page in self._pages(pc, instruction[7]):
+        self._dynamic_pages.setdefault(page, set()).add(pc)
+      if not self._observing_writes:
+        self._memory.add_write_observer(self._on_memory_write)
+        self._observing_writes = True
+    return instruction
+
+  def _pages(self, start, end):
+    """Return the range of the pages holding addresses START up to
+    (but not including) END."""
+    return range(start >> self._page_shift,
+                 ((end - 1) >> self._page_shift) + 1)
+
+  def _on_memory_write(self, start, end):
+    """Drop cached instructions overlapping the written range."""
+    stale = set()
+    for page in self._pages(start, end):
+      pcs = self._dynamic_pages.get(page)
+      if pcs:
+        stale.update(pc for pc in pcs
+                     if pc < end and start < self._decode_cache[pc][7])
+    for pc in stale:
+      log("Invalidating cached instruction at %x", pc)
+      for page in self._pages(pc, self._decode_cache.pop(pc)[7]):
+        pcs = self._dynamic_pages[page]
+        pcs.discard(pc)
+        if not pcs:
+          del self._dynamic_pages[page]
+
+  def read_variable(self, variable_number):
+    """Return the value of the given variable operand, popping it off
+    the stack for variable 0."""
+    if variable_number == 0:
+      return self._stack.pop_stack() # TODO: make sure this is right.
+    elif variable_number < 16:
+      return self._stack.get_local_variable(variable_number - 1)
+    else:
+      return self._memory.read_global_fast(variable_number)
+
+  def decode_instruction(self, pc):
+    """Decode the static shape of the instruction at address PC,
+    without executing anything or touching the program counter.
+    Return a tuple of the form:
+
+       (opcode-class, opcode-number, operands, operand-types,
+        store-variable, branch, text-address, next-pc)
+
+    operands is a tuple of operand values, holding the variable number
+    for VARIABLE operands. operand-types is the tuple of operand types
+    if any operand is a VARIABLE, and None if all operands are
+    constants. store-variable is None for
+    opcodes which don't store, branch is None or a
+    (branch-if-true, branch-offset) tuple, text-address is the address
+    of the inline z-string of print opcodes (or None), and next-pc is
+    the address of the following instruction."""
+
+    # The raw reads below are unchecked, so validate the start address.
+    self._memory.check_readable(pc, pc + 1)
+    memory = self._memory.raw
+    opcode = memory[pc]
+    pc += 1
+
+    if zlogging.debug_enabled:
+      log("Decode opcode %x", opcode)
 
     # Determine the opcode type, and hand off further parsing.
-    if self._memory.version == 5 and opcode == 0xBE:
-      # Extended opcode
-      return self._parse_opcode_extended()
-
-    opcode = BitField(opcode)
-    if opcode[7] == 0:
-      # Long opcode
-      return self._parse_opcode_long(opcode)
-    elif opcode[6] == 0:
-      # Short opcode
-      return self._parse_opcode_short(opcode)
-    else:
-      # Variable opcode
-      return self._parse_opcode_variable(opcode)
-
-  def _parse_opcode_long(self, opcode):
-    """Parse an opcode of the long form."""
-    # Long opcodes are always 2OP. The types of the two operands are
-    # encoded in bits 5 and 6 of the opcode.
-    log("Opcode is long")
-    LONG_OPERAND_TYPES = [SMALL_CONSTANT, VARIABLE]
-    operands = [self._parse_operand(LONG_OPERAND_TYPES[opcode[6]]),
-                self._parse_operand(LONG_OPERAND_TYPES[opcode[5]])]
-    return (OPCODE_2OP, opcode[0:5], operands)
-
-  def _parse_opcode_short(self, opcode):
-    """Parse an opcode of the short form."""
-    # Short opcodes can have either 1 operand, or no operand.
-    log("Opcode is short")
-    operand_type = opcode[4:6]
-    operand = self._parse_operand(operand_type)
-    if operand is None: # 0OP variant
-      log("Opcode is 0OP variant")
-      return (OPCODE_0OP, opcode[0:4], [])
-    else:
-      log("Opcode is 1OP variant")
-      return (OPCODE_1OP, opcode[0:4], [operand])
-
-  def _parse_opcode_variable(self, opcode):
-    """Parse an opcode of the variable form."""
-    log("Opcode is variable")
-    if opcode[5]:
-      log("Variable opcode of VAR kind")
-      opcode_type = OPCODE_VAR
+    if self._memory.version >= 5 and opcode == EXTENDED_OPCODE_BYTE:
+      opcode_class, opcode_number, types, pc = \
+                    self._parse_opcode_extended(pc)
     else:
-      log("Variable opcode of 2OP kind")
-      opcode_type = OPCODE_2OP
-
-    opcode_num = opcode[0:5]
-
-    # Parse the types byte to retrieve the operands.
-    operands = self._parse_operands_byte()
-
-    # Special case: opcodes 12 and 26 have a second operands byte.
-    if opcode[0:7] == 0xC or opcode[0:7] == 0x1A:
-      log("Opcode has second operand byte")
-      operands += self._parse_operands_byte()
-
-    return (opcode_type, opcode_num, operands)
-
-  def _parse_operand(self, operand_type):
-    """Read and return an operand of the given type.
-
-    This assumes that the operand is in memory, at the address pointed
-    by the Program Counter."""
-    assert operand_type <= 0x3
-
-    if operand_type == LARGE_CONSTANT:
-      log("Operand is large constant")
-      operand = self._memory.read_word(self.program_counter)
-      self.program_counter += 2
-    elif operand_type == SMALL_CONSTANT:
-      log("Operand is small constant")
-      operand = self._get_pc()
-    elif operand_type == VARIABLE:
-      variable_number = self._get_pc()
-      log("Operand is variable %d" % variable_number)
-      if variable_number == 0:
-        log("Operand value comes from stack")
-        operand = self._stack.pop_stack() # TODO: make sure this is right.
-      elif variable_number < 16:
-        log("Operand value comes from local variable")
-        operand = self._stack.get_local_variable(variable_number - 1)
-      else:
-        log("Operand value comes from global variable")
-        operand = self._memory.read_global(variable_number)
-    elif operand_type == ABSENT:
-      log("Operand is absent")
-      operand = None
-    if operand is not None:
-      log("Operand value: %d" % operand)
-
-    return operand
-
-  def _parse_operands_byte(self):
-    """Parse operands given by the operand byte and return a list of
-    values.
-    """
-    operand_byte = BitField(self._get_pc())
-    operands = []
-    for operand_type in [operand_byte[6:8], operand_byte[4:6],
-                         operand_byte[2:4], operand_byte[0:2]]:
-      operand = self._parse_operand(operand_type)
-      if operand is None:
-        break
-      operands.append(operand)
+      opcode_class, opcode_number, types = OPCODE_FORMS[opcode]
+      if types is None:
+        types, pc = self._parse_opcode_variable(opcode_class,
+                                                opcode_number, pc)
 
-    return operands
+    operands = []
+    for operand_type in types:
+      if operand_type == LARGE_CONSTANT:
+        operands.append(self._memory.read_word_fast(pc))
+        pc += 2
+      else:
+        operands.append(memory[pc])
+        pc += 1
+      if operand_type == VARIABLE and zlogging.debug_enabled:
+        log("Operand is variable %d", operands[-1])
+    if VARIABLE in types:
+      operand_types = tuple(types)
+    else:
+      operand_types = None
+
+    store_variable = None
+    if (opcode_class, opcode_number) in self._store_opcodes:
+      store_variable = memory[pc]
+      pc += 1
+
+    branch = None
+    if (opcode_class, opcode_number) in self._branch_opcodes:
+      branch, pc = self._parse_branch(pc)
+
+    text_address = None
+    if (opcode_class, opcode_number) in self._text_opcodes:
+      text_address = pc
+      while not (memory[pc] & 0x80):
+        pc += 2
+      pc += 2
+
+    return (opcode_class, opcode_number, tuple(operands), operand_types,
+            store_variable, branch, text_address, pc)
+
+  def _parse_opcode_variable(self, opcode_class, opcode_number, pc):
+    """Parse the operand types of an opcode of the variable form,
+    starting at PC. Return the operand types, and the address
+    following them."""
+    types = OPERAND_TYPES[self._memory.raw[pc]]
+    pc += 1
+
+    # Special case: call_vs2 and call_vn2 have a second types byte.
+    if opcode_class == OPCODE_VAR and opcode_number in (0xC, 0x1A):
+      more_types = OPERAND_TYPES[self._memory.raw[pc]]
+      pc += 1
+      if len(types) == 4:
+        types += more_types
+
+    return types, pc
+
+  def _parse_opcode_extended(self, pc):
+    """Parse an opcode of the extended form."""
+    opcode_num = self._memory.raw[pc]
+    types = OPERAND_TYPES[self._memory.raw[pc + 1]]
+    return (OPCODE_EXT, opcode_num, types, pc + 2)
+
+  def _parse_branch(self, pc):
+    """Parse the branch data at address PC, and return two values:
+    first, a tuple of either True or False (indicating whether to
+    branch if true or branch if false) and the branch offset, and
+    second, the address following the branch data."""
+
+    memory = self._memory.raw
+    branch_if_true, branch_offset, is_short = BRANCH_BYTES[memory[pc]]
+    pc += 1
+    if not is_short:
+      # The branch offset is a signed 14-bit number, whose sign and
+      # high bits come from the first byte.
+      branch_offset += memory[pc]
+      pc += 1
+
+    if zlogging.debug_enabled:
+      log('Branch if %s to offset %+d', branch_if_true, branch_offset)
+    return (branch_if_true, branch_offset), pc
 
 
   # Public funcs that the ZPU may also need to call, depending on the
   # opcode being executed:
 
-  def get_zstring(self):
-    """For string opcodes, return the address of the zstring pointed
-    to by the PC.  Increment PC just past the text."""
+  def get_current_instruction(self):
+    """Return the static shape of the instruction being executed, for
+    set_current_instruction()."""
+    return self._current
 
-    start_addr = self.program_counter
-    bf = BitField(0)
 
-    while True:
-      bf.__init__(self._memory[self.program_counter])
-      self.program_counter += 2
-      if bf[7] == 1:
-        break
+  def set_current_instruction(self, instruction):
+    """Make INSTRUCTION, as returned by get_current_instruction(), the
+    instruction being executed again, so that the accessors below
+    return its store, branch and text data."""
+    self._current = instruction
 
-    return start_addr
+
+  def get_zstring(self):
+    """For string opcodes, return the address of the zstring embedded
+    in the current instruction."""
+    return self._current[6]
 
 
   def get_store_address(self):
-    """For store opcodes, read byte pointed to by PC and return the
-    variable number in which the operation result should be stored.
-    Increment the PC as necessary."""
-    return self._get_pc()
+    """For store opcodes, return the variable number in which the
+    operation result should be stored."""
+    return self._current[4]
 
 
   def get_branch_offset(self):
-    """For branching opcodes, examine address pointed to by PC, and
-    return two values: first, either True or False (indicating whether
-    to branch if true or branch if false), and second, the address to
-    jump to.  Increment the PC as necessary."""
-
-    bf = BitField(self._get_pc())
-    branch_if_true = bool(bf[7])
-    if bf[6]:
-      branch_offset = bf[0:6]
-    else:
-      # We need to do a little magic here. The branch offset is
-      # written as a signed 14-bit number, with signed meaning '-n' is
-      # written as '65536-n'. Or in this case, as we have 14 bits,
-      # '16384-n'.
-      #
-      # So, if the MSB (ie. bit 13) is set, we have a negative
-      # number. We take the value, and substract 16384 to get the
-      # actual offset as a negative integer.
-      #
-      # If the MSB is not set, we just extract the value and return it.
-      #
-      # Can you spell "Weird" ?
-      branch_offset = self._get_pc() + (bf[0:5] << 8)
-      if bf[5]:
-        branch_offset -= 8192
-
-    log('Branch if %s to offset %+d' % (branch_if_true, branch_offset))
-    return branch_if_true, branch_offset
+    """For branching opcodes, return two values: first, either True
+    or False (indicating whether to branch if true or branch if
+    false), and second, the branch offset."""
+    return self._current[5]
@@ -0,0 +1,371 @@
+#
+# A server hosting many Z-Machine sessions in one process, on an
+# asyncio event loop.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Each session is a ZMachine with a scripted user interface.  A session
+# runs until its story asks for input: the input stream has none, so
+# the machine suspends execution (see ZCpu.run) and the session waits
+# until a line of input arrives.  The line is then fed to the input
+# stream, and the machine resumes, retrying the input instruction.  An
+# idle session is thus nothing but a suspended machine, and doesn't
+# hold a thread.
+#
+# Machines run in slices of a limited number of instructions, and
+# yield to the event loop between slices, so that a long turn of one
+# session doesn't starve the others.  A session may also be given a
+# limit on the number of instructions of a turn; a story exceeding it
+# is considered runaway, and its session is stopped.
+#
+# The manager speaks a simple line protocol over TCP (see serve()),
+# one session per connection.  Other front ends (a web server, say)
+# drive the manager through create_session(), send() and
+# close_session() instead.
+#
+# Sessions can keep a checkpoint log (see zcheckpoint), recording the
+# state of their story at the end of every turn.  If the server
+# crashes, a new server recovers the sessions from their logs, with
+# recover_sessions().
+
+import asyncio
+import itertools
+import os
+
+from . import quetzal
+from . import scriptedzui
+from . import zcheckpoint
+from . import zstoryimage
+from . import zstringtable
+from .zcpu import STOPPED_INPUT, STOPPED_HALT
+from .zlogging import log
+from .zmachine import ZMachine
+
+class ZServerError(Exception):
+  "General exception for the server."
+  pass
+
+class ZNoSuchSession(ZServerError):
+  "No session has the given ID."
+  pass
+
+class ZSessionFinished(ZServerError):
+  "The session's story has stopped, and takes no more input."
+  pass
+
+class ZSessionNotWaiting(ZServerError):
+  "The session's story isn't waiting for input."
+  pass
+
+class ZTooManySessions(ZServerError):
+  "The server hosts as many sessions as it is allowed to."
+  pass
+
+# Number of instructions a session executes before yielding to the
+# event loop.
+DEFAULT_SLICE_INSTRUCTIONS = 5000
+
+# States of a session.
+SESSION_RUNNING = "running"
+SESSION_WAITING = "waiting"     # Waiting for a line of input.
+SESSION_FINISHED = "finished"
+
+
+class ZSession(object):
+
+  def __init__(self, session_id, story, max_instructions_per_turn=None,
+               slice_instructions=DEFAULT_SLICE_INSTRUCTIONS,
+               translate=False, checkpoint_path=None):
+    """Create a session, with ID SESSION_ID, running STORY (a story
+    image, or the contents of a story file). If
+    MAX_INSTRUCTIONS_PER_TURN is given, the session is stopped when
+    a turn runs for more instructions than that. Execution yields to
+    the event loop every SLICE_INSTRUCTIONS instructions. If
+    CHECKPOINT_PATH is given, the session keeps a checkpoint log in
+    that file."""
+
+    self.session_id = session_id
+    self.ui = scriptedzui.create_zui()
+    self.machine = ZMachine(story, self.ui, translate=translate)
+    self.max_instructions_per_turn = max_instructions_per_turn
+    self.slice_instructions = slice_instructions
+    self.state = SESSION_RUNNING
+    # Why the session finished, if it did.
+    self.stop_reason = None
+    self.turns = 0
+    self._lock = asyncio.Lock()
+    if checkpoint_path is not None:
+      self.checkpoint_log = zcheckpoint.ZCheckpointLog(self.machine,
+                                                       checkpoint_path)
+    else:
+      self.checkpoint_log = None
+
+  def _start_turn(self):
+    self.state = SESSION_RUNNING
+    self._turn_start = self.machine.instruction_count
+
+  def _run_slice(self):
+    """Run the machine for a slice of the current turn. Return True if
+    the turn is over."""
+    limit = self.max_instructions_per_turn
+    budget = self.slice_instructions
+    if limit is not None:
+      budget = min(budget, self._turn_start + limit
+                   - self.machine.instruction_count)
+    if budget <= 0:
+      log("Session %s exceeded its instruction limit", self.session_id)
+      self.state = SESSION_FINISHED
+      self.stop_reason = "instruction limit"
+      return True
+    status = self.machine.run(budget)
+    if status == STOPPED_INPUT:
+      self.state = SESSION_WAITING
+      return True
+    elif status == STOPPED_HALT:
+      self.state = SESSION_FINISHED
+      self.stop_reason = "halt"
+      return True
+    return False
+
+  def _end_turn(self):
+    self.turns += 1
+    if self.checkpoint_log is not None:
+      if self.state == SESSION_WAITING:
+        self.machine.rewind_input()
+        self.checkpoint_log.checkpoint()
+      elif self.finished:
+        self.checkpoint_log.remove()
+    return self.ui.screen.get_output()
+
+  async def _run_turn(self):
+    """Run the machine until it waits for input or stops, yielding to
+    the event loop between slices, and return the output of the
+    turn."""
+    self._start_turn()
+    while not self._run_slice():
+      await asyncio.sleep(0)
+    return self._end_turn()
+
+  #--------- Public APIs -----------
+
+  @property
+  def finished(self):
+    return self.state == SESSION_FINISHED
+
+  def feed(self, line):
+    """Give LINE of input to the story, for its next request for
+    input. Raise ZSessionFinished if the story has stopped."""
+    if self.finished:
+      raise ZSessionFinished
+    self.ui.keyboard_input.feed(line)
+
+  def run_turn(self):
+    """Run the story until it waits for input or stops, without ever
+    yielding, and return its output. This is for callers scheduling
+    sessions themselves, like the worker processes of a
+    ZSessionPool."""
+    self._start_turn()
+    while not self._run_slice():
+      pass
+    return self._end_turn()
+
+  def snapshot(self):
+    """Return the state of the session's story, as the contents of a
+    Quetzal file. The story must be waiting for input."""
+    if self.state != SESSION_WAITING:
+      raise ZSessionNotWaiting
+    self.machine.rewind_input()
+    return quetzal.QuetzalWriter(self.machine).generate()
+
+  @classmethod
+  def from_snapshot(cls, session_id, story, snapshot, **options):
+    """Return a session running STORY, in the state saved by
+    snapshot() in SNAPSHOT. The session is waiting for input. See
+    the constructor for the other arguments."""
+    session = cls(session_id, story, **options)
+    quetzal.QuetzalParser(session.machine).load_data(snapshot)
+    session.state = SESSION_WAITING
+    return session
+
+  @classmethod
+  def recover(cls, session_id, story, checkpoint_path, **options):
+    """Return a session running STORY, in the state recorded in the
+    checkpoint log at CHECKPOINT_PATH, which the session goes on
+    keeping. The session is waiting for input. See the constructor
+    for the other arguments."""
+    session = cls(session_id, story, checkpoint_path=checkpoint_path,
+                  **options)
+    zcheckpoint.recover(session.machine, checkpoint_path)
+    # Start the log afresh, in case it ends with a damaged record.
+    session.checkpoint_log.compact()
+    session.state = SESSION_WAITING
+    return session
+
+  def close(self):
+    """Stop keeping the checkpoint log of the session, if any, and
+    delete it."""
+    if self.checkpoint_log is not None:
+      self.checkpoint_log.remove()
+
+  async def start(self):
+    """Run the story up to its first request for input, and return
+    its output."""
+    async with self._lock:
+      return await self._run_turn()
+
+  async def send(self, line):
+    """Give LINE of input to the story, run it up to its next request
+    for input, and return its output. Raise ZSessionFinished if the
+    story has stopped."""
+    async with self._lock:
+      self.feed(line)
+      return await self._run_turn()
+
+
+class ZSessionManager(object):
+
+  def __init__(self, story, max_sessions=None,
+               max_instructions_per_turn=None,
+               slice_instructions=DEFAULT_SLICE_INSTRUCTIONS,
+               translate=False, precompile_strings=False,
+               checkpoint_dir=None):
+    """Create a manager of sessions running STORY, the path of a story
+    file, a story image, or the contents of a story file. The memory
+    holding the story is shared by all sessions. At most MAX_SESSIONS sessions are hosted at once,
+    if given. If PRECOMPILE_STRINGS is true, the strings of the story
+    are decoded once, up front, for all sessions (see zstringtable).
+    If CHECKPOINT_DIR is given, each session keeps a checkpoint log in
+    that directory. See ZSession for the other arguments."""
+
+    story_path = None
+    if isinstance(story, str):
+      story_path = story
+      story = zstoryimage.load_story(story)
+    elif not isinstance(story, zstoryimage.ZStoryImage):
+      story = zstoryimage.ZStoryImage.from_bytes(story)
+    if precompile_strings and story.strings is None:
+      zstringtable.precompile(story, story_path)
+    self._story = story
+    self.max_sessions = max_sessions
+    self._session_options = {
+      'max_instructions_per_turn': max_instructions_per_turn,
+      'slice_instructions': slice_instructions,
+      'translate': translate,
+      }
+    self.checkpoint_dir = checkpoint_dir
+    self.sessions = {}
+    # New sessions never reuse the ID, and so the log, of a session
+    # left in the checkpoint directory by a server which crashed.
+    self._session_ids = itertools.count(
+      max(self._logged_session_ids(), default=0) + 1)
+
+  def _get_session(self, session_id):
+    try:
+      return self.sessions[session_id]
+    except KeyError:
+      raise ZNoSuchSession(session_id)
+
+  def _checkpoint_path(self, session_id):
+    if self.checkpoint_dir is None:
+      return None
+    return os.path.join(self.checkpoint_dir,
+                        "%d%s" % (session_id, zcheckpoint.FILE_SUFFIX))
+
+  def _logged_session_ids(self):
+    """Return the sorted IDs of the sessions which have a checkpoint
+    log in the checkpoint directory."""
+    if self.checkpoint_dir is None:
+      return []
+    session_ids = []
+    for name in os.listdir(self.checkpoint_dir):
+      if not name.endswith(zcheckpoint.FILE_SUFFIX):
+        continue
+      try:
+        session_ids.append(int(name[:-len(zcheckpoint.FILE_SUFFIX)]))
+      except ValueError:
+        continue
+    return sorted(session_ids)
+
+  async def _handle_client(self, reader, writer):
+    """Serve a session to the client connected through READER and
+    WRITER, until either side stops."""
+    try:
+      session_id, output = await self.create_session()
+    except ZTooManySessions:
+      writer.write(b"Too many sessions, try again later.\n")
+      writer.close()
+      return
+    try:
+      while True:
+        writer.write(output.encode('utf-8'))
+        await writer.drain()
+        if self.sessions[session_id].finished:
+          break
+        line = await reader.readline()
+        if not line:
+          break
+        output = await self.send(session_id,
+                                 line.decode('utf-8', 'replace')
+                                 .rstrip("\r\n"))
+    except ConnectionError:
+      pass
+    finally:
+      self.close_session(session_id)
+      writer.close()
+
+  #--------- Public APIs -----------
+
+  async def create_session(self):
+    """Start a new session, and return its ID along with the output
+    of the story up to its first request for input."""
+    if (self.max_sessions is not None
+        and len(self.sessions) >= self.max_sessions):
+      raise ZTooManySessions
+    session_id = next(self._session_ids)
+    session = ZSession(session_id, self._story,
+                       checkpoint_path=self._checkpoint_path(session_id),
+                       **self._session_options)
+    self.sessions[session_id] = session
+    log("Started session %s", session_id)
+    return session_id, await session.start()
+
+  async def send(self, session_id, line):
+    """Give LINE of input to the session with ID SESSION_ID, and
+    return the output of the story in response."""
+    return await self._get_session(session_id).send(line)
+
+  def close_session(self, session_id):
+    """Stop the session with ID SESSION_ID, and forget it."""
+    self._get_session(session_id).close()
+    del self.sessions[session_id]
+    log("Closed session %s", session_id)
+
+  def recover_sessions(self):
+    """Recover the sessions whose checkpoint logs are in the
+    checkpoint directory, as left by a server which crashed. The
+    recovered sessions are waiting for input. Return their IDs."""
+    recovered = []
+    for session_id in self._logged_session_ids():
+      if session_id in self.sessions:
+        continue
+      try:
+        session = ZSession.recover(session_id, self._story,
+                                   self._checkpoint_path(session_id),
+                                   **self._session_options)
+      except (zcheckpoint.ZCheckpointError, quetzal.QuetzalError) as e:
+        log("Could not recover session %s: %s", session_id, e)
+        continue
+      self.sessions[session_id] = session
+      recovered.append(session_id)
+    log("Recovered %d sessions", len(recovered))
+    return recovered
+
+  async def serve(self, host, port):
+    """Accept connections on HOST and PORT, until cancelled. Each
+    connection plays its own session: lines received are input to the
+    story, and the output of the story is sent back."""
+    server = await asyncio.start_server(self._handle_client, host, port)
+    async with server:
+      await server.serve_forever()
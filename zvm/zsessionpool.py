@@ -0,0 +1,411 @@
+#
+# A pool of worker processes sharing the sessions of a story between
+# them, so that a host can use more than one core for Z-code execution.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# A single process only executes Z-code on one core at a time.  The
+# pool starts a number of worker processes, each hosting its own
+# sessions (see zserver.ZSession), and routes every request for a
+# session to the worker hosting it.  New sessions are placed on a
+# worker according to their ID.
+#
+# Each worker processes its requests one at a time, in order.  The
+# number of outstanding requests per worker is bounded: once a worker
+# has that many requests queued, submitting another one blocks until
+# one completes (or fails with ZPoolBusy after the pool's submit
+# timeout), so that a busy worker pushes back on its callers instead
+# of queueing without limit.  Waiting for a worker never holds the
+# pool's lock, so a busy worker only holds up requests for its own
+# sessions.
+#
+# Sessions can be moved between workers while they wait for input:
+# the source worker saves the session as a Quetzal snapshot, and the
+# target worker restores it.  rebalance() uses this to move busy
+# sessions off the workers doing the most work.  While a session is
+# being moved, requests for it fail with ZPoolSessionMoving.
+#
+# All requests return concurrent.futures.Future objects; asyncio
+# callers can await them through asyncio.wrap_future().
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import zlib
+
+from . import zstoryimage
+from .zlogging import log
+from .zserver import ZSession, DEFAULT_SLICE_INSTRUCTIONS
+
+class ZSessionPoolError(Exception):
+  "General exception for the session pool."
+  pass
+
+class ZPoolBusy(ZSessionPoolError):
+  "The worker hosting the session has too many requests queued."
+  pass
+
+class ZPoolSessionMoving(ZPoolBusy):
+  "The session is being moved to another worker."
+  pass
+
+class ZPoolNoSuchSession(ZSessionPoolError):
+  "No session has the given ID."
+  pass
+
+class ZPoolWorkerError(ZSessionPoolError):
+  "A worker failed to handle a request."
+  pass
+
+# Number of requests which can be queued for a worker before
+# submitting more blocks.
+DEFAULT_MAX_QUEUE_DEPTH = 64
+
+
+def _worker_main(story, options, requests, responses, counters):
+  """Main loop of a worker process: handle the requests read from
+  REQUESTS, and put their results on RESPONSES. COUNTERS is a shared
+  array, in which the worker accumulates the number of instructions it
+  executed and the time it spent handling requests."""
+
+  if isinstance(story, str):
+    story = zstoryimage.load_story(story)
+  else:
+    story = zstoryimage.ZStoryImage.from_bytes(story)
+  sessions = {}
+
+  while True:
+    request = requests.get()
+    if request is None:
+      break
+    request_id, command, session_id, argument = request
+    start = time.perf_counter()
+    session = sessions.get(session_id)
+    instructions = session.machine.instruction_count if session else 0
+    try:
+      if command == 'create':
+        session = ZSession(session_id, story, **options)
+        sessions[session_id] = session
+        result = session.run_turn()
+      elif command == 'send':
+        session.feed(argument)
+        result = session.run_turn()
+      elif command == 'close':
+        del sessions[session_id]
+        session = None
+        result = None
+      elif command == 'export':
+        result = session.snapshot()
+        del sessions[session_id]
+        session = None
+      elif command == 'import':
+        session = ZSession.from_snapshot(session_id, story, argument,
+                                         **options)
+        sessions[session_id] = session
+        result = None
+      if session is not None:
+        instructions = session.machine.instruction_count - instructions
+      else:
+        instructions = 0
+      response = (request_id, True, (result, instructions))
+    except Exception as e:
+      try:
+        pickle.dumps(e)
+      except Exception:
+        e = ZPoolWorkerError(repr(e))
+      response = (request_id, False, e)
+      instructions = 0
+    counters[0] += instructions
+    counters[1] += time.perf_counter() - start
+    responses.put(response)
+
+
+class _Worker(object):
+  """The pool's side of a worker process."""
+
+  def __init__(self, index, story, options, responses, max_queue_depth):
+    self.index = index
+    self.requests = multiprocessing.Queue()
+    # Instructions executed, and time spent handling requests.
+    self.counters = multiprocessing.Array('d', 2, lock=False)
+    self.slots = threading.BoundedSemaphore(max_queue_depth)
+    self.queue_depth = 0
+    # IDs of the sessions hosted by the worker, mapped to the number
+    # of instructions they executed since the last rebalancing.
+    self.sessions = {}
+    self.last_sample = (time.perf_counter(), 0.0)
+    self.process = multiprocessing.Process(
+      target=_worker_main,
+      args=(story, options, self.requests, responses, self.counters),
+      daemon=True)
+    self.process.start()
+
+
+class ZSessionPool(object):
+
+  def __init__(self, story, num_workers=None,
+               max_queue_depth=DEFAULT_MAX_QUEUE_DEPTH,
+               submit_timeout=None, max_instructions_per_turn=None,
+               translate=False):
+    """Create a pool of NUM_WORKERS worker processes (one per core by
+    default) running sessions of STORY, the path of a story file or
+    the contents of one.
+
+    At most MAX_QUEUE_DEPTH requests are queued for a worker. Beyond
+    that, submitting a request blocks until one completes, for at
+    most SUBMIT_TIMEOUT seconds if not None, after which ZPoolBusy is
+    raised. See zserver.ZSession for MAX_INSTRUCTIONS_PER_TURN and
+    TRANSLATE."""
+
+    if num_workers is None:
+      num_workers = os.cpu_count() or 1
+    if not isinstance(story, str):
+      story = bytes(story)
+    options = {
+      'max_instructions_per_turn': max_instructions_per_turn,
+      'slice_instructions': DEFAULT_SLICE_INSTRUCTIONS,
+      'translate': translate,
+      }
+    self.submit_timeout = submit_timeout
+    self._responses = multiprocessing.Queue()
+    self._workers = [_Worker(index, story, options, self._responses,
+                             max_queue_depth)
+                     for index in range(num_workers)]
+    self._futures = {}
+    self._request_ids = itertools.count()
+    self._session_ids = itertools.count(1)
+    self._routes = {}
+    # IDs of the sessions being moved between workers.
+    self._moving = set()
+    # The pool's lock protects routing, and is only held for short
+    # updates, never while waiting for a worker. The activity counters
+    # of workers, also updated as responses arrive, have their own
+    # lock.
+    self._lock = threading.Lock()
+    self._activity_lock = threading.Lock()
+    self._collector = threading.Thread(target=self._collect, daemon=True)
+    self._collector.start()
+
+  def _collect(self):
+    """Resolve the futures of requests, as their responses arrive."""
+    while True:
+      response = self._responses.get()
+      if response is None:
+        break
+      request_id, succeeded, result = response
+      future, worker, session_id = self._futures.pop(request_id)
+      with self._activity_lock:
+        worker.queue_depth -= 1
+        if succeeded and session_id in worker.sessions:
+          worker.sessions[session_id] += result[1]
+      worker.slots.release()
+      if succeeded:
+        future.set_result(result[0])
+      else:
+        future.set_exception(result)
+
+  def _acquire_slot(self, worker):
+    """Take a slot in the queue of WORKER, waiting for one for at most
+    the submit timeout. The caller must not hold the pool's lock."""
+    if not worker.slots.acquire(timeout=self.submit_timeout):
+      raise ZPoolBusy
+
+  def _enqueue(self, worker, command, session_id, argument=None):
+    """Queue a request for WORKER, which has a slot taken for it, and
+    return its future. The caller holds the pool's lock."""
+    future = concurrent.futures.Future()
+    request_id = next(self._request_ids)
+    self._futures[request_id] = (future, worker, session_id)
+    with self._activity_lock:
+      worker.queue_depth += 1
+    worker.requests.put((request_id, command, session_id, argument))
+    return future
+
+  def _submit(self, worker, command, session_id, argument=None):
+    """Queue a request for WORKER, and return its future. The caller
+    must not hold the pool's lock."""
+    self._acquire_slot(worker)
+    with self._lock:
+      return self._enqueue(worker, command, session_id, argument)
+
+  def _submit_to_session(self, session_id, command, argument=None,
+                         forget=False):
+    """Queue a request for the worker hosting the session with ID
+    SESSION_ID, and return its future. If FORGET is true, the session
+    is forgotten once the request is queued. The caller must not hold
+    the pool's lock."""
+    while True:
+      with self._lock:
+        worker = self._get_worker(session_id)
+      self._acquire_slot(worker)
+      with self._lock:
+        # The session may have moved or closed while we waited.
+        if (self._routes.get(session_id) is worker
+            and session_id not in self._moving):
+          future = self._enqueue(worker, command, session_id, argument)
+          if forget:
+            del self._routes[session_id]
+            with self._activity_lock:
+              del worker.sessions[session_id]
+          return future
+      worker.slots.release()
+
+  def _shard(self, session_id):
+    """Return the worker on which a new session with ID SESSION_ID is
+    placed."""
+    key = str(session_id).encode('utf-8')
+    return self._workers[zlib.crc32(key) % len(self._workers)]
+
+  def _get_worker(self, session_id):
+    """Return the worker hosting the session with ID SESSION_ID. The
+    caller holds the pool's lock."""
+    if session_id in self._moving:
+      raise ZPoolSessionMoving(session_id)
+    try:
+      return self._routes[session_id]
+    except KeyError:
+      raise ZPoolNoSuchSession(session_id)
+
+  def _move(self, session_id, target):
+    """Move the session with ID SESSION_ID to the worker TARGET. The
+    caller must not hold the pool's lock: it is only taken to mark the
+    session as moving and to switch its route, not while the workers
+    export and import it."""
+    with self._lock:
+      source = self._get_worker(session_id)
+      if source is target:
+        return
+      self._moving.add(session_id)
+    try:
+      log("Moving session %s from worker %d to worker %d",
+          session_id, source.index, target.index)
+      snapshot = self._submit(source, 'export', session_id).result()
+      with self._lock:
+        self._routes[session_id] = target
+        with self._activity_lock:
+          del source.sessions[session_id]
+          target.sessions[session_id] = 0
+      self._submit(target, 'import', session_id, snapshot).result()
+    finally:
+      with self._lock:
+        self._moving.discard(session_id)
+
+  #--------- Public APIs -----------
+
+  @property
+  def num_workers(self):
+    return len(self._workers)
+
+  def create_session(self, session_id=None):
+    """Start a new session with ID SESSION_ID (a new ID if None).
+    Return the ID, along with a future of the output of the story up
+    to its first request for input."""
+    with self._lock:
+      if session_id is None:
+        session_id = next(self._session_ids)
+    worker = self._shard(session_id)
+    self._acquire_slot(worker)
+    with self._lock:
+      future = self._enqueue(worker, 'create', session_id)
+      self._routes[session_id] = worker
+      with self._activity_lock:
+        worker.sessions[session_id] = 0
+    return session_id, future
+
+  def send(self, session_id, line):
+    """Give LINE of input to the session with ID SESSION_ID. Return a
+    future of the output of the story in response."""
+    return self._submit_to_session(session_id, 'send', line)
+
+  def close_session(self, session_id):
+    """Stop the session with ID SESSION_ID. Return a future of its
+    completion."""
+    return self._submit_to_session(session_id, 'close', forget=True)
+
+  def worker_of(self, session_id):
+    """Return the index of the worker hosting the session with ID
+    SESSION_ID."""
+    with self._lock:
+      return self._get_worker(session_id).index
+
+  def migrate(self, session_id, worker_index):
+    """Move the session with ID SESSION_ID to the worker numbered
+    WORKER_INDEX, through a Quetzal snapshot. The session must be
+    waiting for input. Requests for the session submitted afterwards
+    go to its new worker."""
+    self._move(session_id, self._workers[worker_index])
+
+  def rebalance(self, max_moves=None):
+    """Move sessions from the workers which executed the most
+    instructions since the last rebalancing to those which executed
+    the fewest, as long as a move reduces the imbalance between them.
+    Return the number of sessions moved."""
+    moves = 0
+    with self._activity_lock:
+      loads = dict((worker, sum(worker.sessions.values()))
+                   for worker in self._workers)
+    while max_moves is None or moves < max_moves:
+      busiest = max(self._workers, key=loads.get)
+      idlest = min(self._workers, key=loads.get)
+      gap = loads[busiest] - loads[idlest]
+      # Moving a session doing less than the whole gap brings both
+      # workers closer to the mean.
+      with self._activity_lock:
+        candidates = [(activity, session_id) for session_id, activity
+                      in busiest.sessions.items() if 0 < activity < gap]
+      if not candidates:
+        break
+      activity, session_id = max(candidates)
+      try:
+        self._move(session_id, idlest)
+      except Exception as e:
+        log("Could not move session %s: %s", session_id, e)
+        break
+      loads[busiest] -= activity
+      loads[idlest] += activity
+      moves += 1
+    with self._activity_lock:
+      for worker in self._workers:
+        for session_id in worker.sessions:
+          worker.sessions[session_id] = 0
+    return moves
+
+  def stats(self):
+    """Return a list of statistics about each worker, as dictionaries
+    holding its index and process ID, the number of sessions it hosts,
+    the number of requests queued for it, the total number of
+    instructions it executed and the time it spent executing them,
+    and its rate of instructions per second since the previous call
+    to stats()."""
+    result = []
+    now = time.perf_counter()
+    for worker in self._workers:
+      instructions, busy_time = worker.counters[0], worker.counters[1]
+      last_time, last_instructions = worker.last_sample
+      worker.last_sample = (now, instructions)
+      result.append({
+        'worker': worker.index,
+        'pid': worker.process.pid,
+        'sessions': len(worker.sessions),
+        'queue_depth': worker.queue_depth,
+        'instructions': int(instructions),
+        'busy_time': busy_time,
+        'instructions_per_sec': ((instructions - last_instructions)
+                                 / (now - last_time)),
+        })
+    return result
+
+  def close(self):
+    """Stop all the worker processes."""
+    for worker in self._workers:
+      worker.requests.put(None)
+    for worker in self._workers:
+      worker.process.join()
+    self._responses.put(None)
+    self._collector.join()
@@ -8,6 +8,28 @@
 # root directory of this distribution.
 #
 
+# Both stacks live in a single list of values, laid out as in the
+# Stks chunk of Quetzal files: the values pushed outside of any
+# routine, then, for each routine from the oldest call up, its local
+# variables followed by the values it pushed on the data stack.  Each
+# routine call also has a frame record, a tuple
+#
+#     (base, num_locals, return_pc, store_var, num_args)
+#
+# where BASE is the index of its first local variable in the list of
+# values, RETURN_PC the address at which its caller resumes, and
+# STORE_VAR the variable receiving its return value (or None).  The
+# bounds of the locals and data stack of the running routine are kept
+# aside, so that locals are read and written with a single index, and
+# calling a routine allocates nothing but its frame record.
+#
+# The header of a routine (its number of locals and, before version 5,
+# their initial values) is parsed on its first call only.  Routines
+# live in high memory, which never changes, so their parsed headers
+# are kept, by address, and shared by all the machines running the
+# story (see zstoryimage).  Routines in dynamic memory, if a story
+# has any, are parsed on every call.
+
 from .zlogging import log
 
 class ZStackError(Exception):
@@ -30,72 +52,36 @@ class ZStackPopError(ZStackError):
   "Nothing to pop from stack!"
   pass
 
-# Helper class used by ZStackManager; a 'routine' object which
-# includes its own private stack of data.
-class ZRoutine(object):
-
-  def __init__(self, start_addr, return_addr, zmem, args,
-               local_vars=None, stack=None):
-    """Initialize a routine object beginning at START_ADDR in ZMEM,
-    with initial argument values in list ARGS.  If LOCAL_VARS is None,
-    then parse them from START_ADDR."""
 
-    self.start_addr = start_addr
-    self.return_addr = return_addr
-    self.program_counter = 0    # used when execution interrupted
+class ZStackManager(object):
 
-    if stack is None:
-      self.stack = []
-    else:
-      self.stack = stack[:]
+  def __init__(self, zmem):
 
-    if local_vars is not None:
-      self.local_vars = local_vars[:]
+    self._memory = zmem
+    self._values = []
+    self._frames = []
+    # Index of the first local variable of the running routine in
+    # _values, and index of the first value of its data stack.
+    self._base = 0
+    self._stack_base = 0
+
+    # Parsed routine headers, by routine address.
+    if zmem.image is not None:
+      self._routines = zmem.image.routines
     else:
-      num_local_vars = zmem[self.start_addr]
-      if not (0 <= num_local_vars <= 15):
-        log("num local vars is %d" % num_local_vars)
-        raise ZStackError
-      self.start_addr += 1
-
-      # Initialize the local vars in the ZRoutine's dictionary. This is
-      # only needed on machines v1 through v4. In v5 machines, all local
-      # variables are preinitialized to zero.
-      self.local_vars = [0 for _ in range(15)]
-      if 1 <= zmem.version <= 4:
-        for i in range(num_local_vars):
-          self.local_vars[i] = zmem.read_word(self.start_addr)
-          self.start_addr += 2
-      elif zmem.version != 5:
-        raise ZStackUnsupportedVersion
+      self._routines = {}
 
-    # Place call arguments into local vars, if available
-    for i in range(0, len(args)):
-      self.local_vars[i] = args[i]
 
+  def _enter_top_frame(self):
+    """Point the bounds of the running routine to the topmost frame
+    record."""
 
-  def pretty_print(self):
-    "Display a ZRoutine nicely, for debugging purposes."
-
-    log("ZRoutine:        start address: %d" % self.start_addr)
-    log("ZRoutine: return value address: %d" % self.return_addr)
-    log("ZRoutine:      program counter: %d" % self.program_counter)
-    log("ZRoutine:      local variables: %d" % self.local_vars)
-
-
-class ZStackBottom(object):
-
-  def __init__(self):
-    self.program_counter = 0  # used as a cache only
-
-
-class ZStackManager(object):
-
-  def __init__(self, zmem):
-
-    self._memory = zmem
-    self._stackbottom = ZStackBottom()
-    self._call_stack = [self._stackbottom]
+    if self._frames:
+      base, num_locals = self._frames[-1][:2]
+      self._base = base
+      self._stack_base = base + num_locals
+    else:
+      self._base = self._stack_base = 0
 
 
   def get_local_variable(self, varnum):
@@ -103,15 +89,11 @@ class ZStackManager(object):
     routine.  VARNUM must be a value between 0 and 15, and must
     exist."""
 
-    if self._call_stack[-1] == self._stackbottom:
+    if 0 <= varnum < self._stack_base - self._base:
+      return self._values[self._base + varnum]
+    if not self._frames:
       raise ZStackNoRoutine
-
-    if not 0 <= varnum <= 15:
-      raise ZStackNoSuchVariable
-
-    current_routine = self._call_stack[-1]
-
-    return current_routine.local_vars[varnum]
+    raise ZStackNoSuchVariable
 
 
   def set_local_variable(self, varnum, value):
@@ -119,45 +101,126 @@ class ZStackManager(object):
     currently-running routine.  VARNUM must be a value between 0 and
     15, and must exist."""
 
-    if self._call_stack[1] == self._stackbottom:
+    if 0 <= varnum < self._stack_base - self._base:
+      self._values[self._base + varnum] = value
+      return
+    if not self._frames:
       raise ZStackNoRoutine
-
-    if not 0 <= varnum <= 15:
-      raise ZStackNoSuchVariable
-
-    current_routine = self._call_stack[-1]
-
-    current_routine.local_vars[varnum] = value
+    raise ZStackNoSuchVariable
 
 
   def push_stack(self, value):
     "Push VALUE onto the top of the current routine's data stack."
 
-    current_routine = self._call_stack[-1]
-    current_routine.stack.append(value)
+    self._values.append(value)
 
 
   def pop_stack(self):
     "Remove and return value from the top of the data stack."
 
-    current_routine = self._call_stack[-1]
-    return current_routine.stack.pop()
+    if len(self._values) <= self._stack_base:
+      raise ZStackPopError
+    return self._values.pop()
 
 
   def get_stack_frame_index(self):
     "Return current stack frame number.  For use by 'catch' opcode."
 
-    return len(self._call_stack) - 1
+    return len(self._frames)
 
 
-  # Used by quetzal save-file parser to reconstruct stack-frames.
-  def push_routine(self, routine):
-    """Blindly push a ZRoutine object to the call stack.
+  # Used by quetzal save-file parser and writer to reconstruct and
+  # save stack-frames.
+  def clear(self):
+    """Empty the call stack and the data stack."""
+
+    del self._values[:]
+    del self._frames[:]
+    self._enter_top_frame()
+
+
+  def push_frame(self, return_pc, store_var, num_args, local_vars,
+                 stack):
+    """Blindly push a frame to the call stack, for a routine with
+    local variables LOCAL_VARS and data stack STACK, which was called
+    with NUM_ARGS arguments, stores its return value in variable
+    STORE_VAR (or nowhere, if None), and returns to RETURN_PC.
     WARNING: do not use this unless you know what you're doing; you
-    probably want the more full-featured start_routine() belowe
+    probably want the more full-featured start_routine() below
     instead."""
 
-    self._call_stack.append(routine)
+    base = len(self._values)
+    self._frames.append((base, len(local_vars), return_pc, store_var,
+                         num_args))
+    self._values.extend(local_vars)
+    self._values.extend(stack)
+    self._enter_top_frame()
+
+
+  def get_frames(self):
+    """Return the list of the frames of the call stack, from the
+    bottom up, as (return_pc, store_var, num_args, local_vars, stack)
+    tuples. The first one stands for the code running outside of any
+    routine: it only has a data stack."""
+
+    values = self._values
+    bounds = [frame[0] for frame in self._frames] + [len(values)]
+    frames = [(0, None, 0, [], values[:bounds[0]])]
+    for index, (base, num_locals, return_pc, store_var,
+                num_args) in enumerate(self._frames):
+      frames.append((return_pc, store_var, num_args,
+                     values[base:base + num_locals],
+                     values[base + num_locals:bounds[index + 1]]))
+    return frames
+
+
+  # Used by the undo buffer to save and restore the stacks.
+  def snapshot(self):
+    """Return a copy of the call stack and data stack, for restore().
+    The copy is a tuple (values, frames) of the values and frame
+    records of the stacks."""
+
+    return (tuple(self._values), tuple(self._frames))
+
+
+  def restore(self, snapshot):
+    """Replace the stacks with the copy SNAPSHOT, as returned by
+    snapshot()."""
+
+    values, frames = snapshot
+    self._values[:] = values
+    self._frames[:] = frames
+    self._enter_top_frame()
+
+
+  def _parse_routine_header(self, routine_addr):
+    """Parse the header of the routine at ROUTINE_ADDR.  Return a
+    tuple (num_locals, local_vars, start_addr) of its number of local
+    variables, a tuple of their initial values, and the address of its
+    first instruction."""
+
+    zmem = self._memory
+    zmem.check_readable(routine_addr, routine_addr + 1)
+    num_locals = zmem.raw[routine_addr]
+    if not (0 <= num_locals <= 15):
+      log("num local vars is %d", num_locals)
+      raise ZStackError
+    start_addr = routine_addr + 1
+
+    # Initialize the local vars. This is only needed on machines v1
+    # through v4. In v5 machines, all local variables are
+    # preinitialized to zero.
+    if 1 <= zmem.version <= 4:
+      zmem.check_readable(start_addr, start_addr + 2 * num_locals)
+      local_vars = [zmem.read_word_fast(start_addr + 2 * i)
+                    for i in range(num_locals)]
+      start_addr += 2 * num_locals
+    elif zmem.version == 5:
+      local_vars = [0] * num_locals
+    else:
+      raise ZStackUnsupportedVersion
+
+    return num_locals, tuple(local_vars), start_addr
 
 
   # ZPU should call this whenever it decides to call a new routine.
@@ -166,15 +229,31 @@ class ZStackManager(object):
     """Save the state of the currenly running routine (by examining
     the current value of the PROGRAM_COUNTER), and prepare for
     execution of a new routine at ROUTINE_ADDR with list of initial
-    arguments ARGS."""
-
-    new_routine = ZRoutine(routine_addr, return_addr,
-                           self._memory, args)
-    current_routine = self._call_stack[-1]
-    current_routine.program_counter = program_counter
-    self._call_stack.append(new_routine)
-
-    return new_routine.start_addr
+    arguments ARGS.  Return the address of the first instruction of
+    the new routine."""
+
+    header = self._routines.get(routine_addr)
+    if header is None:
+      header = self._parse_routine_header(routine_addr)
+      if routine_addr > self._memory._dynamic_end:
+        self._routines[routine_addr] = header
+    num_locals, local_vars, start_addr = header
+
+    # The locals are the call arguments, if available, followed by the
+    # initial values of the remaining locals.
+    num_args = len(args)
+    if num_args > num_locals:
+      num_args = num_locals
+      args = args[:num_locals]
+    base = len(self._values)
+    self._frames.append((base, num_locals, program_counter, return_addr,
+                         num_args))
+    self._values.extend(args)
+    self._values.extend(local_vars[num_args:])
+    self._base = base
+    self._stack_base = base + num_locals
+
+    return start_addr
 
 
   # ZPU should call this whenever it decides to return from current
@@ -185,19 +264,19 @@ class ZStackManager(object):
     Return the previous routine's program counter address, so that
     execution can resume where from it left off."""
 
-    exiting_routine = self._call_stack.pop()
-    current_routine = self._call_stack[-1]
+    if not self._frames:
+      raise ZStackNoRoutine
+    base, num_locals, return_pc, store_var, num_args = self._frames.pop()
+    del self._values[base:]
+    self._enter_top_frame()
 
     # Depending on many things, return stuff.
-    if exiting_routine.return_addr != None:
-      if exiting_routine.return_addr == 0: # Push to stack
+    if store_var is not None:
+      if store_var == 0: # Push to stack
         self.push_stack(return_value)
-      elif 0 < exiting_routine.return_addr < 10: # Store in local var
-        self.set_local_variable(exiting_routine.return_addr,
-                                return_value)
+      elif 0 < store_var < 0x10: # Store in local var
+        self.set_local_variable(store_var - 1, return_value)
       else: # Store in global var
-        self._memory.write_global(exiting_routine.return_addr,
-                                  return_value)
-
-    return current_routine.program_counter
+        self._memory.write_global(store_var, return_value)
 
+    return return_pc
@@ -0,0 +1,136 @@
+#
+# A class which represents the read-only image of a story file, shared
+# between all the Z-machines running that story in a process.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Only dynamic memory, at the start of the story, can be modified by
+# a running game; static and high memory never change.  Hosting many
+# sessions of the same story therefore doesn't require a full copy of
+# the story per session.
+#
+# A ZStoryImage maps the story file in memory once, read-only.  Each
+# ZMemory built from the image gets its own private copy-on-write
+# mapping of the same file: the operating system shares the pages of
+# the mapping between all sessions (and with forked worker processes),
+# and only copies the pages a session actually writes to, which are
+# pages of dynamic memory.  To the rest of the interpreter, that
+# mapping behaves just like the bytearray memory is otherwise kept in.
+#
+# Stories which don't come from a file are copied once into an
+# anonymous in-memory file where the platform supports it (Linux), and
+# shared the same way.  Elsewhere, each ZMemory falls back to a private
+# bytearray copy of the story.
+#
+# An image holds file descriptors for as long as it lives, and so
+# does each memory mapped from it.  Images of story files are kept for
+# the life of the process (see load_story()); other images should be
+# closed once no more machines are to be created on them.
+
+import mmap
+import os
+import weakref
+
+from .zlogging import log
+
+class ZStoryImageError(Exception):
+  "General exception for ZStoryImage class"
+  pass
+
+class ZStoryImageTooSmall(ZStoryImageError):
+  "Story file is too small to hold a header."
+  pass
+
+# Shared images of story files, by real path, see load_story().
+_loaded_stories = {}
+
+
+class ZStoryImage(object):
+
+  def __init__(self, data, fileno=None):
+    """Create a story image holding DATA, a read-only buffer of the
+    story. If FILENO is given, it is a file descriptor whose contents
+    are DATA, from which private copy-on-write mappings are made. The
+    image owns the file descriptor, and closes it when closed or
+    garbage-collected."""
+
+    if len(data) < 64:
+      raise ZStoryImageTooSmall
+    self.data = data
+    self._fileno = fileno
+    if fileno is not None:
+      self._close_fileno = weakref.finalize(self, os.close, fileno)
+    else:
+      self._close_fileno = None
+    self.static_start = (data[0x0e] << 8) | data[0x0f]
+    # Strings decoded ahead of time, by address (see zstringtable).
+    self.strings = None
+    # Dictionaries in static memory, by address, loaded by the lexers
+    # of machines running the story (see zlexer).
+    self.dictionaries = {}
+    # Headers of routines outside dynamic memory, by address, parsed
+    # by the stack managers of machines running the story (see
+    # zstackmanager).
+    self.routines = {}
+
+  @classmethod
+  def from_bytes(cls, story):
+    """Return an image of the story in the bytes-like object STORY."""
+    story = bytes(story)
+    if len(story) < 64:
+      raise ZStoryImageTooSmall
+    if hasattr(os, 'memfd_create'):
+      fileno = os.memfd_create('zvm-story')
+      with os.fdopen(os.dup(fileno), 'wb') as f:
+        f.write(story)
+      return cls(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), fileno)
+    return cls(story)
+
+  def __len__(self):
+    return len(self.data)
+
+  def __getitem__(self, index):
+    """Return the byte (or bytes, for slices) at INDEX in the
+    story."""
+    return self.data[index]
+
+  def new_memory(self):
+    """Return a new, private and writable buffer holding the whole
+    story, for a running machine."""
+    if self._fileno is not None:
+      return mmap.mmap(self._fileno, 0, access=mmap.ACCESS_COPY)
+    return bytearray(self.data)
+
+  def close(self):
+    """Release the file descriptor and mapping of the image. The image
+    can't be used afterwards, but memories made from it keep working:
+    each of them holds its own mapping."""
+    if self._close_fileno is not None:
+      self._close_fileno()
+      self._close_fileno = None
+      self._fileno = None
+    if isinstance(self.data, mmap.mmap):
+      self.data.close()
+
+
+#--------- Public APIs -----------
+
+def load_story(path):
+  """Return the story image of the story file at PATH. Each story file
+  is mapped in memory once per process, and its image is shared by
+  all callers."""
+  path = os.path.realpath(path)
+  image = _loaded_stories.get(path)
+  if image is None:
+    fileno = os.open(path, os.O_RDONLY)
+    try:
+      data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      os.close(fileno)
+      raise ZStoryImageTooSmall
+    image = ZStoryImage(data, fileno)
+    _loaded_stories[path] = image
+    log("Mapped story file %s (%d bytes)", path, len(data))
+  return image
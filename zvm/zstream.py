@@ -5,6 +5,16 @@
 # root directory of this distribution.
 #
 
+class ZInputStreamError(Exception):
+  "General exception for input streams."
+  pass
+
+class ZInputNotReady(ZInputStreamError):
+  """Raised by input streams which can't block, when no input is
+  available yet. The machine suspends execution, and retries the
+  input instruction when it is resumed."""
+  pass
+
 class ZOutputStream(object):
   """Abstract class representing an output stream for a z-machine."""
 
@@ -79,7 +89,10 @@ class ZInputStream(object):
     Note, however, that supplying a timed input routine is only useful
     if the has_timed_input feature is supported by the input stream.
     If it is unsupported, then the timed input routine will not be
-    called."""
+    called.
+
+    Streams which can't block until input is available raise
+    ZInputNotReady instead."""
 
     raise NotImplementedError()
 
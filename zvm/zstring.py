@@ -5,8 +5,16 @@
 # root directory of this distribution.
 #
 
+import collections
 import itertools
 
+# Default number of decoded strings kept by a ZStringFactory.
+DEFAULT_CACHE_SIZE = 1024
+
+# Strings cached from dynamic memory are indexed by blocks of this
+# many bytes, to find those overlapping a memory write quickly.
+_CACHE_BLOCK_SHIFT = 6
+
 
 class ZStringEndOfString(Exception):
     """No more data left in string."""
@@ -21,41 +29,45 @@ class ZStringTranslator(object):
         self._mem = zmem
 
     def get(self, addr):
-        from .bitfield import BitField
-        pos = (addr, BitField(self._mem.read_word(addr)), 0)
-
+        """Return the list of 5-bit Z-characters of the string at
+        ADDR."""
+        self._mem.check_readable(addr, addr + 2)
+        read_word = self._mem.read_word_fast
         s = []
-        try:
-            while True:
-                s.append(self._read_char(pos))
-                pos = self._next_pos(pos)
-        except ZStringEndOfString:
-            return s
-
-    def _read_char(self, pos):
-        offset = (2 - pos[2]) * 5
-        return pos[1][offset:offset+5]
-
-    def _is_final(self, pos):
-        return pos[1][15] == 1
-
-    def _next_pos(self, pos):
-        from .bitfield import BitField
-
-        offset = pos[2] + 1
-        # Overflowing from current block?
-        if offset == 3:
-            # Was last block?
-            if self._is_final(pos):
-                # Kill processing.
-                raise ZStringEndOfString
-            # Get and return the next block.
-            return (pos[0] + 2,
-                    BitField(self._mem.read_word(pos[0] + 2)),
-                    0)
-
-        # Just increment the intra-block counter.
-        return (pos[0], pos[1], offset)
+        while True:
+            # Each word packs three Z-characters, and its top bit
+            # marks the last word of the string.
+            word = read_word(addr)
+            s += ((word >> 10) & 0x1f, (word >> 5) & 0x1f, word & 0x1f)
+            if word & 0x8000:
+                return s
+            addr += 2
+
+
+# The Z-character decoder is a small state machine.  Its states:
+_NORMAL = 0         # Decoding characters of the current alphabet.
+_ABBREVIATION = 1   # The next character selects an abbreviation.
+_ESCAPE_HIGH = 2    # The next character is the top of a ZSCII code.
+_ESCAPE_LOW = 3     # The next character is the bottom of a ZSCII code.
+
+# In the decoding table of a ZCharTranslator, the special characters
+# are given as these negative actions instead of ZSCII codes.
+_NEWLINE = -1
+_SHIFT_UP = -2
+_SHIFT_DOWN = -3
+_SHIFT_LOCK_UP = -4
+_SHIFT_LOCK_DOWN = -5
+_ABBREV_0 = -6
+_ABBREV_1 = -7
+_ABBREV_2 = -8
+_ESCAPE = -9
+
+# Special characters 1-5 of each version, see _load_specials().
+_SPECIALS_V1 = (_NEWLINE, _SHIFT_UP, _SHIFT_DOWN,
+                _SHIFT_LOCK_UP, _SHIFT_LOCK_DOWN)
+_SPECIALS_V2 = (_ABBREV_0, _SHIFT_UP, _SHIFT_DOWN,
+                _SHIFT_LOCK_UP, _SHIFT_LOCK_DOWN)
+_SPECIALS_V3 = (_ABBREV_0, _ABBREV_1, _ABBREV_2, _SHIFT_UP, _SHIFT_DOWN)
 
 
 class ZCharTranslator(object):
@@ -74,15 +86,33 @@ class ZCharTranslator(object):
     def __init__(self, zmem):
         self._mem = zmem
 
-        # Initialize the alphabets
+        # Initialize the alphabets. Version 1 has its own symbol
+        # alphabet; later versions have a newline instead of '<'.
+        custom = None
         if self._mem.version == 5:
-            self._alphabet = self._load_custom_alphabet() or self.ALPHA_V5
+            custom = self._load_custom_alphabet()
+        if custom is not None:
+            alphabet = [list(custom[0]), list(custom[1]),
+                        list(custom[2][1:])]
+        elif self._mem.version == 1:
+            alphabet = self.ALPHA
         else:
-            self._alphabet = self.ALPHA
+            alphabet = self.ALPHA_V5
 
-        # Initialize the special state handlers
+        # Initialize the special characters
         self._load_specials()
 
+        # Flatten the alphabets and special characters into a single
+        # decoding table, indexed by 32 * alphabet + character.
+        self._table = []
+        for index, chars in enumerate(alphabet):
+            row = [32] + list(self._specials)
+            if index == 2:
+                row += [_ESCAPE] + list(chars)
+            else:
+                row += list(chars)
+            self._table += row
+
         # Initialize the abbreviations (if supported)
         self._load_abbrev_tables()
 
@@ -99,145 +129,93 @@ class ZCharTranslator(object):
         return [alphabet[0:26], alphabet[26:52], alphabet[52:78]]
 
     def _load_abbrev_tables(self):
-        self._abbrevs = {}
+        """Decode all abbreviations into ZSCII codes, in a list indexed
+        by 32 * subtable + abbreviation number."""
+        self._abbrevs = [None] * 96
 
-        # If the ZM doesn't do abbrevs, just return an empty dict.
+        # If the ZM doesn't do abbrevs, there's nothing to load.
         if self._mem.version == 1:
             return
 
         # Build ourselves a ZStringTranslator for the abbrevs.
         xlator = ZStringTranslator(self._mem)
 
-        def _load_subtable(num, base):
-            for i,zoff in [(i,base+(num*64)+(i*2))
-                            for i in range(0, 32)]:
-                zaddr = self._mem.read_word(zoff)
-                zstr = xlator.get(self._mem.word_address(zaddr))
-                zchr = self.get(zstr, allow_abbreviations=False)
-                self._abbrevs[(num, i)] = zchr
-
-        abbrev_base = self._mem.read_word(0x18)
-        _load_subtable(0, abbrev_base)
-
-        # Does this ZM support the extended abbrev tables?
         if self._mem.version >= 3:
-            _load_subtable(1, abbrev_base)
-            _load_subtable(2, abbrev_base)
+            num_subtables = 3
+        else:
+            num_subtables = 1
+        abbrev_base = self._mem.read_word(0x18)
+        for i in range(32 * num_subtables):
+            zaddr = self._mem.read_word(abbrev_base + 2 * i)
+            zstr = xlator.get(self._mem.word_address(zaddr))
+            self._abbrevs[i] = self.get(zstr, allow_abbreviations=False)
 
     def _load_specials(self):
-        """Load the special character code handlers for the current
-        machine version.
+        """Load the meaning of the special characters 1-5 for the
+        current machine version:
+
+          - v1: newline, then shifts up and down for one character,
+            then shift locks up and down.
+          - v2: abbreviation (from the first subtable), then shifts as
+            in v1.
+          - v3-5: abbreviations from the three subtables, then shifts
+            up and down for one character.
         """
-        # The following three functions define the three possible
-        # special character code handlers.
-        def newline(state):
-            """Append ZSCII 13 (newline) to the output."""
-            state['zscii'].append(13)
-
-        def shift_alphabet(state, direction, lock):
-            """Shift the current alphaber up or down. If lock is
-            False, the alphabet will revert to the previous alphabet
-            after outputting 1 character. Else, the alphabet will
-            remain unchanged until the next shift.
-            """
-            state['curr_alpha'] = (state['curr_alpha'] + direction) % 3
-            if lock:
-                state['prev_alpha'] = state['curr_alpha']
-
-        def abbreviation(state, abbrev):
-            """Insert the given abbreviation from the given table into
-            the output stream.
-
-            This character was an abbreviation table number. The next
-            character will be the offset within that table of the
-            abbreviation. Set up a state handler to intercept the next
-            character and output the right abbreviation."""
-            def write_abbreviation(state, c, subtable):
-                state['zscii'] += self._abbrevs[(subtable, c)]
-                del state['state_handler']
-
-            # If we're parsing an abbreviation, there should be no
-            # nested abbreviations. So this is just a sanity check for
-            # people feeding us bad stories.
-            if not state['allow_abbreviations']:
-                raise ZStringIllegalAbbrevInString
-
-            state['state_handler'] = lambda s,c: write_abbreviation(s, c,
-                                                                    abbrev)
-
-        # Register the specials handlers depending on machine version.
         if self._mem.version == 1:
-            self._specials = {
-                1: lambda s: newline(s),
-                2: lambda s: shift_alphabet(s, +1, False),
-                3: lambda s: shift_alphabet(s, -1, False),
-                4: lambda s: shift_alphabet(s, +1, True),
-                5: lambda s: shift_alphabet(s, -1, True),
-                }
+            self._specials = _SPECIALS_V1
         elif self._mem.version == 2:
-            self._specials = {
-                1: lambda s: abbreviation(s, 0),
-                2: lambda s: shift_alphabet(s, +1, False),
-                3: lambda s: shift_alphabet(s, -1, False),
-                4: lambda s: shift_alphabet(s, +1, True),
-                5: lambda s: shift_alphabet(s, -1, True),
-                }
-        else: # ZM v3-5
-            self._specials = {
-                1: lambda s: abbreviation(s, 0),
-                2: lambda s: abbreviation(s, 1),
-                3: lambda s: abbreviation(s, 2),
-                4: lambda s: shift_alphabet(s, +1, False),
-                5: lambda s: shift_alphabet(s, -1, False),
-                }
-
-    def _special_zscii(self, state, char):
-        if 'zscii_char' not in list(state.keys()):
-            state['zscii_char'] = char
+            self._specials = _SPECIALS_V2
         else:
-            zchar = (state['zscii_char'] << 5) + char
-            state['zscii'].append(zchar)
-            del state['zscii_char']
-            del state['state_handler']
+            self._specials = _SPECIALS_V3
 
     def get(self, zstr, allow_abbreviations=True):
-        state = {
-            'curr_alpha': 0,
-            'prev_alpha': 0,
-            'zscii': [],
-            'allow_abbreviations': allow_abbreviations,
-            }
+        """Return the list of ZSCII codes decoded from ZSTR, a sequence
+        of Z-characters. Abbreviations raise
+        ZStringIllegalAbbrevInString unless ALLOW_ABBREVIATIONS."""
+        table = self._table
+        result = []
+        append = result.append
+        # The alphabets are given as offsets into the decoding table:
+        # the current one, and the one to return to after a single
+        # shifted character.
+        alpha = base = 0
+        state = _NORMAL
 
         for c in zstr:
-            if 'state_handler' in list(state.keys()):
-                # If a special handler has registered itself, then hand
-                # processing over to it.
-                state['state_handler'](state, c)
-            elif c in list(self._specials.keys()):
-                # Hand off per-ZM version special char handling.
-                self._specials[c](state)
-            elif state['curr_alpha'] == 2 and c == 6:
-                # Handle the strange A2/6 character
-                state['state_handler'] = self._special_zscii
-            else:
-                # Do the usual Thing: append a zscii code to the
-                # decoded sequence and revert to the "previous"
-                # alphabet (or not, if it hasn't recently changed or
-                # was locked)
-                if c == 0:
-                    # Append a space.
-                    z = 32
-                elif state['curr_alpha'] == 2:
-                    # The symbol alphabet table only has 25 chars
-                    # because of the A2/6 special char, so we need to
-                    # adjust differently.
-                    z = self._alphabet[state['curr_alpha']][c-7]
+            if state == _NORMAL:
+                code = table[alpha + c]
+                if code >= 0:
+                    append(code)
+                    alpha = base
+                elif code == _ESCAPE:
+                    state = _ESCAPE_HIGH
+                elif code == _SHIFT_UP:
+                    alpha = (alpha + 32) % 96
+                elif code == _SHIFT_DOWN:
+                    alpha = (alpha + 64) % 96
+                elif code <= _ABBREV_0:
+                    if not allow_abbreviations:
+                        raise ZStringIllegalAbbrevInString
+                    abbrev = 32 * (_ABBREV_0 - code)
+                    state = _ABBREVIATION
+                elif code == _NEWLINE:
+                    append(13)
+                elif code == _SHIFT_LOCK_UP:
+                    alpha = base = (alpha + 32) % 96
                 else:
-                    z = self._alphabet[state['curr_alpha']][c-6]
-                state['zscii'].append(z)
-                state['curr_alpha'] = state['prev_alpha']
+                    alpha = base = (alpha + 64) % 96
+            elif state == _ABBREVIATION:
+                result += self._abbrevs[abbrev + c]
+                state = _NORMAL
+            elif state == _ESCAPE_HIGH:
+                high = c
+                state = _ESCAPE_LOW
+            else:
+                append((high << 5) | c)
+                alpha = base
+                state = _NORMAL
 
-        return state['zscii']
+        return result
 
 
 class ZsciiTranslator(object):
@@ -392,17 +370,137 @@ class ZsciiTranslator(object):
             raise IndexError("No such input character")
 
     def get(self, zscii):
-        return ''.join([self.ztou(c) for c in zscii])
+        """Return the Unicode string of the ZSCII codes in ZSCII."""
+        try:
+            return ''.join(map(self._output_table.__getitem__, zscii))
+        except KeyError:
+            raise IndexError("No such ZSCII character")
 
 
 class ZStringFactory(object):
-    def __init__(self, zmem):
+    def __init__(self, zmem, cache_size=DEFAULT_CACHE_SIZE):
+        """Create a factory decoding the strings of ZMEM. The last
+        CACHE_SIZE decoded strings are cached, by address."""
         self._mem = zmem
         self.zstr = ZStringTranslator(zmem)
         self.zchr = ZCharTranslator(zmem)
         self.zscii = ZsciiTranslator(zmem)
 
+        # Decoded strings by address, least recently used first.
+        # Strings in static and high memory never change, but those in
+        # dynamic memory (object names, mostly) are dropped when their
+        # bytes are written to. Those are also indexed by the blocks of
+        # memory they span, and we only start watching memory writes
+        # once there are some.
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._dynamic_blocks = {}
+        self._observing_writes = False
+        # Strings of static and high memory decoded ahead of time (see
+        # preload), kept apart from the cache and never evicted.
+        self._static_strings = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _cache_string(self, addr, end, string):
+        """Remember STRING, decoded from the bytes at ADDR up to END."""
+        self._cache[addr] = (string, end)
+        if addr <= self._mem._dynamic_end:
+            for block in range(addr >> _CACHE_BLOCK_SHIFT,
+                               ((end - 1) >> _CACHE_BLOCK_SHIFT) + 1):
+                self._dynamic_blocks.setdefault(block, set()).add(addr)
+            if not self._observing_writes:
+                self._mem.add_write_observer(self._on_memory_write)
+                self._observing_writes = True
+        if len(self._cache) > self._cache_size:
+            self._forget(next(iter(self._cache)))
+
+    def _forget(self, addr):
+        """Drop the cached string at ADDR."""
+        string, end = self._cache.pop(addr)
+        if addr <= self._mem._dynamic_end:
+            for block in range(addr >> _CACHE_BLOCK_SHIFT,
+                               ((end - 1) >> _CACHE_BLOCK_SHIFT) + 1):
+                addrs = self._dynamic_blocks[block]
+                addrs.discard(addr)
+                if not addrs:
+                    del self._dynamic_blocks[block]
+
+    def _on_memory_write(self, start, end):
+        """Drop cached strings overlapping the written range."""
+        blocks = self._dynamic_blocks
+        if not blocks:
+            return
+        stale = set()
+        for block in range(start >> _CACHE_BLOCK_SHIFT,
+                           ((end - 1) >> _CACHE_BLOCK_SHIFT) + 1):
+            if block in blocks:
+                stale.update(addr for addr in blocks[block]
+                             if addr < end and start < self._cache[addr][1])
+        for addr in stale:
+            self._forget(addr)
+
     def get(self, addr):
+        """Return the Unicode string decoded from the string at
+        ADDR."""
+        string = self._static_strings.get(addr)
+        if string is not None:
+            self.cache_hits += 1
+            return string
+        entry = self._cache.get(addr)
+        if entry is not None:
+            self._cache.move_to_end(addr)
+            self.cache_hits += 1
+            return entry[0]
+        self.cache_misses += 1
         zstr = self.zstr.get(addr)
         zchr = self.zchr.get(zstr)
-        return self.zscii.get(zchr)
+        string = self.zscii.get(zchr)
+        if self._cache_size > 0:
+            # Every word of the string packs three Z-characters.
+            self._cache_string(addr, addr + 2 * (len(zstr) // 3), string)
+        return string
+
+    def get_many(self, addresses, cache=True):
+        """Return the list of Unicode strings decoded from the strings
+        at each of ADDRESSES. If CACHE is false, the strings which
+        aren't cached yet are decoded without being cached, so that
+        one-off bulk loads don't evict strings in use."""
+        if cache:
+            get = self.get
+            return [get(addr) for addr in addresses]
+        zstr, zchr, zscii = self.zstr.get, self.zchr.get, self.zscii.get
+        static_strings = self._static_strings
+        result = []
+        for addr in addresses:
+            string = static_strings.get(addr)
+            if string is None:
+                entry = self._cache.get(addr)
+                if entry is None:
+                    string = zscii(zchr(zstr(addr)))
+                else:
+                    string = entry[0]
+            result.append(string)
+        return result
+
+    def preload(self, strings):
+        """Take STRINGS, a dictionary mapping addresses to the strings
+        decoded from them (see zstringtable), as already decoded.
+        Strings in dynamic memory go through the cache, as they may be
+        overwritten."""
+        dynamic_end = self._mem._dynamic_end
+        for addr, string in strings.items():
+            if addr > dynamic_end:
+                self._static_strings[addr] = string
+            elif self._cache_size > 0:
+                end = addr
+                while not self._mem.read_word(end) & 0x8000:
+                    end += 2
+                self._cache_string(addr, end + 2, string)
+
+    def clear_cache(self):
+        """Forget all decoded strings, and reset the cache counters."""
+        for addr in list(self._cache):
+            self._forget(addr)
+        self.cache_hits = 0
+        self.cache_misses = 0
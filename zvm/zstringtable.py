@@ -0,0 +1,252 @@
+#
+# A pass decoding, ahead of time, all the strings of a story that can
+# be found without running it, and a cache of the result stored next
+# to the story file.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Most of the text a story prints is fixed: inline strings of print
+# and print_ret, strings printed with print_paddr from a constant
+# address, object short names and abbreviations.  Those can be found
+# by following the code from its entry point: the scan decodes every
+# instruction reachable through fallthrough, branches, jumps and
+# calls to constant routine addresses, and collects the strings these
+# instructions print.  Code only reachable through computed addresses
+# isn't found, and its strings are decoded when first printed, as
+# usual.
+#
+# The strings are decoded into a table mapping addresses to text,
+# which is attached to the story image (so it is shared by all the
+# machines running the story) and preloaded into the string factory
+# of each new machine.  The table can be saved in a file next to the
+# story file, keyed by the release number, serial number and checksum
+# of the story, so that later runs load it instead of scanning again.
+
+import json
+import os
+import struct
+import sys
+
+from . import decodetables
+from . import zmemory
+from . import zopdecoder
+from . import zstring
+from .zlogging import log
+from .zobjectparser import ZObjectParser
+from .ztranslator import TERMINATORS
+
+class ZStringTableError(Exception):
+  "General exception for string tables."
+  pass
+
+# Version of the format of string table files.
+FILE_FORMAT = 1
+
+# Suffix appended to the path of a story file to name its string
+# table file.
+FILE_SUFFIX = ".zstrings"
+
+# Declaration of the opcodes calling a routine, in the format of
+# zopdecoder.STORE_OPCODES.
+CALL_OPCODES = {
+  zopdecoder.OPCODE_2OP: [(4, (25,)), (5, (26,))],
+  zopdecoder.OPCODE_1OP: [(4, (8,)), (5, (15,))],
+  zopdecoder.OPCODE_VAR: [(1, (0,)), (4, (12,)), (5, (25, 26))],
+  }
+
+# The print_paddr opcode.
+PRINT_PADDR = (zopdecoder.OPCODE_1OP, 13)
+
+# The jump opcode, which takes its offset as an operand.
+JUMP = (zopdecoder.OPCODE_1OP, 12)
+
+# Errors raised when decoding something which turns out not to be
+# code or text.
+_DECODE_ERRORS = (zmemory.ZMemoryError, zstring.ZStringIllegalAbbrevInString,
+                  IndexError, struct.error)
+
+
+class ZStringScanner(object):
+
+  def __init__(self, zmem):
+    """Create a scanner of the strings of the story in ZMEM."""
+    self._memory = zmem
+    self._stringfactory = zstring.ZStringFactory(zmem, cache_size=0)
+    self._opdecoder = zopdecoder.ZOpDecoder(zmem, None)
+    self._call_opcodes = zopdecoder._opcode_set(CALL_OPCODES, zmem.version)
+    self._high_start = zmem.read_word(0x04)
+    # Addresses of code to scan.
+    self._entry_points = [zmem.read_word(0x06)]
+    self.strings = {}
+
+  def _add_string(self, addr):
+    """Decode the string at ADDR into the table, unless it doesn't
+    decode."""
+    if addr in self.strings:
+      return
+    try:
+      self.strings[addr] = sys.intern(self._stringfactory.get(addr))
+    except _DECODE_ERRORS:
+      log("No string at %x", addr)
+
+  def _add_packed_string(self, packed_addr):
+    """Decode the string at PACKED_ADDR into the table, if there can be
+    a string there."""
+    try:
+      addr = self._memory.packed_address(packed_addr)
+    except _DECODE_ERRORS:
+      return
+    if addr >= self._high_start:
+      self._add_string(addr)
+
+  def _add_routine(self, packed_addr):
+    """Add the routine at PACKED_ADDR to the code to scan, if there
+    can be a routine there."""
+    try:
+      addr = self._memory.packed_address(packed_addr)
+      num_locals = self._memory[addr]
+    except _DECODE_ERRORS:
+      return
+    if addr < self._high_start or num_locals > 15:
+      return
+    if self._memory.version <= 4:
+      addr += 2 * num_locals
+    self._entry_points.append(addr + 1)
+
+  def _scan_code(self):
+    """Follow the code reachable from the entry points, and collect
+    the strings it prints."""
+    pending = list(self._entry_points)
+    seen = set()
+    while pending:
+      pc = pending.pop()
+      while pc not in seen and pc > self._memory._dynamic_end:
+        seen.add(pc)
+        try:
+          (opcode_class, opcode_number, operands, types, store, branch,
+           text, next_pc) = self._opdecoder.decode_instruction(pc)
+        except _DECODE_ERRORS:
+          break
+        opcode = (opcode_class, opcode_number)
+        constant = types is None or types[0] != zopdecoder.VARIABLE
+        if text is not None:
+          self._add_string(text)
+        if opcode == PRINT_PADDR and constant:
+          self._add_packed_string(operands[0])
+        elif opcode in self._call_opcodes and constant and operands:
+          self._add_routine(operands[0])
+          pending.extend(self._entry_points)
+          del self._entry_points[:]
+        if branch is not None and branch[1] not in (0, 1):
+          pending.append(next_pc + branch[1] - 2)
+        if opcode == JUMP:
+          if constant:
+            pending.append(next_pc + decodetables.to_signed(operands[0])
+                           - 2)
+          break
+        if opcode in TERMINATORS:
+          break
+        pc = next_pc
+
+  def _scan_objects(self):
+    """Collect the short names of all objects."""
+    objects = ZObjectParser(self._memory, self._stringfactory)
+    try:
+      count = objects.count_objects()
+    except _DECODE_ERRORS:
+      return
+    for objectnum in range(1, count + 1):
+      addr = objects._get_proptable_addr(objectnum)
+      if self._memory[addr] > 0:
+        self._add_string(addr + 1)
+      # Descriptions and routines attached to objects are found
+      # through the packed addresses held in their properties. Values
+      # which only happen to look like addresses are harmless: what we
+      # find there either doesn't decode, or is decoded correctly
+      # anyway.
+      try:
+        properties = objects.get_all_properties(objectnum)
+      except _DECODE_ERRORS:
+        continue
+      for prop_addr, size in properties.values():
+        for offset in range(0, size - 1, 2):
+          packed_addr = self._memory.read_word(prop_addr + offset)
+          self._add_routine(packed_addr)
+          self._add_packed_string(packed_addr)
+
+  def _scan_abbreviations(self):
+    """Collect the abbreviations."""
+    if self._memory.version == 1:
+      return
+    num_abbrevs = 96 if self._memory.version >= 3 else 32
+    table = self._memory.read_word(0x18)
+    for i in range(num_abbrevs):
+      self._add_string(2 * self._memory.read_word(table + 2 * i))
+
+  #--------- Public APIs -----------
+
+  def scan(self):
+    """Collect and decode all the strings found, and return them as a
+    dictionary mapping addresses to text."""
+    self._scan_abbreviations()
+    self._scan_objects()
+    self._scan_code()
+    log("Found %d strings", len(self.strings))
+    return self.strings
+
+
+def story_key(zmem):
+  """Return the key identifying the story in ZMEM: its release number,
+  serial number and checksum."""
+  return [zmem.read_word(0x02), bytes(zmem[0x12:0x18]).hex(),
+          zmem.generate_checksum()]
+
+def save_table(path, key, strings):
+  """Save the string table STRINGS, of the story identified by KEY,
+  in the file at PATH."""
+  data = {
+    'format': FILE_FORMAT,
+    'story': key,
+    'strings': sorted(strings.items()),
+    }
+  temp_path = path + ".tmp"
+  with open(temp_path, 'w') as f:
+    json.dump(data, f, separators=(',', ':'))
+  os.replace(temp_path, path)
+
+def load_table(path, key):
+  """Return the string table saved in the file at PATH, or None if
+  there is none, or if it was made for another story than the one
+  identified by KEY."""
+  try:
+    with open(path) as f:
+      data = json.load(f)
+  except (IOError, ValueError):
+    return None
+  if data.get('format') != FILE_FORMAT or data.get('story') != key:
+    return None
+  return dict((addr, sys.intern(text)) for addr, text in data['strings'])
+
+def precompile(image, story_path=None):
+  """Decode the strings of the story image IMAGE, and attach the
+  resulting table to the image, for machines created on it. If
+  STORY_PATH is given, the table is loaded from the file next to the
+  story file if it is there and matches the story, and saved there
+  otherwise. Return the table."""
+  zmem = zmemory.ZMemory(image)
+  key = story_key(zmem)
+  strings = None
+  if story_path is not None:
+    table_path = story_path + FILE_SUFFIX
+    strings = load_table(table_path, key)
+  if strings is None:
+    strings = ZStringScanner(zmem).scan()
+    if story_path is not None:
+      try:
+        save_table(table_path, key, strings)
+      except IOError as e:
+        log("Could not save string table: %s", e)
+  image.strings = strings
+  return strings
@@ -0,0 +1,184 @@
+#
+# A translator which compiles basic blocks of Z-code into Python
+# functions, as an alternative to interpreting instructions one by
+# one.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# The interpreter loop of ZCpu pays, for every executed instruction,
+# the cost of looking up the decoded instruction, building its operand
+# list and dispatching to the opcode implementation.  The translator
+# pays those costs once per block of code instead: starting at a given
+# address, it decodes consecutive instructions (using the static
+# decoding of ZOpDecoder), and generates the source of a Python
+# function which executes them in a row, with the opcode
+# implementations, constant operands and fallthrough addresses
+# resolved at translation time.
+#
+# Any instruction may still transfer control elsewhere (a taken
+# branch, a call, a return...).  After each instruction, the
+# generated code checks that the program counter is where straight-line
+# execution would have put it, and leaves the block otherwise.  The
+# CPU then looks up the block starting at the new address.
+#
+# Code living in dynamic memory can be modified by the game, so it is
+# never translated: it is always run by the interpreter.
+
+from . import zopdecoder
+from .zlogging import log, log_disasm
+
+# Instructions after which execution never falls through to the next
+# instruction. Blocks end after them.
+TERMINATORS = frozenset([
+  (zopdecoder.OPCODE_1OP, 11),  # ret
+  (zopdecoder.OPCODE_1OP, 12),  # jump
+  (zopdecoder.OPCODE_0OP, 0),   # rtrue
+  (zopdecoder.OPCODE_0OP, 1),   # rfalse
+  (zopdecoder.OPCODE_0OP, 3),   # print_ret
+  (zopdecoder.OPCODE_0OP, 7),   # restart
+  (zopdecoder.OPCODE_0OP, 8),   # ret_popped
+  (zopdecoder.OPCODE_0OP, 10),  # quit
+  (zopdecoder.OPCODE_2OP, 28),  # throw
+  ])
+
+# Upper bound on the number of instructions in a block.
+MAX_BLOCK_LENGTH = 64
+
+
+class ZTranslator(object):
+
+  def __init__(self, zmem, zopdecoder, dispatch, translatable, halt):
+    """Create a translator for code in ZMEM, decoded by ZOPDECODER.
+    DISPATCH is the dispatch table of the CPU, mapping
+    (opcode_class << 8) | opcode_number to opcode implementations, and
+    TRANSLATABLE(opcode_class, opcode_number) tells whether an opcode
+    may be part of a block; blocks end just before the first
+    instruction which isn't translatable. HALT is the exception raised
+    by opcode implementations to stop execution."""
+
+    self._memory = zmem
+    self._opdecoder = zopdecoder
+    self._dispatch = dispatch
+    self._translatable = translatable
+    self._halt = halt
+
+    # Maps addresses to compiled blocks, or to None for addresses
+    # where no block can be compiled.
+    self.blocks = {}
+
+
+  def _decode_block(self, pc):
+    """Return the list of decoded instructions of the block starting
+    at PC."""
+
+    instructions = []
+    while len(instructions) < MAX_BLOCK_LENGTH:
+      # Never translate code the game could modify.
+      if pc <= self._memory.dynamic_end:
+        break
+      instruction = self._opdecoder.decode_instruction(pc)
+      opcode_class, opcode_number = instruction[0], instruction[1]
+      if not self._translatable(opcode_class, opcode_number):
+        break
+      instructions.append((pc, instruction))
+      if (opcode_class, opcode_number) in TERMINATORS:
+        break
+      pc = instruction[7]
+    return instructions
+
+
+  def _generate_source(self, start_pc, instructions):
+    """Return the Python source of a function executing the given
+    decoded INSTRUCTIONS, which start at START_PC."""
+
+    # The opcode implementations and instruction shapes are bound to
+    # local names of the enclosing function, so that the block reads
+    # them as cheap closure variables. The block tells the decoder
+    # which instruction it executes, for the store, branch and text
+    # data of the instruction.
+    names = ", ".join(["h%d, s%d" % (i, i) for i in range(len(instructions))])
+    # An opcode implementation which halts execution leaves the
+    # program counter after its instruction, which tells how many
+    # instructions of the block ran.
+    executed = ", ".join(["%d: %d" % (instruction[7], i + 1)
+                          for i, (pc, instruction) in enumerate(instructions)])
+    lines = ["def make_block(decoder, read_variable, set_current, bindings,",
+             "               halt):",
+             "  %s, = bindings" % names,
+             "  executed = {%s}" % executed,
+             "  def block_%x():" % start_pc,
+             "    try:"]
+    for i, (pc, instruction) in enumerate(instructions):
+      operands, types, next_pc = instruction[2], instruction[3], instruction[7]
+      if types is None:
+        args = [str(value) for value in operands]
+      else:
+        args = []
+        for operand_type, value in zip(types, operands):
+          if operand_type == zopdecoder.VARIABLE:
+            args.append("read_variable(%d)" % value)
+          else:
+            args.append(str(value))
+      lines.append("      set_current(s%d)" % i)
+      lines.append("      decoder.program_counter = %d" % next_pc)
+      lines.append("      h%d(%s)" % (i, ", ".join(args)))
+      if i < len(instructions) - 1:
+        lines.append("      if decoder.program_counter != %d:" % next_pc)
+        lines.append("        return %d" % (i + 1))
+    lines.append("      return %d" % len(instructions))
+    lines.append("    except halt as e:")
+    lines.append("      e.instructions = executed[decoder.program_counter]")
+    lines.append("      raise")
+    lines.append("  return block_%x" % start_pc)
+    return "\n".join(lines) + "\n"
+
+
+  #--------- Public APIs -----------
+
+
+  def translate(self, pc):
+    """Compile the block of code starting at PC into a Python
+    function, and return it. Calling the function executes the block,
+    and returns the number of instructions executed; if an instruction
+    halts execution, that number is set as the 'instructions'
+    attribute of the halting exception instead. The function's
+    'length' attribute gives the number of instructions in the block.
+
+    Return None if no block can be compiled at PC, in which case the
+    instruction at PC must be interpreted."""
+
+    if pc in self.blocks:
+      return self.blocks[pc]
+
+    instructions = self._decode_block(pc)
+    if not instructions:
+      self.blocks[pc] = None
+      return None
+
+    source = self._generate_source(pc, instructions)
+    namespace = {}
+    exec(compile(source, "<ztranslator %x>" % pc, "exec"), namespace)
+
+    bindings = []
+    for instr_pc, instruction in instructions:
+      opcode_class, opcode_number = instruction[0], instruction[1]
+      handler = self._dispatch[(opcode_class << 8) | opcode_number]
+      bindings += [handler, instruction]
+      log_disasm(instr_pc, zopdecoder.OPCODE_STRINGS[opcode_class],
+                 opcode_number, handler.__name__, instruction[2])
+
+    decoder = self._opdecoder
+    block = namespace["make_block"](decoder, decoder.read_variable,
+                                    decoder.set_current_instruction,
+                                    bindings, self._halt)
+    block.length = len(instructions)
+    log("Translated block at %x (%d instructions)", pc, block.length)
+    self.blocks[pc] = block
+    return block
+
+
+  def flush(self):
+    """Forget all compiled blocks."""
+    self.blocks.clear()
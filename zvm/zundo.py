@@ -0,0 +1,263 @@
+#
+# A ring buffer of saved machine states, for the save_undo and
+# restore_undo opcodes.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Inform games save an undo state at every turn, so saving must be
+# cheap, and keeping several levels of undo must not cost a copy of
+# dynamic memory per level.  Only the newest state holds a full copy
+# of dynamic memory.  Each older state holds the runs of bytes which
+# differ between its memory and the memory of the state after it, as
+# they were in the older state.  Saving a state records what changed
+# in memory since the previous save; restoring a state writes back
+# only the bytes which changed since it was saved.
+#
+# A turn only writes to a few pages of dynamic memory, so the buffer
+# observes memory writes, and keeps its own map of the pages written
+# to since the newest state was saved (the dirty map of ZMemory
+# belongs to checkpoint logs).  Only those pages are compared with
+# the copy of the newest state, with one XOR per run of pages, by C
+# code, so that no Python code runs per unchanged byte.
+#
+# States are dropped, oldest first, when there are more than the
+# allowed number of levels, or when the differences and stacks they
+# hold take more than the allowed number of bytes.  Dropping a state
+# simply forgets its differences.
+
+import collections
+import re
+
+from .zlogging import log
+
+class ZUndoError(Exception):
+  "General exception for the undo buffer."
+  pass
+
+# Number of states kept by default.
+DEFAULT_LEVELS = 10
+
+# Number of bytes of memory differences and stack values kept by
+# default, besides the copy of dynamic memory of the newest state.
+DEFAULT_BUDGET = 256 * 1024
+
+# Estimated size of a call stack frame, besides its values, as in the
+# Stks chunk of Quetzal files.
+_FRAME_SIZE = 8
+
+_CHANGED_RUNS = re.compile(b"[^\0]+")
+_WRITTEN_RUNS = re.compile(b"\x01+")
+
+
+def _stack_size(stack):
+  """Return the number of bytes used by the stack copy STACK, as
+  returned by ZStackManager.snapshot()."""
+  values, frames = stack
+  return 2 * len(values) + _FRAME_SIZE * (len(frames) + 1)
+
+
+class ZUndoState(object):
+  """A saved state of the machine."""
+
+  def __init__(self, program_counter, store_addr, stack):
+    """Create a state resuming execution at PROGRAM_COUNTER, after a
+    save_undo instruction storing its result in variable STORE_ADDR,
+    with the call stack copy STACK."""
+
+    self.program_counter = program_counter
+    self.store_addr = store_addr
+    self.stack = stack
+    self.stack_size = _stack_size(stack)
+
+    # Runs of bytes turning the memory of the next state into the
+    # memory of this one, as (offset in dynamic memory, bytes) tuples.
+    self.changes = []
+    self.changes_size = 0
+
+  @property
+  def size(self):
+    """Number of bytes held by the state."""
+    return self.stack_size + self.changes_size
+
+
+class ZUndoBuffer(object):
+
+  def __init__(self, zmem, zstack, levels=DEFAULT_LEVELS,
+               budget=DEFAULT_BUDGET):
+    """Create an undo buffer for the machine with memory ZMEM and
+    stack manager ZSTACK, keeping up to LEVELS states, which hold up
+    to BUDGET bytes."""
+
+    self._memory = zmem
+    self._stackmanager = zstack
+    self.levels = levels
+    self.budget = budget
+
+    # Saved states, oldest first, the copy of dynamic memory of the
+    # newest one, and the number of bytes held by all of them.
+    self._states = collections.deque()
+    self._memory_copy = None
+    self._size = 0
+
+    # One byte per page of memory, set to 1 for the pages which may
+    # differ from the copy of dynamic memory. Memory writes are only
+    # observed once a state is saved.
+    self._page_shift = zmem.page_size.bit_length() - 1
+    self._written = bytearray(zmem.page_count)
+    self._observing = False
+
+
+  def _on_memory_write(self, start, end):
+    """Mark the pages of addresses START up to END as written to."""
+
+    first = start >> self._page_shift
+    last = (end - 1) >> self._page_shift
+    if first == last:
+      self._written[first] = 1
+    elif first < last:
+      self._written[first:last + 1] = b"\x01" * (last + 1 - first)
+
+
+  def _dynamic_memory(self):
+    """Return a copy of dynamic memory."""
+
+    mem = self._memory
+    return bytearray(mem.raw[mem.dynamic_start:mem.dynamic_end + 1])
+
+
+  def _written_regions(self):
+    """Return the list of (start, end) offsets in dynamic memory of the
+    runs of pages written to since the newest state was saved."""
+
+    mem = self._memory
+    shift = self._page_shift
+    base = mem.dynamic_start
+    size = mem.dynamic_end + 1 - base
+    regions = []
+    for run in _WRITTEN_RUNS.finditer(self._written):
+      start = max((run.start() << shift) - base, 0)
+      end = min((run.end() << shift) - base, size)
+      if start < end:
+        regions.append((start, end))
+    return regions
+
+
+  def _clear_written(self):
+    """Mark all pages as matching the copy of dynamic memory."""
+
+    self._written[:] = bytes(len(self._written))
+
+
+  def _diff(self, old, new):
+    """Return the list of (start, end) offsets of the runs of bytes
+    which differ between OLD and NEW, two byte strings of the same
+    length."""
+
+    diff = (int.from_bytes(old, 'big')
+            ^ int.from_bytes(new, 'big')).to_bytes(len(old), 'big')
+    return [run.span() for run in _CHANGED_RUNS.finditer(diff)]
+
+
+  def _trim(self):
+    """Drop the oldest states, until the buffer holds no more states
+    and bytes than it may. The newest state is always kept."""
+
+    while len(self._states) > 1 and (len(self._states) > self.levels
+                                     or self._size > self.budget):
+      self._size -= self._states.popleft().size
+
+
+  #--------- Public APIs -----------
+
+
+  def __len__(self):
+    return len(self._states)
+
+
+  @property
+  def size(self):
+    """Number of bytes held by the saved states."""
+    return self._size
+
+
+  def save(self, program_counter, store_addr):
+    """Save the state of the machine, which is to resume execution at
+    PROGRAM_COUNTER after storing 2 in variable STORE_ADDR once the
+    state is restored. Return False if no state can be saved."""
+
+    if self.levels < 1:
+      return False
+    if not self._observing:
+      self._memory.add_write_observer(self._on_memory_write)
+      self._observing = True
+
+    if self._states:
+      # Bring the copy of dynamic memory up to date, keeping the bytes
+      # it held in the previous state.
+      previous = self._states[-1]
+      memory_copy = self._memory_copy
+      raw = self._memory.raw
+      base = self._memory.dynamic_start
+      for start, end in self._written_regions():
+        old = bytes(memory_copy[start:end])
+        new = raw[base + start:base + end]
+        previous.changes += [(start + run_start, old[run_start:run_end])
+                             for run_start, run_end in self._diff(old, new)]
+        memory_copy[start:end] = new
+      self._clear_written()
+      previous.changes_size = sum(len(data) for start, data
+                                  in previous.changes)
+      self._size += previous.changes_size
+    else:
+      self._clear_written()
+      self._memory_copy = self._dynamic_memory()
+
+    state = ZUndoState(program_counter, store_addr,
+                       self._stackmanager.snapshot())
+    self._states.append(state)
+    self._size += state.size
+    self._trim()
+    log("Saved undo state %d, %d bytes held", len(self._states), self._size)
+    return True
+
+
+  def restore(self):
+    """Restore the memory and stacks of the newest saved state, and
+    drop it from the buffer. Return the state, or None if there is
+    none."""
+
+    if not self._states:
+      return None
+    state = self._states.pop()
+    self._size -= state.size
+
+    # Write back the bytes changed since the state was saved, so that
+    # caches built on memory only see those writes.
+    memory_copy = self._memory_copy
+    raw = self._memory.raw
+    base = self._memory.dynamic_start
+    for start, end in self._written_regions():
+      saved = bytes(memory_copy[start:end])
+      for run_start, run_end in self._diff(raw[base + start:base + end],
+                                           saved):
+        self._memory[base + start + run_start:base + start + run_end] = \
+          saved[run_start:run_end]
+    self._clear_written()
+    self._stackmanager.restore(state.stack)
+
+    # The previous state becomes the newest one. Memory differs from
+    # its copy by the changes it holds.
+    if self._states:
+      previous = self._states[-1]
+      for start, data in previous.changes:
+        memory_copy[start:start + len(data)] = data
+        self._on_memory_write(base + start, base + start + len(data))
+      self._size -= previous.changes_size
+      previous.changes = []
+      previous.changes_size = 0
+    else:
+      self._memory_copy = None
+    log("Restored undo state, %d left", len(self._states))
+    return state